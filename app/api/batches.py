@@ -0,0 +1,89 @@
+import os
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Form, HTTPException, UploadFile, File
+from fastapi.responses import JSONResponse
+from starlette.responses import FileResponse
+
+from app.db.auth.auth_db import auth_user_with_local_exception
+from app.db.model.auth import User
+from app.services.batch_jobs.runner import BatchJob, batch_job_runner
+from app.utils.definitions import BATCH_INPUTS_DIRECTORY
+from app.utils.log import setup_custom_logger
+
+router = APIRouter()
+
+logger = setup_custom_logger(__name__)
+
+LOCAL_USER_ID = "local"  # owner of the jobs created with the local token
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def resolve_batch_input_path(input_path: str) -> str:
+    """
+    Resolve a path relative to BATCH_INPUTS_DIRECTORY, the only directory a job reads from.
+    :raise HTTPException: if the path leaves the directory or is not a file
+    """
+    directory = os.path.realpath(BATCH_INPUTS_DIRECTORY)
+    path = os.path.realpath(os.path.join(directory, input_path))
+    if os.path.commonpath([directory, path]) != directory:
+        raise HTTPException(status_code=403, detail=f"Batch input files must be in {BATCH_INPUTS_DIRECTORY}.")
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail=f"No file found at {input_path} in {BATCH_INPUTS_DIRECTORY}.")
+    return path
+
+
+def _get_user_job(job_id: str, current_user: Optional[User]) -> BatchJob:
+    job = batch_job_runner.get(job_id)
+    if job is None or job.user_id != (current_user.id if current_user else LOCAL_USER_ID):
+        raise HTTPException(status_code=404, detail="No batch job found with this ID.")
+    return job
+
+
+@router.post("/v1/batches")
+async def create_batch(file: UploadFile = File(None), input_path: Optional[str] = Form(None),
+                       current_user: User = Depends(auth_user_with_local_exception)):
+    """
+    Run a JSONL file of chat requests in the background, uploaded or, with the local token, read from
+    BATCH_INPUTS_DIRECTORY on the server. The lines follow the OpenAI Batch API or are bare chat requests.
+    """
+    if (file is None) == (input_path is None):
+        raise HTTPException(status_code=400, detail="Send either a file or an input_path.")
+    if input_path is not None:
+        # the tunnels reach the server from localhost, only the local token tells a request of this machine apart
+        if current_user is not None:
+            raise HTTPException(status_code=403, detail="Only the local token can read a file of the server.")
+        input_path = resolve_batch_input_path(input_path)
+
+    async def read_upload():
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            yield chunk
+
+    job = await batch_job_runner.create(current_user.id if current_user else LOCAL_USER_ID,
+                                        content=read_upload() if file is not None else None, input_path=input_path)
+    return JSONResponse(content=job.to_dict())
+
+
+@router.get("/v1/batches")
+async def list_batches(current_user: User = Depends(auth_user_with_local_exception)):
+    jobs = batch_job_runner.list(current_user.id if current_user else LOCAL_USER_ID)
+    return JSONResponse(content={"object": "list", "data": [job.to_dict() for job in jobs]})
+
+
+@router.get("/v1/batches/{job_id}")
+async def get_batch(job_id: str, current_user: User = Depends(auth_user_with_local_exception)):
+    return JSONResponse(content=_get_user_job(job_id, current_user).to_dict())
+
+
+@router.post("/v1/batches/{job_id}/cancel")
+async def cancel_batch(job_id: str, current_user: User = Depends(auth_user_with_local_exception)):
+    return JSONResponse(content=batch_job_runner.cancel(_get_user_job(job_id, current_user)).to_dict())
+
+
+@router.get("/v1/batches/{job_id}/output")
+async def get_batch_output(job_id: str, current_user: User = Depends(auth_user_with_local_exception)):
+    """The results answered so far, one JSONL line per request in completion order."""
+    job = _get_user_job(job_id, current_user)
+    if not os.path.exists(job.output_path):
+        raise HTTPException(status_code=404, detail="The batch job has no output yet.")
+    return FileResponse(job.output_path, media_type="application/x-ndjson", filename=f"{job.id}_output.jsonl")
@@ -2,23 +2,28 @@ import json
 import uuid
 
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import select, func
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.requests import Request
 from starlette.responses import JSONResponse
 from vllm.entrypoints.openai.protocol import ErrorResponse, CompletionRequest
 
+from app.core.admission import AdmissionRejected
+from app.core.engine_pool import engine_pool
 from app.db.auth.auth_db import get_current_user
-from app.db.chat.chat_db import async_unpack_chat_history
+from app.db.chat.chat_db import async_unpack_chat_history, write_messages
+from app.db.chat.chat_tree_cache import chat_tree_cache
+from app.db.chat.message_writer import message_writer
 from app.db.lora.lora_db import establish_if_lora
-from app.db.ml_models.model_db import get_current_model
+from app.db.ml_models.model_db import get_current_model, get_model
 from app.db.model.auth import User
-from app.db.model.chat import Chat, Message
+from app.db.model.chat import Chat
 from app.db.personality.personality_db import format_dict_to_string, get_personality_by_id
 from app.hijacks.protocols.extended_oai import ExtendedChatCompletionRequest
 from app.hijacks.starlette import WrappedStreamingResponse
 from app.utils.formatting.chat.formatter import format_chat_response, extract_parameter_from_request
-from app.utils.formatting.chat.summerizer import populate_and_summarize_chat
+from app.utils.formatting.chat.history_budget import count_message_tokens
+from app.utils.formatting.chat.summerizer import title_summarizer
 from app.utils.database.get import get_db
 from app.utils.formatting.personality.personality_preprompt import format_personality_preprompt
 from app.utils.log import setup_custom_logger
@@ -32,6 +37,7 @@ logger = setup_custom_logger(__name__)
 async def edit_message(chat_id: str, summary: str,
                        request: Request, db: AsyncSession = Depends(get_db),
                        current_user: User = Depends(get_current_user)):
+    await message_writer.flush(chat_id)
     message = await db.execute(select(Chat).where(Chat.id == chat_id))
     message = message.scalars().first()
     if not message:
@@ -46,6 +52,7 @@ async def edit_message(chat_id: str, summary: str,
 @router.delete("/v1/chat/delete")
 async def delete_message(chat_id: str, db: AsyncSession = Depends(get_db),
                          current_user: User = Depends(get_current_user)):
+    await message_writer.flush(chat_id)
     message = await db.execute(select(Chat).where(Chat.id == chat_id))
     message = message.scalars().first()
     if not message:
@@ -54,6 +61,7 @@ async def delete_message(chat_id: str, db: AsyncSession = Depends(get_db),
         raise HTTPException(detail="You are not the owner of this message.", status_code=403)
     await db.delete(message)
     await db.commit()
+    chat_tree_cache.invalidate(chat_id)
     return JSONResponse(content={"message": f"Message {chat_id} deleted"})
 
 
@@ -67,6 +75,7 @@ async def abort(message_id: str):
 
 @router.get("/v1/list/chats")
 async def list_chats(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    await message_writer.flush()
     chats = await db.execute(select(Chat).where(Chat.user_id == current_user.id))
     chats = chats.scalars().all()
     return JSONResponse(
@@ -109,22 +118,28 @@ async def create_chat_completion(
     else:
         personality = None
 
-    model = await get_current_model(db)
+    # a model of the engine pool is served next to the main one
+    serving_chat = engine_pool.get_serving_chat(request.model)
+    model = await get_model(db, url=request.model) if serving_chat else await get_current_model(db)
+    serving_chat = serving_chat or openai_serving_chat
 
     is_new_chat = False
 
     # Retrieve or initialize chat
     if chat_id:
+        await message_writer.flush(chat_id)
         chat = await db.execute(select(Chat).where(Chat.id == chat_id))
         chat = chat.scalars().first()
         if not chat:
             raise HTTPException(detail="No chat found with this ID.", status_code=404)
     else:
         chat_id = uuid.uuid4().hex
-        chat = Chat(id=chat_id, user_id=current_user.id, model_id=model.name, timestamp=func.now())
-        db.add(chat)
+        chat = Chat(id=chat_id, user_id=current_user.id, model_id=model.name)
+        message_writer.add_chat(id=chat_id, user_id=current_user.id, model_id=model.name)
 
         is_new_chat = True
+    request.chat_id = chat_id
+    request.user = current_user.id
 
     # Check model compatibility
     is_lora = await establish_if_lora(request.model, db)
@@ -136,6 +151,7 @@ async def create_chat_completion(
         request.chat_template = lora_chat_template_dict.get(request.model, None)
 
     message = request.messages[0]
+    new_messages = []
 
     # add system prompt if in personality chat
     if is_new_chat:
@@ -149,54 +165,53 @@ async def create_chat_completion(
         else:
             initial_content = await format_personality_preprompt(personality, current_user) \
                 if personality else "You are an helpful AI Assistant."
-        system_message = Message(chat=chat, id=message["parent_message_id"], model_id=model.name,
-                                 content={"content": initial_content, "role": "system"})
-
-        db.add(system_message)
+        new_messages.append(dict(id=message["parent_message_id"], model_id=model.name,
+                                 content={"content": initial_content, "role": "system"},
+                                 token_count=await count_message_tokens(initial_content)))
 
     if not is_regeneration:
         if isinstance(message['content'], list):
             message['content'] = "<_MultiModalContent_>" + json.dumps(
                 message['content'])  # we add a prefix to the message to identify it as multimodal
 
-        user_message = Message(chat=chat, id=message['id'],
-                               parent_message_id=message["parent_message_id"], model_id=model.name,
-                               content={"content": message['content'], "role": message['role']})
-        db.add(user_message)
+        new_messages.append(dict(id=message['id'], parent_message_id=message["parent_message_id"],
+                                 model_id=model.name,
+                                 content={"content": message['content'], "role": message['role']},
+                                 token_count=await count_message_tokens(message['content'])))
+    else:
+        # the new response becomes a sibling of the current one, read the branch again
+        chat_tree_cache.invalidate(chat.id)
 
-    # Finalize chat session
-    await db.commit()
+    # written in the background, the branch is served from the chat tree cache
+    write_messages(chat_id, *new_messages)
 
     unpacked_history = await async_unpack_chat_history(db, chat, message["id"], selected_messages_version_ids,
                                                        personality)
     request.messages = unpacked_history
     response_id = uuid.uuid4().hex
     try:
-        generator = await openai_serving_chat.generate_response(request, raw_request)
+        generator = await serving_chat.generate_response(request, raw_request)
         if isinstance(generator, ErrorResponse):
             return JSONResponse(content=generator.model_dump(), status_code=generator.code)
         if request.stream:
-            return WrappedStreamingResponse(generator, db, chat, response_id, message['id'], model.name,
-                                            media_type="text/event-stream")
+            return WrappedStreamingResponse(generator, chat, response_id, message['id'], model.name,
+                                            media_type="text/event-stream", raw_request=raw_request)
 
         response = await format_chat_response(generator.model_dump())
-        response_msg = Message(chat=chat, id=response_id, parent_message_id=message['id'], model_id=model.name,
-                               content=response)
-        db.add(response_msg)
-        await db.commit()
+        write_messages(chat_id, dict(id=response_id, parent_message_id=message['id'], model_id=model.name,
+                                     content=response, token_count=await count_message_tokens(response['content'])))
         generation = generator.model_dump()
         generation['chat_id'] = chat_id
         generation['id'] = response_id
         return JSONResponse(content=generation)
+    except AdmissionRejected:
+        raise  # answered with a 429
     except Exception as e:
-        await db.rollback()
         raise HTTPException(detail=str(e), status_code=500)
     finally:
         if is_new_chat:
-            try:
-                await populate_and_summarize_chat(chat, db, openai_serving_chat, request, raw_request)
-            except Exception as e:
-                logger.error(f"Error while summarizing chat: {e}")
+            # titled in the background, batched with the other new chats
+            title_summarizer.schedule(chat_id, message['content'], request)
 
 
 @router.post("/v1/completions")
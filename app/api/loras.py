@@ -266,6 +266,10 @@ async def load_model(lora_url: str = Form(...),
         is_lora_loaded = openai_serving_chat.engine_client.engine.add_lora(lora_request)
         if is_lora_loaded:
             openai_serving_chat.lora_requests.append(lora_request)
+            if openai_serving_chat.response_cache:
+                openai_serving_chat.response_cache.clear(lora.url)
+            if openai_serving_chat.semantic_cache:
+                openai_serving_chat.semantic_cache.clear(lora.url)
     except Exception as e:
         return JSONResponse(content={"message": f"Error loading model: {str(e)}"}, status_code=500)
 
@@ -297,6 +301,10 @@ async def unload_model(lora_url: str = Form(...),
             return JSONResponse(content={"message": "Could not be unloaded"}, status_code=404)
         openai_serving_chat.lora_requests = [lora for lora in openai_serving_chat.lora_requests if
                                              lora.lora_int_id != lora_int_id]
+        if openai_serving_chat.response_cache:
+            openai_serving_chat.response_cache.clear(lora.url)
+        if openai_serving_chat.semantic_cache:
+            openai_serving_chat.semantic_cache.clear(lora.url)
     except Exception as e:
         return JSONResponse(content={"message": f"Error unloading model: {str(e)}"}, status_code=500)
 
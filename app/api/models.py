@@ -1,8 +1,9 @@
+import ast
 import asyncio
 import os
 import shutil
 import warnings
-from typing import Union
+from typing import Optional, Union
 
 from fastapi import APIRouter, Depends, Form, UploadFile, HTTPException, BackgroundTasks
 from fastapi.responses import JSONResponse
@@ -12,7 +13,11 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.responses import FileResponse
 from vllm.usage.usage_lib import UsageContext
 
+from app.api.open_ai import load_serving_entrypoints
 from app.core.engine import create_serving_instances
+from app.core.engine_pool import engine_pool
+from app.core.load_metrics import get_load_timings, start_load_timings
+from app.core.swap import swap_coordinator
 from app.db.auth.auth_db import get_current_user, get_last_model_lora, \
     set_last_model_lora
 from app.db.lora.lora_db import get_lora_list, hash_lora_str_id, get_lora
@@ -22,11 +27,13 @@ from app.db.ml_models.model_db import get_model_list, download_model_api_, \
 from app.db.model.auth import User
 from app.db.model.ml_model import Model
 from app.hijacks.vllm import ExtendedAsyncCompleteServerArgs
-from app.middlewares.model_loader_block import set_block_requests
 from app.utils.database.get import get_db
 from app.utils.database.images import save_image, delete_image
 from app.utils.formatting.pydantic.request import ImageRequest
 from app.utils.log import setup_custom_logger
+from app.utils.memory.cuda_mem import get_total_cuda_memory, get_engine_cuda_memory
+from app.utils.memory.estimator import estimate_model_fit
+from app.utils.memory.weight_cache import weight_cache
 from app.utils.formatting.pydantic.privacy import PrivacyOptions
 from app.utils.server.image_fetch import get_image
 from app.utils.server.restarter import restart
@@ -44,11 +51,31 @@ async def get_router_image(image_name: str):
     return await get_image(image_request)
 
 
+def estimate_model_fits(model: Model, available_memory: int, engine_args) -> Optional[dict]:
+    """
+    Estimate how each variant of a model would fit in VRAM with the current engine settings.
+    :return: the estimate of the model, or a dict of estimates keyed by GGUF variant
+    """
+    if model.variants:
+        try:
+            variant_paths = ast.literal_eval(model.path)
+        except (ValueError, SyntaxError):
+            return None
+        estimates = {variant: estimate_model_fit(path, available_memory, engine_args)
+                     for variant, path in variant_paths.items()}
+        return {variant: estimate.to_dict() if estimate else None for variant, estimate in estimates.items()}
+    estimate = estimate_model_fit(model.path or model.url, available_memory, engine_args)
+    return estimate.to_dict() if estimate else None
+
+
 @router.get("/model/list")
 async def show_available_models(
         db: AsyncSession = Depends(get_db),
         current_user: User = Depends(get_current_user)):
+    from app.core.engine import async_engine_args
     models = await get_model_list(db)
+    available_memory = (get_engine_cuda_memory(async_engine_args) if async_engine_args
+                        else int(get_total_cuda_memory() * 0.9))
     model_w_loras = {}
     non_f_model = {}
     for model in models:
@@ -62,7 +89,11 @@ async def show_available_models(
                 "model_speed": model.speed_value,
                 "model_architecture": model.base_architecture,
                 "versions": model.variants,
-                "loras": [lora.name for lora in loras]
+                "loras": [lora.name for lora in loras],
+                "resident": model.url in engine_pool or model.url in (async_engine_args.model,
+                                                                      async_engine_args.tokenizer),
+                "estimated_fit": await asyncio.to_thread(estimate_model_fits, model, available_memory,
+                                                         async_engine_args)
             }
         else:
             non_f_model[model.name] = {"name": model.name, "path": model.path,
@@ -109,70 +140,98 @@ async def show_loaded_model(current_user: User = Depends(get_current_user), db:
                         "url": lora_item.url, "description": lora_item.description,
                         "owner": lora_item.owner}
     return JSONResponse(content={"model": final_dict, "lora": lora, "is_lora_enabled": is_lora_enabled,
-                                 'is_vision': is_model_vision, "images_per_prompt": images_per_prompt})
+                                 'is_vision': is_model_vision, "images_per_prompt": images_per_prompt,
+                                 "pool": engine_pool.describe()})
 
 
 @router.post("/model/load")
 async def load_model(background_tasks: BackgroundTasks, model_url: str = Form(...), model_variant: str = Form(None),
                      db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
-    from app.core.engine import (openai_serving_chat,
-                                 delete_engine_model_from_vram, initialize_engine, async_engine_args)
     try:
-
-        old_conf = await openai_serving_chat.engine_client.get_model_config()
-
-        if model_url == old_conf.model:
-            raise HTTPException(detail="Model already loaded", status_code=409)
-
         is_model_predownloaded = (await db.execute(select(Model).where(Model.url == model_url))).scalars().first()
-
-        set_block_requests(True)
-
-        # Ensure that both engines are not currently running any tasks
-        while openai_serving_chat.engine_client.engine.has_unfinished_requests(): # noqa
-            await asyncio.sleep(0.1)
-
         if not is_model_predownloaded:
             return JSONResponse(content={"error": "Model not found, is it installed?"}, status_code=404)
-
-        # create a restoration server configuration
-        server_conf = ExtendedAsyncCompleteServerArgs.from_yaml("last.yml")
-        server_conf.gpu_memory_utilization = async_engine_args.gpu_memory_utilization
-        # here because otherwise the gpu memory utilization would be calculated with the model still in vram
         model_path = await get_model_path_or_url(is_model_predownloaded, model_variant)
-        # try to load the new model, if it fails reload the previous model
-        try:
-            delete_engine_model_from_vram()
-
-            server_conf.model = model_path
-            server_conf.tokenizer = model_url
-            server_conf.served_model_name = [model_url]
-            await initialize_engine(server_conf.get_async_eng_args(), UsageContext.OPENAI_API_SERVER)
-            create_serving_instances(server_conf.served_model_name, server_conf)
 
-            server_conf.save_to_yaml()
-            set_block_requests(False)
+        async def swap_engine() -> Optional[dict]:
+            from app.core.engine import (openai_serving_chat,
+                                         delete_engine_model_from_vram, initialize_engine, async_engine_args)
+            old_conf = await openai_serving_chat.engine_client.get_model_config()
+            if model_url == old_conf.model or model_path == old_conf.model:
+                return None
+            timings = get_load_timings() or start_load_timings()
+
+            # create a restoration server configuration
+            server_conf = ExtendedAsyncCompleteServerArgs.from_yaml("last.yml")
+            server_conf.gpu_memory_utilization = async_engine_args.gpu_memory_utilization
+            # here because otherwise the gpu memory utilization would be calculated with the model still in vram
+            # try to load the new model, if it fails reload the previous model
+            try:
+                # the model is about to become the main one, don't keep it loaded twice
+                await engine_pool.unload(model_url)
+                delete_engine_model_from_vram()
+
+                server_conf.model = model_path
+                server_conf.tokenizer = model_url
+                server_conf.served_model_name = [model_url]
+                engine_pool.fit_main_engine(server_conf)
+                await initialize_engine(server_conf.get_async_eng_args(), UsageContext.OPENAI_API_SERVER)
+                create_serving_instances(server_conf.served_model_name, server_conf)
+                load_serving_entrypoints()
+
+                server_conf.save_to_yaml()
+                # keep the previous model in host memory, swapping back to it will skip the disk
+                weight_cache.prefetch(old_conf.model, old_conf.revision)
+            except Exception:
+                background_tasks.add_task(restart(server_conf, True))
+                raise
+            return timings.to_dict()
 
+        try:
+            load_timings = await swap_coordinator.swap(model_path, swap_engine)
         except Exception as e:
-            background_tasks.add_task(restart(server_conf, True))
             return JSONResponse(
                 content={"status": f"The model you select run into errors ({e}), defaulted back to the orignal model"},
                 status_code=205)
+        if not load_timings:
+            raise HTTPException(detail="Model already loaded", status_code=409)
 
         await set_last_model_lora(db, current_user, model_id=is_model_predownloaded.url)
-        return JSONResponse(content={"status": "Model loaded successfully"}, status_code=200)
+        return JSONResponse(content={"status": "Model loaded successfully", "timings": load_timings}, status_code=200)
     except RepositoryNotFoundError:
-        set_block_requests(False)
         return JSONResponse(content={
             "error": "Model not found, please double check the repo name and if you have the right permissions"},
             status_code=404)
     except HTTPException as e:
         raise e
     except Exception as e:
-        set_block_requests(False)
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
+@router.post("/model/pool/load")
+async def load_model_in_pool(model_url: str = Form(...), model_variant: str = Form(None),
+                             db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+    from app.core.engine import async_engine_args
+    if model_url in (async_engine_args.model, async_engine_args.tokenizer):
+        raise HTTPException(detail="Model already loaded as the main model", status_code=409)
+    model = (await db.execute(select(Model).where(Model.url == model_url))).scalars().first()
+    if not model:
+        return JSONResponse(content={"error": "Model not found, is it installed?"}, status_code=404)
+    model_path = await get_model_path_or_url(model, model_variant)
+    try:
+        await engine_pool.load(model_url, model_path)
+    except (RuntimeError, ValueError) as e:
+        return JSONResponse(content={"error": str(e)}, status_code=409)
+    return JSONResponse(content={"status": "Model loaded in the pool", "pool": engine_pool.describe()})
+
+
+@router.post("/model/pool/unload")
+async def unload_model_from_pool(model_url: str = Form(...), current_user: User = Depends(get_current_user)):
+    if not await engine_pool.unload(model_url):
+        raise HTTPException(detail="Model is not in the pool", status_code=404)
+    return JSONResponse(content={"status": "Model unloaded from the pool", "pool": engine_pool.describe()})
+
+
 @router.post("/model/create")
 async def create_model(
         background_tasks: BackgroundTasks,
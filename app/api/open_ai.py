@@ -25,8 +25,12 @@ from vllm.entrypoints.openai.serving_tokenization import (
     OpenAIServingTokenization)
 from vllm.logger import init_logger
 
+from app.core.scheduler import Lane, scheduling_context
+from app.core.stream_shaper import shape_stream
 from app.db.auth.auth_db import auth_user_with_local_exception
 from app.db.model.auth import User
+from app.hijacks.protocols.extended_oai import ChatBatchRequest
+from app.services.batch_jobs.chat_batch import stream_chat_batch_ndjson
 
 TIMEOUT_KEEP_ALIVE = 5  # seconds
 
@@ -91,8 +95,16 @@ async def detokenize(request: DetokenizeRequest, current_user: User = Depends(au
 @router.post("/v1/chat/completions")
 async def create_chat_completion(request: ChatCompletionRequest,
                                  raw_request: Request, current_user: User = Depends(auth_user_with_local_exception)):
-    generator = await openai_serving_chat.create_chat_completion(
-        request, raw_request)
+    from app.core.engine_pool import engine_pool
+    serving_chat = engine_pool.get_serving_chat(request.model) or openai_serving_chat
+    # the local token is used by the loopback calls of the server itself, they carry the user they serve
+    if current_user is None:
+        scheduling = scheduling_context(Lane.INTERNAL)
+    else:
+        scheduling = scheduling_context(Lane.INTERACTIVE, current_user.id)
+    with scheduling:
+        generator = await serving_chat.create_chat_completion(
+            request, raw_request)
 
     if isinstance(generator, ErrorResponse):
         return JSONResponse(content=generator.model_dump(),
@@ -101,7 +113,28 @@ async def create_chat_completion(request: ChatCompletionRequest,
     elif isinstance(generator, ChatCompletionResponse):
         return JSONResponse(content=generator.model_dump())
 
-    return StreamingResponse(content=generator, media_type="text/event-stream")
+    # the loopback calls are not shaped, they are read line by line as soon as they arrive
+    return StreamingResponse(content=generator if current_user is None else shape_stream(generator, raw_request),
+                             media_type="text/event-stream")
+
+
+@router.post("/v1/chat/batch")
+async def create_chat_batch(request: ChatBatchRequest, raw_request: Request,
+                            current_user: User = Depends(auth_user_with_local_exception)):
+    """
+    Run many independent chat completions at once, so the engine batches them. The results are streamed as NDJSON
+    in completion order, one line per request with its index and either its response or its error.
+    """
+    from app.core.engine import async_engine_args
+    if len(request.requests) > async_engine_args.batch_max_items:
+        raise HTTPException(status_code=400,
+                            detail=f"A batch can hold at most {async_engine_args.batch_max_items} requests")
+    max_concurrency = min(request.max_concurrency or async_engine_args.batch_max_concurrency,
+                          async_engine_args.batch_max_concurrency)
+    user = current_user.id if current_user is not None else None
+    return StreamingResponse(content=stream_chat_batch_ndjson(request.requests, max(max_concurrency, 1),
+                                                              raw_request, user),
+                             media_type="application/x-ndjson")
 
 
 @router.post("/v1/completions")
@@ -14,6 +14,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.requests import Request
 from starlette.responses import JSONResponse, FileResponse
 
+from app.core.scheduler import Lane, scheduling_context
 from app.db.auth.auth_db import get_current_user, get_user
 from app.db.db_common import get_entity
 from app.db.model.auth import User
@@ -65,8 +66,14 @@ async def add_personality(
     # Generate personality data
     if auto_generate:
         from app.core.engine import openai_serving_chat
-        model_config = (await openai_serving_chat.engine_client.get_model_config())
-        model_name = model_config.model
+        from app.core.engine_pool import engine_pool
+        # generated by the background model when it is loaded in the engine pool
+        serving_chat = engine_pool.get_background_serving_chat()
+        if serving_chat:
+            model_name = serving_chat.base_model_paths[0].name
+        else:
+            serving_chat = openai_serving_chat
+            model_name = (await serving_chat.engine_client.get_model_config()).model
         personality_dict = await set_personality_model_request_as_dict(personality_name, personality_description)
 
         max_attempts = 5
@@ -75,7 +82,8 @@ async def add_personality(
 
         while attempts < max_attempts and not success:
             try:
-                preprompt = await create_preprompt(personality_dict, model_name, raw_request, openai_serving_chat)
+                with scheduling_context(Lane.BACKGROUND, current_user.id):
+                    preprompt = await create_preprompt(personality_dict, model_name, raw_request, serving_chat)
                 personality_description = preprompt.get("description")
                 personality_schema = PersonalitySchema(**preprompt).to_dict()
                 success = True
@@ -0,0 +1,66 @@
+from typing import Any
+
+from vllm import AsyncLLMEngine
+from vllm.entrypoints.openai.protocol import ChatCompletionRequest
+
+from app.utils.formatting.chat.history_budget import MESSAGE_OVERHEAD_TOKENS
+
+CHARS_PER_TOKEN = 4  # for the messages without a stored token count
+DEFAULT_COMPLETION_TOKENS = 512  # expected completion when max_tokens is not set
+MAX_RETRY_AFTER = 120  # seconds
+SATURATION_FREE_BLOCKS = 0.01  # share of the KV cache blocks left below which the engine is full
+
+
+class AdmissionRejected(Exception):
+    """The engine is full and the request can't wait for it, answered with a 429 and a Retry-After."""
+
+    def __init__(self, queue_position: int, retry_after: int):
+        super().__init__(f"The server is at capacity, the request would be number {queue_position} in the queue")
+        self.queue_position = queue_position
+        self.retry_after = retry_after
+
+
+def _content_chars(content: Any) -> int:
+    if isinstance(content, str):
+        return len(content)
+    if isinstance(content, list):
+        return sum(len(part.get("text") or "") for part in content if isinstance(part, dict))
+    return 0
+
+
+def estimate_demand(request: ChatCompletionRequest, max_model_len: int) -> int:
+    """
+    Estimate the KV cache tokens a request holds at its peak: its prompt plus the completion of each sequence.
+    The prompt is counted with the token counts stored on the Pulsar chat messages, the others are approximated
+    from their length.
+    :return: the number of tokens
+    """
+    prompt_tokens = 0
+    for message in request.messages:
+        if not isinstance(message, dict):
+            continue
+        token_count = message.get("token_count")
+        if token_count is None:
+            token_count = _content_chars(message.get("content")) // CHARS_PER_TOKEN
+        prompt_tokens += token_count + MESSAGE_OVERHEAD_TOKENS
+    prompt_tokens = min(prompt_tokens, max_model_len)
+    completion_tokens = min(request.max_tokens or DEFAULT_COMPLETION_TOKENS, max_model_len - prompt_tokens)
+    return prompt_tokens + max(completion_tokens, 0) * (request.n or 1)
+
+
+def kv_capacity_tokens(engine: AsyncLLMEngine) -> int:
+    """The tokens the KV cache of an engine holds, from the blocks vllm allocated at startup."""
+    cache_config = engine.engine.cache_config
+    return (cache_config.num_gpu_blocks or 0) * cache_config.block_size
+
+
+def is_engine_saturated(engine: AsyncLLMEngine) -> bool:
+    """
+    Whether the KV cache of an engine is already full, whatever the estimates say: vllm swapped sequences out or
+    has almost no free block left.
+    """
+    for scheduler in engine.engine.scheduler:
+        free_blocks = scheduler.block_manager.get_num_free_gpu_blocks()
+        if scheduler.swapped or free_blocks < SATURATION_FREE_BLOCKS * (engine.engine.cache_config.num_gpu_blocks or 0):
+            return True
+    return False
@@ -1,6 +1,7 @@
 import asyncio
 import copy
 import gc
+import time
 from typing import Optional, Union
 
 import torch
@@ -13,11 +14,18 @@ from vllm.entrypoints.openai.serving_engine import BaseModelPath
 from vllm.entrypoints.openai.serving_tokenization import OpenAIServingTokenization
 from vllm.usage.usage_lib import UsageContext
 
+from .admission import is_engine_saturated, kv_capacity_tokens
 from .fallback.picker import pick_a_quantized_fallback
+from .fit_profile import get_profile_key, load_fit_profile, apply_fit_profile, save_fit_profile, forget_fit_profile
+from .load_metrics import (time_phase, record_retry, instrument_vllm_engine, get_load_timings,
+                           start_load_timings)
 from .whisper import get_optimal_whisper
 from ..hijacks.openai import ExtendedOpenAIServingChat
 from ..hijacks.vllm import ExtendedAsyncEngineArgs, ExtendedAsyncCompleteServerArgs
 from ..utils.log import setup_custom_logger
+from ..utils.memory.cuda_mem import get_engine_cuda_memory
+from ..utils.memory.estimator import estimate_model_fit, MIN_USABLE_CONTEXT
+from ..utils.memory.weight_cache import weight_cache
 from ..utils.models.tokenizer_template_inferrer import maybe_get_chat_template
 from ..utils.server.engine_utils import find_max_seq_len
 
@@ -36,21 +44,27 @@ images_per_prompt: Optional[int] = None
 
 logger = setup_custom_logger(__name__)
 
+MAX_FALLBACK_MODELS = 3  # quantized fallbacks tried after the requested model, each with its own retry ladder
+
+instrument_vllm_engine()
+
 
 def delete_engine_model_from_vram() -> None:
     """Delete the model and all the gc's references to free the VRAM."""
     global async_engine, openai_serving_chat, openai_serving_completion
     logger.debug("Deleting the engine and all the gc's references to free the VRAM")
-    try:
-        del async_engine.engine.model_executor.driver_worker.model_runner
-        del async_engine.engine.model_executor.driver_worker
-        del async_engine
-        del openai_serving_chat, openai_serving_completion
-    except AttributeError:  # already unloaded
-        pass
-    gc.collect()
-    torch.cuda.synchronize()
-    torch.cuda.empty_cache()
+    with time_phase("teardown"):
+        try:
+            del async_engine.engine.model_executor.driver_worker.model_runner
+            del async_engine.engine.model_executor.driver_worker
+            del async_engine
+            del openai_serving_chat, openai_serving_completion
+        except AttributeError:  # already unloaded
+            pass
+    with time_phase("gc_empty_cache"):
+        gc.collect()
+        torch.cuda.synchronize()
+        torch.cuda.empty_cache()
 
 
 def get_engine_args(args: Union[dict, ModelConfig]) -> Optional[ExtendedAsyncEngineArgs]:
@@ -74,12 +88,34 @@ async def initialize_engine(engine_args: ExtendedAsyncEngineArgs, usage_context:
     global async_engine, model_config, async_engine_args, is_lora_enabled, is_model_vision, images_per_prompt
     async_engine = None
     async_engine_args = engine_args
+    timings = get_load_timings() or start_load_timings()
+
+    # if the weights are already in host memory this is a no-op, otherwise vllm will read them from the page cache
+    weight_cache.set_budget(engine_args.weight_cache_budget_gb)
+    try:
+        with time_phase("host_cache_warm"):
+            await weight_cache.warm(engine_args.model, engine_args.revision)
+    except OSError as e:
+        logger.error(f"Could not warm the host weight cache for {engine_args.model}: {e}")
 
     retries = 0
+    tried_fallbacks = set()
     original_engine_args = copy.copy(engine_args)
+    profile_key = get_profile_key(engine_args)
+    # start from the configuration that worked last time, so a known model skips the retry ladder
+    fit_profile = load_fit_profile(engine_args)
+    if fit_profile:
+        logger.info(f"Using the stored engine fit profile for {engine_args.model}")
+        apply_fit_profile(engine_args, fit_profile)
+    elif not engine_args.max_model_len:
+        apply_estimated_max_model_len(engine_args)
     while not async_engine and retries <= 3:
+        attempt_start = time.perf_counter()
         try:
-            async_engine = AsyncLLMEngine.from_engine_args(engine_args, usage_context=usage_context)
+            with time_phase("engine_init"):
+                # the weight load blocks for a while, run it off the event loop so the server keeps answering
+                async_engine = await asyncio.to_thread(AsyncLLMEngine.from_engine_args, engine_args,
+                                                       usage_context=usage_context)
             tokenizer = await async_engine.get_tokenizer()
             if not tokenizer.chat_template:
                 async_engine = None  # to throw AttributeError and to not delete the variable
@@ -93,6 +129,16 @@ async def initialize_engine(engine_args: ExtendedAsyncEngineArgs, usage_context:
                 model_config = asyncio.run(async_engine.get_model_config())
 
         except (torch.cuda.OutOfMemoryError, RuntimeError, ValueError) as e:
+            record_retry(e, time.perf_counter() - attempt_start)
+            if fit_profile:
+                # the stored profile does not fit anymore, fall back to the original arguments and the retry ladder
+                logger.error(f"The stored engine fit profile failed due to: {str(e)}, discarding it")
+                forget_fit_profile(profile_key)
+                delete_engine_model_from_vram()
+                apply_fit_profile(engine_args, {name: getattr(original_engine_args, name, None)
+                                                for name in fit_profile})
+                fit_profile = None
+                continue
             if retries < 3:
                 if await handle_specific_errors(e, engine_args):
                     continue
@@ -112,15 +158,26 @@ async def initialize_engine(engine_args: ExtendedAsyncEngineArgs, usage_context:
                 engine_args.gpu_memory_utilization = engine_args.gpu_memory_utilization - 0.1
                 engine_args.swap_space += 2
             else:
-                handle_final_retry(engine_args, original_engine_args, e)
+                # switch to the best quantized fallback that fits and start the retry ladder over with it
+                handle_final_retry(engine_args, original_engine_args, e, tried_fallbacks)
+                delete_engine_model_from_vram()
+                original_engine_args = copy.copy(engine_args)
+                profile_key = get_profile_key(engine_args)
+                apply_estimated_max_model_len(engine_args)
+                retries = 0
+                continue
             retries += 1
             continue  # Continue to retry initialization
 
         except Exception as e:
             logger.error(f"Failed to initialize the engine due to: {str(e)}")
+            if fit_profile:
+                forget_fit_profile(profile_key)  # the next start goes through the retry ladder again
             raise RuntimeError(f"Failed to initialize the engine due to: {str(e)}") from e
 
         if async_engine:
+            save_fit_profile(profile_key, engine_args)
+            logger.info(f"Engine for {engine_args.model} initialized, load timings: {timings.to_dict()}")
             is_lora_enabled = engine_args.enable_lora
             is_model_vision = async_engine.engine.model_config.multimodal_config is not None
             images_per_prompt = (
@@ -141,6 +198,21 @@ async def initialize_engine(engine_args: ExtendedAsyncEngineArgs, usage_context:
         )
 
 
+def apply_estimated_max_model_len(engine_args: ExtendedAsyncEngineArgs) -> None:
+    """Pick max_model_len from the analytic VRAM estimate instead of waiting for an OOM to find it."""
+    available_memory = get_engine_cuda_memory(engine_args)
+    estimate = estimate_model_fit(engine_args.model, available_memory, engine_args)
+    if not estimate:
+        return
+    if not estimate.fits:
+        logger.warning(f"Model {engine_args.model} is estimated to need more VRAM than available "
+                       f"({estimate.weight_bytes / 1024 ** 3:.1f} GB of weights), trying anyway")
+        return
+    if estimate.native_max_model_len and estimate.max_model_len < estimate.native_max_model_len:
+        logger.info(f"Setting max_model_len to {estimate.max_model_len} based on the estimated free KV cache memory")
+        engine_args.max_model_len = estimate.max_model_len
+
+
 async def handle_specific_errors(e: Exception, engine_args: ExtendedAsyncEngineArgs) -> bool:
     """Handle specific errors during engine initialization."""
     if any(sub_string in str(e) for sub_string in ['max_num_batched_tokens', 'does not support LoRA']):
@@ -169,7 +241,8 @@ async def handle_specific_errors(e: Exception, engine_args: ExtendedAsyncEngineA
             return True
     elif 'Chat template is not defined in the tokenizer' in str(e):
         logger.error("Chat template is not defined in the tokenizer, we'll to try infer it from the model config, this could lead to misconfigurations")
-        model_template = await maybe_get_chat_template(engine_args.model)
+        with time_phase("chat_template"):
+            model_template = await maybe_get_chat_template(engine_args.model)
         if not model_template:
             raise RuntimeError("Chat template is not defined in the tokenizer, "
                            "this is probably not an instruction tuned model.  Please use another model") from e
@@ -186,43 +259,78 @@ async def handle_specific_errors(e: Exception, engine_args: ExtendedAsyncEngineA
 
 def handle_final_retry(engine_args: ExtendedAsyncEngineArgs,
                        original_engine_args: ExtendedAsyncEngineArgs,
-                       e: Exception) -> None:
-    """Handle the final retry attempt."""
-    if engine_args.auto_quantized_fallback:
-        engine_args.model = pick_a_quantized_fallback(engine_args.quant_type_preference)
-        engine_args = original_engine_args
-    else:
-        logger.error(f"Unable to initialize model after retries: {str(e)}")
-        raise RuntimeError(f"Unable to initialize model after retries: {str(e)}") from e
+                       e: Exception, tried_fallbacks: set) -> None:
+    """
+    Handle the final retry attempt by resetting the arguments on the best quantized fallback that fits.
+    Each fallback gets the whole retry ladder, at most MAX_FALLBACK_MODELS of them are tried before giving up.
+    """
+    tried_fallbacks.add(engine_args.model)
+    if engine_args.auto_quantized_fallback and len(tried_fallbacks) <= MAX_FALLBACK_MODELS:
+        available_memory = get_engine_cuda_memory(original_engine_args)
+        fallback = pick_a_quantized_fallback(engine_args.quant_type_preference, available_memory,
+                                             min_context=original_engine_args.max_model_len or MIN_USABLE_CONTEXT,
+                                             exclude=tried_fallbacks, requested_model=engine_args.model)
+        if fallback:
+            logger.error(f"Unable to initialize {engine_args.model} after retries: {str(e)}, "
+                         f"falling back to {fallback}")
+            for name, value in vars(original_engine_args).items():
+                setattr(engine_args, name, value)
+            engine_args.model = fallback
+            engine_args.tokenizer = fallback
+            return
+    logger.error(f"Unable to initialize model after retries: {str(e)}")
+    raise RuntimeError(f"Unable to initialize model after retries: {str(e)}") from e
 
 
 def create_serving_instances(models: list, args: ExtendedAsyncCompleteServerArgs) -> None:
     """Create the serving instances for chat and completion."""
     global openai_serving_chat, openai_serving_completion, openai_serving_embedding, openai_serving_tokenization
-    served_model = [BaseModelPath(model_path='', name=model) for model in models]
-    openai_serving_chat = ExtendedOpenAIServingChat(
+    with time_phase("serving_instances"):
+        served_model = [BaseModelPath(model_path='', name=model) for model in models]
+        if openai_serving_chat is not None:
+            openai_serving_chat.retired = True  # the requests it admits from now on go to the new instance
+        openai_serving_chat = build_serving_chat(async_engine, model_config, models, args)
+        openai_serving_embedding = OpenAIServingEmbedding(
+            engine_client=async_engine,
+            model_config=model_config,
+            base_model_paths= served_model,
+            request_logger=None
+        )
+        openai_serving_tokenization = OpenAIServingTokenization(
+            engine_client=async_engine,
+            model_config=model_config,
+            base_model_paths= served_model,
+            lora_modules=args.lora_modules,
+            request_logger=None,
+            chat_template=args.chat_template
+        )
+        # openai_serving_completion = This is disabled since it is not used in the current implementation
+
+
+def build_serving_chat(engine: AsyncLLMEngine, engine_model_config: ModelConfig, models: list,
+                       args: ExtendedAsyncCompleteServerArgs) -> ExtendedOpenAIServingChat:
+    """Create the chat serving instance of an engine, used for the main engine and the ones in the engine pool."""
+    return ExtendedOpenAIServingChat(
         api_url=f"http://{args.host}:{args.port}",
-        engine_client=async_engine,
-        model_config=model_config,
-        base_model_paths= served_model,
+        engine_client=engine,
+        model_config=engine_model_config,
+        base_model_paths=[BaseModelPath(model_path='', name=model) for model in models],
         response_role=args.response_role,
         lora_modules=args.lora_modules,
         chat_template=args.chat_template,
         prompt_adapters=None,
-        request_logger=None
-    )
-    openai_serving_embedding = OpenAIServingEmbedding(
-        engine_client=async_engine,
-        model_config=model_config,
-        base_model_paths= served_model,
-        request_logger=None
-    )
-    openai_serving_tokenization = OpenAIServingTokenization(
-        engine_client=async_engine,
-        model_config=model_config,
-        base_model_paths= served_model,
-        lora_modules=args.lora_modules,
         request_logger=None,
-        chat_template=args.chat_template
+        prompt_token_cache_mb=async_engine_args.prompt_token_cache_mb,
+        response_cache_mb=async_engine_args.response_cache_mb,
+        response_cache_ttl=async_engine_args.response_cache_ttl,
+        semantic_cache_mb=async_engine_args.semantic_cache_mb,
+        semantic_cache_threshold=async_engine_args.semantic_cache_threshold,
+        enable_request_coalescing=async_engine_args.enable_request_coalescing,
+        scheduler_max_running=async_engine_args.scheduler_max_running
+        if async_engine_args.scheduler_max_running is not None else async_engine_args.max_num_seqs,
+        use_engine_priority=getattr(async_engine_args, 'scheduling_policy', 'fcfs') == 'priority',
+        admission_capacity=int(kv_capacity_tokens(engine) * async_engine_args.admission_kv_overcommit),
+        admission_max_waiting=async_engine_args.admission_max_waiting,
+        admission_max_wait=async_engine_args.admission_max_wait,
+        is_engine_saturated=lambda: is_engine_saturated(engine),
     )
-    # openai_serving_completion = This is disabled since it is not used in the current implementation
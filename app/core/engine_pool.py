@@ -0,0 +1,195 @@
+import asyncio
+import gc
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional, List, Dict, Any
+
+import torch
+from vllm import AsyncLLMEngine
+from vllm.usage.usage_lib import UsageContext
+
+from app.core.engine import build_serving_chat
+from app.core.swap import swap_coordinator
+from app.hijacks.openai import ExtendedOpenAIServingChat
+from app.hijacks.vllm import ExtendedAsyncCompleteServerArgs
+from app.utils.log import setup_custom_logger
+from app.utils.memory.cuda_mem import get_total_cuda_memory, get_used_cuda_memory
+from app.utils.memory.estimator import estimate_model_fit, FitEstimate
+
+logger = setup_custom_logger(__name__)
+
+MAX_GPU_MEMORY_UTILIZATION = 0.98
+
+
+@dataclass
+class PoolEntry:
+    model: str
+    engine: AsyncLLMEngine
+    serving_chat: ExtendedOpenAIServingChat
+    memory_bytes: int
+    last_used: float = field(default_factory=time.time)
+
+
+class EnginePool:
+    """
+    LRU of engines kept resident next to the main engine of app.core.engine.
+
+    The main engine keeps living in the app.core.engine globals, the pool only holds the side engines that fit in
+    the VRAM left over. Requests whose `model` names a pooled engine are routed to it, the least recently used idle
+    engine is evicted when a new one needs room.
+    """
+
+    def __init__(self, max_engines: int = 2):
+        self.max_engines = max_engines
+        self._entries: "OrderedDict[str, PoolEntry]" = OrderedDict()
+
+    def __contains__(self, model: str) -> bool:
+        return model in self._entries
+
+    @property
+    def models(self) -> List[str]:
+        return list(self._entries)
+
+    def get_serving_chat(self, model: Optional[str]) -> Optional[ExtendedOpenAIServingChat]:
+        entry = self._entries.get(model) if model else None
+        if not entry:
+            return None
+        entry.last_used = time.time()
+        self._entries.move_to_end(model)
+        return entry.serving_chat
+
+    def get_background_serving_chat(self) -> Optional[ExtendedOpenAIServingChat]:
+        """The pooled engine of background_model, which serves the titles and the personalities, None if not loaded."""
+        from app.core.engine import async_engine_args
+        return self.get_serving_chat(getattr(async_engine_args, "background_model", None))
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(entry.memory_bytes for entry in self._entries.values())
+
+    def describe(self) -> List[Dict[str, Any]]:
+        return [{"model": entry.model, "memory_gb": round(entry.memory_bytes / 1024 ** 3, 2),
+                 "last_used": int(entry.last_used)} for entry in self._entries.values()]
+
+    @staticmethod
+    def _release(entry: PoolEntry) -> None:
+        logger.info(f"Unloading {entry.model} from the engine pool")
+        try:
+            entry.engine.shutdown_background_loop()
+            del entry.engine.engine.model_executor.driver_worker.model_runner
+            del entry.engine.engine.model_executor.driver_worker
+        except AttributeError:  # already unloaded
+            pass
+        del entry.engine, entry.serving_chat
+        gc.collect()
+        torch.cuda.synchronize()
+        torch.cuda.empty_cache()
+
+    async def unload(self, model: str) -> bool:
+        entry = self._entries.pop(model, None)
+        if not entry:
+            return False
+        self._release(entry)
+        return True
+
+    def _evict_idle(self) -> bool:
+        """Evict the least recently used engine that has no request running, False if they are all busy."""
+        for model, entry in self._entries.items():
+            if not entry.engine.engine.has_unfinished_requests():  # noqa
+                self._release(self._entries.pop(model))
+                return True
+        return False
+
+    def _free_share(self) -> int:
+        """The VRAM a new engine may take: what is left on the device, split between the free slots of the pool."""
+        free_memory = int(get_total_cuda_memory() * MAX_GPU_MEMORY_UTILIZATION) - get_used_cuda_memory()
+        return max(free_memory, 0) // max(self.max_engines - len(self._entries), 1)
+
+    def _fit(self, model_path: str, server_conf: ExtendedAsyncCompleteServerArgs) -> FitEstimate:
+        """Estimate a new engine on its share of the VRAM, evicting idle engines until it fits in a free slot."""
+        while True:
+            estimate = estimate_model_fit(model_path, self._free_share(), server_conf)
+            if not estimate:
+                raise ValueError(f"Model {model_path} is not downloaded, download it before adding it to the pool")
+            if (len(self._entries) < self.max_engines and estimate.fits) or not self._evict_idle():
+                return estimate
+
+    def fit_main_engine(self, engine_args) -> None:
+        """
+        Set the share of the device a new main engine may take next to the pooled engines: vllm only subtracts its
+        own peak from total * gpu_memory_utilization, the memory of the pool has to come out of the utilization.
+        Idle engines are evicted while the main model is estimated not to fit in what is left.
+        """
+        total_memory = get_total_cuda_memory()
+        wanted = engine_args.gpu_memory_utilization
+        while True:
+            share = min(wanted, MAX_GPU_MEMORY_UTILIZATION - self.memory_bytes / total_memory)
+            estimate = None
+            if share > 0:
+                estimate = estimate_model_fit(engine_args.model, int(share * total_memory), engine_args)
+            fits = share > 0 and (estimate is None or estimate.fits)  # a model that is not on disk keeps its share
+            if share >= wanted or fits or not self._evict_idle():
+                break
+        if share <= 0:
+            raise RuntimeError("The engine pool leaves no memory for the main model, unload a pooled model first")
+        if share < wanted:
+            logger.info(f"Lowering the gpu memory utilization of {engine_args.model} to {share:.2f} to leave "
+                        f"{self.memory_bytes / 1024 ** 3:.1f} GB to the engine pool")
+        engine_args.gpu_memory_utilization = share
+
+    async def load(self, model_url: str, model_path: str) -> PoolEntry:
+        """
+        Load a model next to the main one.
+        :param model_url: the name the model is served and routed under
+        :param model_path: the path of the weights, i.e. a GGUF variant
+        """
+        from app.core.engine import async_engine_args
+        async with swap_coordinator.serialized():
+            if model_url in self._entries:
+                return self._entries[model_url]
+            if async_engine_args:
+                self.max_engines = async_engine_args.engine_pool_size
+            if self.max_engines <= 0:
+                raise RuntimeError("The engine pool is disabled, set engine_pool_size to keep side models loaded")
+
+            server_conf = ExtendedAsyncCompleteServerArgs.from_yaml("last.yml")
+            server_conf.model = model_path
+            server_conf.tokenizer = model_url
+            server_conf.served_model_name = [model_url]
+            server_conf.enable_lora = False
+            server_conf.enforce_eager = True  # cuda graphs would take memory away from the main engine
+
+            # the context is the longest the estimate fits in the share of the pool, not a fixed length
+            estimate = self._fit(model_path, server_conf)
+            if not estimate.fits or len(self._entries) >= self.max_engines:
+                raise RuntimeError(f"Model {model_url} does not fit next to the loaded models "
+                                   f"({estimate.weight_bytes / 1024 ** 3:.1f} GB of weights)")
+            max_model_len = estimate.max_model_len
+            needed_bytes = estimate.weight_bytes + estimate.overhead_bytes + estimate.kv_bytes_per_token * max_model_len
+            total_memory = get_total_cuda_memory()
+
+            # vllm sizes the kv cache on total * utilization minus the peak of its own worker, the memory of the
+            # other engines is not counted: the utilization is the share of the device this engine may take
+            used_before = get_used_cuda_memory()
+            server_conf.max_model_len = max_model_len
+            server_conf.gpu_memory_utilization = min(needed_bytes / total_memory, MAX_GPU_MEMORY_UTILIZATION)
+
+            logger.info(f"Loading {model_url} in the engine pool")
+            # the weight load blocks for a while, run it off the event loop so the server keeps answering
+            engine = await asyncio.to_thread(AsyncLLMEngine.from_engine_args, server_conf.get_async_eng_args(),
+                                             usage_context=UsageContext.OPENAI_API_SERVER)
+            tokenizer = await engine.get_tokenizer()
+            engine_model_config = await engine.get_model_config()
+            entry = PoolEntry(model=model_url, engine=engine,
+                              serving_chat=build_serving_chat(engine, engine_model_config, [model_url], server_conf),
+                              memory_bytes=get_used_cuda_memory() - used_before)
+            if not tokenizer.chat_template and not server_conf.chat_template:
+                self._release(entry)
+                raise RuntimeError("Chat template is not defined in the tokenizer, this is probably not an instruction "
+                                   "tuned model. Please use another model")
+            self._entries[model_url] = entry
+            return entry
+
+
+engine_pool = EnginePool()
@@ -8,8 +8,8 @@ logger = setup_custom_logger(__name__)
 
 
 async def continuously_monitor_server_for_errors(time_to_sleep: int = 60):
-    from app.core.engine import openai_serving_chat
     while True:
+        from app.core.engine import openai_serving_chat  # the engine may still be loading at startup
         try:
             if openai_serving_chat:
                 await openai_serving_chat.engine_client.check_health()
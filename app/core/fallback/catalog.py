@@ -0,0 +1,147 @@
+import os
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Iterable, Tuple
+
+import yaml
+
+from app.utils.log import setup_custom_logger
+from app.utils.memory.estimator import (read_model_footprint, estimate_fit, RUNTIME_OVERHEAD_BYTES,
+                                        MIN_USABLE_CONTEXT)
+
+logger = setup_custom_logger(__name__)
+
+CATALOG_PATH = os.path.join(os.path.dirname(__file__), "fallback.yml")
+QUANT_TYPES = ("GPTQ", "AWQ", "GGUF")
+DEFAULT_BITS = 4
+QUANT_SIZE_OVERHEAD = 1.1  # embeddings, scales and zero points are not quantized
+# used when the architecture config of a model can't be read, about a Llama 3 8B at fp16
+FALLBACK_KV_BYTES_PER_TOKEN = 128 * 1024
+
+# GGUF quantizations from the best to the worst
+GGUF_QUANT_RANKING = ("F32", "BF16", "F16", "Q8_0", "Q6_K", "Q5_K_L", "Q5_K_M", "Q5_K_S", "Q5_1", "Q5_0",
+                      "Q4_K_L", "Q4_K_M", "IQ4_NL", "Q4_K_S", "IQ4_XS", "Q4_1", "Q4_0", "Q3_K_L", "Q3_K_M",
+                      "IQ3_M", "IQ3_S", "Q3_K_S", "IQ3_XS", "IQ3_XXS", "Q2_K_L", "Q2_K", "IQ2_M", "IQ2_S",
+                      "IQ2_XS", "IQ2_XXS", "IQ1_M", "IQ1_S")
+_GGUF_QUANT_PATTERN = re.compile(r"(?<![A-Z0-9])(" + "|".join(GGUF_QUANT_RANKING) + r")(?![A-Z0-9])")
+
+
+@dataclass
+class CatalogEntry:
+    name: str
+    params: float
+    quality: int
+    variants: Dict[str, str]
+    bits: Dict[str, int] = field(default_factory=dict)
+    family: Optional[str] = None
+    architecture: Optional[str] = None
+
+    def estimated_weight_bytes(self, quant_type: str) -> int:
+        return int(self.params * 1e9 * self.bits.get(quant_type, DEFAULT_BITS) / 8 * QUANT_SIZE_OVERHEAD)
+
+
+@lru_cache(maxsize=1)
+def load_catalog() -> Tuple[CatalogEntry, ...]:
+    with open(CATALOG_PATH) as file:
+        data = yaml.safe_load(file)
+    return tuple(
+        CatalogEntry(name=name, params=float(entry.get("params", 0)), quality=int(entry.get("quality", 0)),
+                     variants={quant: entry[quant] for quant in QUANT_TYPES if quant in entry},
+                     bits=entry.get("bits", {}), family=entry.get("family"), architecture=entry.get("architecture"))
+        for name, entry in data.get("models", {}).items()
+    )
+
+
+def get_required_bytes(weight_bytes: int, min_context: int, kv_bytes_per_token: int = FALLBACK_KV_BYTES_PER_TOKEN):
+    return weight_bytes + RUNTIME_OVERHEAD_BYTES + min_context * kv_bytes_per_token
+
+
+def variant_fits(entry: CatalogEntry, quant_type: str, available_bytes: int, min_context: int) -> bool:
+    """Check a variant against the available VRAM, measuring it if it is downloaded and estimating it otherwise."""
+    repo = entry.variants[quant_type]
+    try:
+        footprint = read_model_footprint(repo)
+    except (OSError, ValueError, KeyError):
+        footprint = None
+    if footprint:
+        config, weight_bytes = footprint
+        estimate = estimate_fit(config, weight_bytes, available_bytes)
+        return estimate.max_model_len >= min(min_context, estimate.native_max_model_len or min_context)
+    return get_required_bytes(entry.estimated_weight_bytes(quant_type), min_context) <= available_bytes
+
+
+def _normalize_name(name: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+def get_model_family(model: str) -> Optional[str]:
+    """The catalog family of a model: its entry if it is in the catalog, else the longest family in its name."""
+    catalog = load_catalog()
+    for entry in catalog:
+        if model in entry.variants.values() or _normalize_name(entry.name) == _normalize_name(os.path.basename(model)):
+            return entry.family
+    name = _normalize_name(model)
+    families = [entry.family for entry in catalog if entry.family and _normalize_name(entry.family) in name]
+    return max(families, key=len, default=None)
+
+
+def get_model_architecture(model: str) -> Optional[str]:
+    """The architecture of a model from its config.json, None if it is not on disk."""
+    try:
+        footprint = read_model_footprint(model)
+    except (OSError, ValueError, KeyError):
+        return None
+    architectures = footprint[0].get("architectures") if footprint else None
+    return architectures[0] if architectures else None
+
+
+def rank_fallbacks(quant_preference: Optional[str], available_bytes: Optional[int],
+                   min_context: int = MIN_USABLE_CONTEXT, exclude: Iterable[str] = (),
+                   requested_model: Optional[str] = None) -> List[str]:
+    """
+    Rank the catalog variants that fit. The variants of the family of the requested model come first, then the ones
+    of its architecture, then the best model, the preferred quantization first on equal models.
+    :param available_bytes: the VRAM the engine can use, None to skip the fit check
+    :param requested_model: the model the fallback replaces
+    """
+    exclude = set(exclude)
+    family = get_model_family(requested_model) if requested_model else None
+    architecture = get_model_architecture(requested_model) if requested_model else None
+    candidates = []
+    for entry in load_catalog():
+        for quant_type, repo in entry.variants.items():
+            if repo in exclude:
+                continue
+            if available_bytes is not None and not variant_fits(entry, quant_type, available_bytes, min_context):
+                continue
+            rank = (family is not None and entry.family == family,
+                    architecture is not None and entry.architecture == architecture,
+                    entry.quality, entry.params, quant_type == quant_preference)
+            candidates.append((rank, repo))
+    return [repo for _, repo in sorted(candidates, key=lambda candidate: candidate[0], reverse=True)]
+
+
+def get_gguf_quant_rank(file_name: str) -> int:
+    """Position of the quantization of a GGUF file in GGUF_QUANT_RANKING, unknown quantizations go last."""
+    match = _GGUF_QUANT_PATTERN.search(os.path.basename(file_name).upper())
+    return GGUF_QUANT_RANKING.index(match.group(1)) if match else len(GGUF_QUANT_RANKING)
+
+
+def pick_gguf_variant(file_sizes: Dict[str, int], available_bytes: int,
+                      min_context: int = MIN_USABLE_CONTEXT) -> Optional[str]:
+    """
+    Pick the best quantization of a GGUF repo that fits in VRAM with the target context.
+    :param file_sizes: the .gguf files of the repo and their size
+    :return: the file name, or the smallest file if none fits, None if there are no single file variants
+    """
+    # split files (model-00001-of-00002.gguf) are not supported by vllm
+    variants = {name: size for name, size in file_sizes.items()
+                if name.lower().endswith(".gguf") and not re.search(r"-\d{5}-of-\d{5}", name) and size}
+    if not variants:
+        return None
+    ranked = sorted(variants, key=lambda name: (get_gguf_quant_rank(name), -variants[name]))
+    for name in ranked:
+        if get_required_bytes(variants[name], min_context) <= available_bytes:
+            return name
+    return min(variants, key=variants.get)
@@ -1,20 +1,20 @@
-import os
-from typing import Any
+from typing import Any, Iterable, Optional
 
-import yaml
+from app.core.fallback.catalog import rank_fallbacks
+from app.utils.memory.estimator import MIN_USABLE_CONTEXT
 
-file_path = os.path.join(os.path.dirname(__file__), "fallback.yml")
 
-
-def pick_a_quantized_fallback(quant_preference) -> Any:
+def pick_a_quantized_fallback(quant_preference, available_bytes: Optional[int] = None,
+                              min_context: int = MIN_USABLE_CONTEXT, exclude: Iterable[str] = (),
+                              requested_model: Optional[str] = None) -> Any:
     """
-    Pick from a fallback yaml file the name and link for a quantized model
-    :return:
+    Pick from the fallback catalog the best quantized model that fits in the available VRAM
+    :param quant_preference: the preferred quantization type, either GPTQ or AWQ
+    :param available_bytes: the VRAM the engine can use, None to only rank by quality
+    :param min_context: the context length the model must be able to serve
+    :param exclude: repos that were already tried
+    :param requested_model: the model that failed, a fallback of its family and architecture is preferred
+    :return: the repo of the model or None if nothing fits
     """
-    with open(file_path) as file:
-        data = yaml.load(file, Loader=yaml.FullLoader)
-        # check if the quantized_fallback key exists in the yaml file
-        try:
-            return data["model"][quant_preference]
-        except KeyError:
-            return None
+    ranked = rank_fallbacks(quant_preference, available_bytes, min_context, exclude, requested_model)
+    return ranked[0] if ranked else None
@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from app.utils.definitions import FIT_PROFILE_FILE
+from app.utils.log import setup_custom_logger
+from app.utils.memory.cuda_mem import get_gpu_signature
+
+logger = setup_custom_logger(__name__)
+
+PROFILE_PATH = os.path.join(Path(__file__).resolve().parents[2], "configs", FIT_PROFILE_FILE)
+
+# The engine arguments the OOM retry ladder and handle_specific_errors can change
+PROFILED_FIELDS = (
+    "max_model_len",
+    "gpu_memory_utilization",
+    "swap_space",
+    "enable_lora",
+    "max_loras",
+    "max_lora_rank",
+    "limit_mm_per_prompt",
+    "chat_template",
+)
+
+_file_lock = threading.Lock()
+
+
+def get_profile_key(engine_args) -> str:
+    """
+    Key a profile on everything that changes how much memory the engine needs:
+    the model path (which includes the GGUF variant), the GPU and the kv cache dtype.
+    The values asked for the profiled fields are part of the key too, so a profile never overrides a changed config:
+    the new config gets its own profile once it has been fitted.
+    """
+    requested = {name: getattr(engine_args, name, None) for name in PROFILED_FIELDS}
+    return "|".join([
+        str(engine_args.model),
+        str(engine_args.tokenizer or engine_args.model),
+        get_gpu_signature(),
+        str(getattr(engine_args, "kv_cache_dtype", "auto")),
+        json.dumps(requested, sort_keys=True, default=str),
+    ])
+
+
+def _read_profiles() -> dict:
+    try:
+        with open(PROFILE_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (json.JSONDecodeError, OSError) as e:
+        logger.error(f"Engine fit profiles could not be read, ignoring them: {e}")
+        return {}
+
+
+def _write_profiles(profiles: dict) -> None:
+    tmp_path = f"{PROFILE_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmp_path, PROFILE_PATH)
+
+
+def load_fit_profile(engine_args) -> Optional[dict]:
+    """Return the stored engine arguments that last worked for this model on this machine."""
+    with _file_lock:
+        profile = _read_profiles().get(get_profile_key(engine_args))
+    return profile["args"] if profile else None
+
+
+def apply_fit_profile(engine_args, profile: dict) -> None:
+    for name, value in profile.items():
+        if name in PROFILED_FIELDS:
+            setattr(engine_args, name, value)
+
+
+def save_fit_profile(key: str, engine_args) -> None:
+    """Persist the engine arguments of a successful initialization under the key of the original arguments."""
+    args = {name: getattr(engine_args, name, None) for name in PROFILED_FIELDS}
+    try:
+        with _file_lock:
+            profiles = _read_profiles()
+            if profiles.get(key, {}).get("args") == args:
+                return
+            profiles[key] = {"args": args, "updated_at": int(time.time())}
+            _write_profiles(profiles)
+    except (OSError, TypeError) as e:
+        logger.error(f"Could not save the engine fit profile: {e}")
+
+
+def forget_fit_profile(key: str) -> None:
+    """Drop a profile that no longer fits, i.e. because something else is now using the VRAM."""
+    try:
+        with _file_lock:
+            profiles = _read_profiles()
+            if profiles.pop(key, None) is not None:
+                _write_profiles(profiles)
+    except OSError as e:
+        logger.error(f"Could not remove the engine fit profile: {e}")
@@ -0,0 +1,144 @@
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Any
+
+from prometheus_client import Counter, Histogram
+
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+INSTRUMENTED_VLLM_VERSION = "0.6."  # the releases whose private engine methods instrument_vllm_engine wraps
+LOAD_PHASE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+load_phase_seconds = Histogram(
+    "pulsar_engine_load_phase_seconds",
+    "Time spent in each phase of an engine load or swap",
+    ["phase"],
+    buckets=LOAD_PHASE_BUCKETS,
+)
+load_retries_total = Counter(
+    "pulsar_engine_load_retries_total",
+    "Engine initialization attempts that failed and were retried, by cause",
+    ["cause"],
+)
+
+# substrings of the initialization errors, in the order handle_specific_errors checks them
+RETRY_CAUSES = (
+    ("max_num_batched_tokens", "lora"),
+    ("does not support LoRA", "lora"),
+    ("multimodal models", "multimodal"),
+    ("is greater than the derived max_model_len", "max_model_len"),
+    ("The model's max seq len", "max_model_len"),
+    ("Chat template is not defined in the tokenizer", "chat_template"),
+    ("No available memory for the cache blocks", "kv_cache"),
+)
+
+
+class LoadTimings:
+    """Phase durations and retries of a single engine load, returned in the /model/load payload."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.retries: List[Dict[str, Any]] = []
+
+    def add(self, phase: str, seconds: float) -> None:
+        # phases such as the teardown run again on each retry
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def add_retry(self, cause: str, seconds: float) -> None:
+        self.retries.append({"cause": cause, "seconds": round(seconds, 3)})
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "total": round(time.perf_counter() - self.started_at, 3),
+            "phases": {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+            "retries": self.retries,
+        }
+
+
+_current_timings: contextvars.ContextVar[Optional[LoadTimings]] = contextvars.ContextVar(
+    "current_load_timings", default=None)
+
+
+def start_load_timings() -> LoadTimings:
+    """Start collecting the phases of the load running in the current context."""
+    timings = LoadTimings()
+    _current_timings.set(timings)
+    return timings
+
+
+def get_load_timings() -> Optional[LoadTimings]:
+    return _current_timings.get()
+
+
+@contextmanager
+def time_phase(phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        load_phase_seconds.labels(phase=phase).observe(elapsed)
+        timings = _current_timings.get()
+        if timings:
+            timings.add(phase, elapsed)
+
+
+def get_retry_cause(e: Exception) -> str:
+    if e.__class__.__name__ == "OutOfMemoryError":
+        return "oom"
+    for sub_string, cause in RETRY_CAUSES:
+        if sub_string in str(e):
+            return cause
+    return "other"
+
+
+def record_retry(e: Exception, seconds: float) -> None:
+    cause = get_retry_cause(e)
+    load_retries_total.labels(cause=cause).inc()
+    timings = _current_timings.get()
+    if timings:
+        timings.add_retry(cause, seconds)
+
+
+def _timed_method(cls, method_name: str, phase: str) -> None:
+    method = getattr(cls, method_name, None)
+    if method is None or not callable(method):
+        # a vllm release renamed the hook: the phase is not timed, the load itself is untouched
+        logger.warning(f"{cls.__name__}.{method_name} not found in this vllm version, "
+                       f"the {phase} phase will not be timed")
+        return
+    if getattr(method, "_pulsar_phase", None):
+        return
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with time_phase(phase):
+            return method(*args, **kwargs)
+
+    wrapper._pulsar_phase = phase
+    setattr(cls, method_name, wrapper)
+
+
+def instrument_vllm_engine() -> None:
+    """
+    Time the phases that happen inside AsyncLLMEngine.from_engine_args, they run in the caller's thread so the
+    context of the load is preserved (not with ray workers, where only the kv cache phase is timed).
+    The hooks are private vllm methods: each one is checked and skipped with a warning if this version lacks it.
+    """
+    import vllm
+    try:
+        from vllm.engine.llm_engine import LLMEngine
+        from vllm.worker.model_runner import GPUModelRunnerBase
+    except ImportError as e:
+        logger.warning(f"Engine load phases are not timed on vllm {vllm.__version__}: {e}")
+        return
+    if not vllm.__version__.startswith(INSTRUMENTED_VLLM_VERSION):
+        logger.info(f"The load phase timings target vllm {INSTRUMENTED_VLLM_VERSION}, running {vllm.__version__}")
+    _timed_method(LLMEngine, "_init_tokenizer", "tokenizer_load")
+    _timed_method(GPUModelRunnerBase, "load_model", "weight_load")
+    _timed_method(LLMEngine, "_initialize_kv_caches", "kv_cache_allocation")
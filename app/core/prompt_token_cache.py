@@ -0,0 +1,122 @@
+import hashlib
+import sys
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import cachetools
+
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+# cold tokenizations of a template checked against the split one before trusting the split
+VALIDATION_ROUNDS = 2
+
+
+class PromptTokenCache:
+    """
+    Token ids of the rendered prompt of each chat branch, so a new turn only tokenizes what the template added
+    after the previous one.
+
+    An entry holds the prompt of a branch up to its last special token, keyed by the chat, the tip of the branch, the
+    model and the chat template. Tokenizers split the text on special tokens before tokenizing it, so the ids of the prefix
+    plus the ids of the rest match the ids of the whole prompt; the split is still checked on the first prompts of
+    each template (i.e. sentencepiece tokenizers prepend a space to the rest) and disabled for it if it doesn't hold.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._entries: cachetools.LRUCache = cachetools.LRUCache(maxsize=max_bytes, getsizeof=self._entry_size)
+        self._boundaries: Dict[str, Tuple[str, ...]] = {}
+        self._validated: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _entry_size(entry: Tuple[str, array]) -> int:
+        text, token_ids = entry
+        return sys.getsizeof(text) + token_ids.itemsize * len(token_ids)
+
+    @staticmethod
+    def get_template_key(model: str, chat_template: Optional[str], add_special_tokens: bool) -> str:
+        digest = hashlib.sha1((chat_template or "").encode()).hexdigest()[:16]
+        return f"{model}:{digest}:{int(add_special_tokens)}"
+
+    def _get_boundaries(self, template_key: str, tokenizer, chat_template: Optional[str]) -> Tuple[str, ...]:
+        """The special tokens the template writes, the prompt is split after the last one."""
+        if template_key not in self._boundaries:
+            added_tokens = set(getattr(tokenizer, "get_added_vocab", dict)())
+            added_tokens.update(token for token in (getattr(tokenizer, "bos_token", None),
+                                                    getattr(tokenizer, "eos_token", None)) if token)
+            if chat_template:
+                added_tokens = {token for token in added_tokens if token in chat_template}
+            self._boundaries[template_key] = tuple(added_tokens)
+        return self._boundaries[template_key]
+
+    def _store(self, key: Tuple[str, str, str], prefix_text: str, prefix_ids: List[int]) -> None:
+        entry = (prefix_text, array("i", prefix_ids))
+        if self._entry_size(entry) <= self._entries.maxsize:
+            self._entries[key] = entry
+
+    @staticmethod
+    def _split(prompt: str, boundaries: Sequence[str]) -> int:
+        return max((prompt.rfind(token) + len(token) for token in boundaries if token in prompt), default=0)
+
+    def tokenize(self, tokenizer, prompt: str, add_special_tokens: bool, template_key: str,
+                 chat_template: Optional[str], chat_id: Optional[str], branch_ids: Sequence[str]) -> List[int]:
+        """
+        Tokenize the prompt of a branch reusing the tokens of the nearest cached ancestor.
+        :param template_key: the model and the template, from get_template_key
+        :param branch_ids: the messages of the prompt, the root first, the last one is the tip
+        :return: the token ids of the whole prompt
+        """
+        tip_key = (chat_id or "", branch_ids[-1], template_key)
+        validations = self._validated.get(template_key, 0)
+        if validations < 0:
+            return tokenizer(prompt, add_special_tokens=add_special_tokens).input_ids
+
+        boundaries = self._get_boundaries(template_key, tokenizer, chat_template)
+        split_at = self._split(prompt, boundaries)
+        if validations < VALIDATION_ROUNDS:
+            token_ids = tokenizer(prompt, add_special_tokens=add_special_tokens).input_ids
+            if split_at:
+                head = tokenizer(prompt[:split_at], add_special_tokens=add_special_tokens).input_ids
+                tail = tokenizer(prompt[split_at:], add_special_tokens=False).input_ids
+                if head + tail != token_ids:
+                    logger.warning(f"The prompt tokens of {template_key} can't be split on special tokens, "
+                                   f"the prompt token cache is disabled for it")
+                    self._validated[template_key] = -1
+                    return token_ids
+                self._validated[template_key] = validations + 1
+                self._store(tip_key, prompt[:split_at], head)
+            return token_ids
+
+        cached = None
+        for message_id in reversed(branch_ids):
+            entry = self._entries.get((chat_id or "", message_id, template_key))
+            if entry and len(entry[0]) <= split_at and prompt.startswith(entry[0]):
+                cached = entry
+                break
+        if cached:
+            self.hits += 1
+            prefix_text, prefix_ids = cached
+        else:
+            self.misses += 1
+            prefix_text, prefix_ids = "", array("i")
+
+        if prefix_text:
+            head_ids = prefix_ids.tolist()
+            if split_at > len(prefix_text):
+                head_ids += tokenizer(prompt[len(prefix_text):split_at], add_special_tokens=False).input_ids
+        else:
+            head_ids = tokenizer(prompt[:split_at], add_special_tokens=add_special_tokens).input_ids if split_at else []
+        if split_at:
+            self._store(tip_key, prompt[:split_at], head_ids)
+            tail_ids = tokenizer(prompt[split_at:], add_special_tokens=False).input_ids
+        else:
+            tail_ids = tokenizer(prompt, add_special_tokens=add_special_tokens).input_ids
+        return head_ids + tail_ids
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._boundaries.clear()
+        self._validated.clear()
@@ -0,0 +1,187 @@
+import asyncio
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from starlette.datastructures import Headers, State
+from starlette.requests import Request
+from vllm.entrypoints.openai.protocol import ChatCompletionRequest, ChatCompletionResponse, ErrorResponse
+from vllm.utils import random_uuid
+
+from app.core.response_cache import ID_PREFIX, ResponseCache
+from app.core.scheduler import Lane, get_current_lane
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+CoalescingKey = Tuple[str, str, str]
+
+
+class SharedRawRequest:
+    """
+    Stands for the raw requests of all the subscribers of a generation when it is handed to vllm, which polls
+    is_disconnected to abort it: the generation goes on while any subscriber is still connected.
+    """
+
+    def __init__(self, raw_request: Optional[Request]):
+        self.state = raw_request.state if raw_request is not None else State()
+        self.headers = raw_request.headers if raw_request is not None else Headers()
+        self._raw_requests: List[Optional[Request]] = []
+
+    def attach(self, raw_request: Optional[Request]) -> None:
+        self._raw_requests.append(raw_request)
+
+    def detach(self, raw_request: Optional[Request]) -> None:
+        if raw_request in self._raw_requests:
+            self._raw_requests.remove(raw_request)
+
+    async def is_disconnected(self) -> bool:
+        for raw_request in self._raw_requests:
+            # the internal callers have no raw request, they wait until the end
+            if raw_request is None or not await raw_request.is_disconnected():
+                return False
+        return True
+
+
+class InFlightGeneration:
+    """A generation running upstream, its result and, for streams, the chunks sent so far."""
+
+    def __init__(self, raw_request: Optional[Request]):
+        self.raw_request = SharedRawRequest(raw_request)
+        self.result: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None  # why the stream ended early, raised to every subscriber
+        self._changed = asyncio.Event()
+        self.pump: Optional[asyncio.Task] = None
+
+    def publish(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.error = error
+        self.done = True
+        self._changed.set()
+
+    async def subscribe(self, raw_request: Optional[Request], new_id: Optional[str]) -> AsyncGenerator[str, None]:
+        """
+        Stream the chunks of the generation from the first one, the ones sent before the subscription included.
+        If the upstream stream failed, its error is raised once the chunks sent before it are delivered.
+        :param new_id: replaces the id of the completion in the chunks, None to keep it
+        """
+        original_id = None
+        position = 0
+        try:
+            while True:
+                while position < len(self.chunks):
+                    chunk = self.chunks[position]
+                    position += 1
+                    if new_id is not None and chunk.startswith(ID_PREFIX):
+                        original_id = original_id or chunk[len(ID_PREFIX):chunk.index('"', len(ID_PREFIX))]
+                        chunk = chunk.replace(original_id, new_id, 1)
+                    yield chunk
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.raw_request.detach(raw_request)
+
+    async def follow(self, raw_request: Optional[Request]) -> Any:
+        """Attach a duplicate request, it gets the result of the generation with its own id."""
+        self.raw_request.attach(raw_request)
+        try:
+            result = await asyncio.shield(self.result)
+        except BaseException:
+            self.raw_request.detach(raw_request)
+            raise
+        if isinstance(result, ChatCompletionResponse):
+            self.raw_request.detach(raw_request)
+            return result.model_copy(update={"id": f"chat-{random_uuid()}"})
+        if isinstance(result, ErrorResponse):
+            self.raw_request.detach(raw_request)
+            return result
+        return self.subscribe(raw_request, f"chat-{random_uuid()}")
+
+
+class RequestCoalescer:
+    """
+    Registry of the generations in flight, so identical concurrent requests (i.e. a client retrying over a flaky
+    tunnel, several tabs sending the same message) share one upstream generation instead of each running its own.
+
+    Only deterministic requests are coalesced, keyed by the hash of their normalized body, as the response cache does,
+    and by their user. The first request runs the generation, the duplicates that arrive while it runs wait for its
+    result, streams are fanned out to every subscriber from their first chunk. A generation is only aborted once all
+    of its subscribers are gone.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[CoalescingKey, InFlightGeneration] = {}
+        self.coalesced = 0
+
+    @staticmethod
+    def can_coalesce(request: ChatCompletionRequest) -> bool:
+        """
+        Sampled duplicates are meant to get different answers (i.e. the PulsarBoost rollouts, a regeneration), and the
+        loopback requests are sampled on purpose, they always run on their own.
+        """
+        return ResponseCache.is_cacheable(request) and get_current_lane() != Lane.INTERNAL
+
+    @staticmethod
+    def make_key(request: ChatCompletionRequest, chat_template: Optional[str]) -> CoalescingKey:
+        return (*ResponseCache.make_key(request, chat_template), request.user or "")
+
+    async def run(self, key: CoalescingKey, raw_request: Optional[Request],
+                  generate: Callable[[SharedRawRequest], Awaitable[Any]]) -> Any:
+        """
+        Run a generation, or attach to the identical one in flight.
+        :param generate: starts the generation, given the raw request to hand to vllm
+        :return: the result of the generation, a stream of it for streaming requests
+        """
+        generation = self._in_flight.get(key)
+        if generation is not None:
+            self.coalesced += 1
+            logger.info(f"Attaching a duplicate request to the generation in flight for {key[0]}")
+            return await generation.follow(raw_request)
+
+        generation = self._in_flight[key] = InFlightGeneration(raw_request)
+        generation.raw_request.attach(raw_request)
+        try:
+            result = await generate(generation.raw_request)
+        except BaseException as e:
+            self._release(key, generation)
+            if isinstance(e, Exception):
+                generation.result.set_exception(e)
+                generation.result.exception()  # retrieved, the duplicates may be none
+            else:
+                generation.result.cancel()
+            raise
+        generation.result.set_result(result)
+
+        if isinstance(result, (ChatCompletionResponse, ErrorResponse)):
+            self._release(key, generation)
+            generation.raw_request.detach(raw_request)
+            return result
+        generation.pump = asyncio.create_task(self._pump(key, generation, result))
+        return generation.subscribe(raw_request, None)
+
+    def _release(self, key: CoalescingKey, generation: InFlightGeneration) -> None:
+        if self._in_flight.get(key) is generation:
+            del self._in_flight[key]
+
+    async def _pump(self, key: CoalescingKey, generation: InFlightGeneration,
+                    stream: AsyncGenerator[str, None]) -> None:
+        error = None
+        try:
+            async for chunk in stream:
+                generation.publish(chunk)
+        except Exception as e:
+            logger.error(f"Error while streaming a shared generation of {key[0]}: {e}")
+            error = e
+        except asyncio.CancelledError:
+            error = RuntimeError("The shared generation was cancelled")
+            raise
+        finally:
+            self._release(key, generation)
+            generation.finish(error)
@@ -0,0 +1,115 @@
+import hashlib
+import json
+from typing import Any, AsyncGenerator, Callable, List, Optional, Tuple, Union
+
+import cachetools
+from vllm.entrypoints.openai.protocol import ChatCompletionRequest, ChatCompletionResponse, ErrorResponse
+from vllm.utils import random_uuid
+
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+SSE_DONE = "data: [DONE]\n\n"
+ID_PREFIX = 'data: {"id":"'
+# request fields that don't change the generated text, the Pulsar chat fields are only used to build the messages
+IGNORED_FIELDS = {"user", "chat_id", "personality_id", "system_prompt", "is_regeneration",
+                  "selected_messages_version_ids", "pulsar_boost", "num_rollouts", "max_depth",
+                  "chat_history_cutoff_percentage", "disable_semantic_cache"}
+# set on the messages of a Pulsar chat to rebuild the branch
+MESSAGE_METADATA_FIELDS = {"id", "version", "parent_message_id", "token_count"}
+
+CacheKey = Tuple[str, str]
+
+
+class ResponseCache:
+    """
+    Exact match cache of the deterministic chat completions (temperature 0 or a fixed seed).
+
+    Requests are keyed by a hash of their canonical JSON together with the served model or LoRA and the chat
+    template. Full responses are stored as they are, streams as the SSE chunks vLLM produced and are replayed as
+    a stream with a new id, so the clients can't tell a replay from a generation. The cache is bounded in bytes and
+    entries expire after a TTL; it lives on the serving instance so a model swap drops it, LoRA changes drop the
+    entries of the LoRA.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self._entries: cachetools.TTLCache = cachetools.TTLCache(maxsize=max_bytes, ttl=ttl,
+                                                                 getsizeof=self._entry_size)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _entry_size(entry: Union[ChatCompletionResponse, Tuple[str, List[str]]]) -> int:
+        if isinstance(entry, tuple):
+            return sum(len(chunk) for chunk in entry[1])
+        return len(entry.model_dump_json())
+
+    @staticmethod
+    def is_cacheable(request: ChatCompletionRequest) -> bool:
+        return request.temperature == 0 or request.seed is not None
+
+    @staticmethod
+    def make_key(request: ChatCompletionRequest, chat_template: Optional[str]) -> CacheKey:
+        values = request.model_dump(mode="json", exclude=IGNORED_FIELDS)
+        values["messages"] = [{key: value for key, value in message.items() if key not in MESSAGE_METADATA_FIELDS}
+                              if isinstance(message, dict) else message for message in values["messages"]]
+        values["chat_template"] = request.chat_template or chat_template
+        canonical = json.dumps(values, sort_keys=True, separators=(",", ":"), default=str)
+        return request.model, hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _store(self, key: CacheKey, entry: Union[ChatCompletionResponse, Tuple[str, List[str]]],
+               on_store: Optional[Callable[[], None]] = None) -> None:
+        if self._entry_size(entry) <= self._entries.maxsize:
+            self._entries[key] = entry
+            if on_store is not None:
+                on_store()
+
+    def get(self, key: CacheKey) -> Optional[Union[ChatCompletionResponse, AsyncGenerator[str, None]]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if isinstance(entry, tuple):
+            return self._replay_stream(*entry)
+        return entry.model_copy(update={"id": f"chat-{random_uuid()}"})
+
+    @staticmethod
+    async def _replay_stream(original_id: str, chunks: List[str]) -> AsyncGenerator[str, None]:
+        new_id = f"chat-{random_uuid()}"
+        for chunk in chunks:
+            yield chunk.replace(original_id, new_id, 1) if chunk.startswith(ID_PREFIX) else chunk
+
+    async def _capture_stream(self, key: CacheKey, generator: AsyncGenerator[str, None],
+                              on_store: Optional[Callable[[], None]]) -> AsyncGenerator[str, None]:
+        chunks = []
+        completed = False
+        async for chunk in generator:
+            chunks.append(chunk)
+            yield chunk
+            completed = chunk == SSE_DONE
+        # vllm reports the errors inside the stream, those and the interrupted streams are not stored
+        if completed and len(chunks) > 1 and all(chunk.startswith(ID_PREFIX) for chunk in chunks[:-1]):
+            original_id = chunks[0][len(ID_PREFIX):chunks[0].index('"', len(ID_PREFIX))]
+            self._store(key, (original_id, chunks), on_store)
+
+    def capture(self, key: CacheKey, result: Any, on_store: Optional[Callable[[], None]] = None) -> Any:
+        """
+        Store the result of a generation, streams are stored once they are completely sent.
+        :param on_store: called once the result is stored
+        """
+        if isinstance(result, ErrorResponse):
+            return result
+        if isinstance(result, ChatCompletionResponse):
+            self._store(key, result, on_store)
+            return result
+        return self._capture_stream(key, result, on_store)
+
+    def clear(self, model: Optional[str] = None) -> None:
+        """Drop the entries of a model or LoRA, all of them if None."""
+        if model is None:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries.keys() if key[0] == model]:
+            self._entries.pop(key, None)
@@ -0,0 +1,197 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import AsyncGenerator, Callable, Dict, List, Optional, Tuple
+
+from app.core.admission import AdmissionRejected, MAX_RETRY_AFTER
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+DEFAULT_USER = "anonymous"
+MAX_FINISH_TAGS = 4096  # users remembered per lane before the idle ones are forgotten
+INITIAL_TURN_SECONDS = 10.0  # expected length of a generation before one is measured
+
+
+class Lane(IntEnum):
+    """Traffic classes, served in this order. The values match the vllm priorities (lower is served first)."""
+    INTERACTIVE = 0  # the chats of the users
+    INTERNAL = 1  # loopback calls made while serving a user, i.e. PulsarBoost rollouts
+    BACKGROUND = 2  # titles, personality generation and batch jobs
+
+
+_current_lane: ContextVar[Lane] = ContextVar("scheduling_lane", default=Lane.INTERACTIVE)
+_current_user: ContextVar[Optional[str]] = ContextVar("scheduling_user", default=None)
+
+
+@contextmanager
+def scheduling_context(lane: Lane, user: Optional[str] = None):
+    """Schedule the generations started inside the block in a lane, on behalf of a user if given."""
+    lane_token = _current_lane.set(lane)
+    user_token = _current_user.set(user) if user is not None else None
+    try:
+        yield
+    finally:
+        _current_lane.reset(lane_token)
+        if user_token is not None:
+            _current_user.reset(user_token)
+
+
+def get_current_lane() -> Lane:
+    return _current_lane.get()
+
+
+def get_current_user(default: Optional[str] = None) -> str:
+    return _current_user.get() or default or DEFAULT_USER
+
+
+@dataclass
+class Turn:
+    """A generation admitted into the engine."""
+    demand: int
+    started: float
+
+
+QueueEntry = Tuple[float, int, asyncio.Future, int]
+
+
+class FairScheduler:
+    """
+    Admission of the generations into an engine, by lane and then by weighted fair queuing across users.
+
+    At most max_running generations are handed to the engine at once, as vllm serves what it is given first come,
+    first served, and only while their estimated KV cache demand fits the capacity of the engine. The others wait
+    here: a lane is only served once the lanes before it are empty, and within a lane each request gets a start tag
+    (start-time fair queuing) so a user sending many requests at once, i.e. a 16-rollout boost, is interleaved with
+    the others instead of holding the engine until they all finish. When the queue is full or a turn takes too long,
+    interactive requests are rejected with an estimate of when to retry instead of piling up latency.
+    """
+
+    def __init__(self, max_running: int, capacity: int = 0, max_waiting: int = 0, max_wait: Optional[float] = None,
+                 is_saturated: Optional[Callable[[], bool]] = None, weights: Optional[Dict[str, float]] = None):
+        """
+        :param capacity: the KV cache tokens the admitted generations may hold together, 0 for no limit
+        :param max_waiting: interactive requests are rejected when this many requests wait, 0 for no limit
+        :param max_wait: seconds an interactive request waits for its turn before being rejected, None for no limit
+        :param is_saturated: tells if the engine is already full, whatever the estimates say
+        """
+        self.max_running = max_running
+        self.capacity = capacity
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.is_saturated = is_saturated
+        self.weights: Dict[str, float] = dict(weights or {})
+        self.running = 0
+        self.outstanding = 0  # estimated KV cache tokens of the running generations
+        self._turn_seconds = INITIAL_TURN_SECONDS
+        self._queues: Dict[Lane, List[QueueEntry]] = {lane: [] for lane in Lane}
+        self._virtual_time: Dict[Lane, float] = {lane: 0.0 for lane in Lane}
+        self._finish_tags: Dict[Lane, Dict[str, float]] = {lane: {} for lane in Lane}
+        self._sequence = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(not entry[2].done() for queue in self._queues.values() for entry in queue)
+
+    def set_weight(self, user: str, weight: float) -> None:
+        self.weights[user] = weight
+
+    def _start_tag(self, lane: Lane, user: str, cost: float) -> float:
+        finish_tags = self._finish_tags[lane]
+        start = max(self._virtual_time[lane], finish_tags.get(user, 0.0))
+        finish_tags[user] = start + cost / self.weights.get(user, 1.0)
+        if len(finish_tags) > MAX_FINISH_TAGS:
+            self._finish_tags[lane] = {key: tag for key, tag in finish_tags.items()
+                                       if tag > self._virtual_time[lane]}
+        return start
+
+    def _fits(self, demand: int) -> bool:
+        if self.running == 0:
+            return True  # a request bigger than the cache still gets the engine alone
+        if self.running >= self.max_running or (self.capacity and self.outstanding + demand > self.capacity):
+            return False
+        return self.is_saturated is None or not self.is_saturated()
+
+    def _position(self, lane: Lane, entry: QueueEntry) -> int:
+        ahead = sum(not other[2].done() for other_lane in Lane if other_lane < lane
+                    for other in self._queues[other_lane])
+        return ahead + sum(not other[2].done() and other[:2] < entry[:2] for other in self._queues[lane]) + 1
+
+    def retry_after(self, position: int) -> int:
+        """Seconds until a request at this position of the queue would likely get its turn."""
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(position * self._turn_seconds / max(self.running, 1))))
+
+    async def acquire(self, lane: Lane, user: str, cost: float = 1.0, demand: int = 0) -> Turn:
+        """
+        Wait for the turn of a generation, release() must be called once it is over.
+        Only the interactive requests are rejected when the queue is full or too slow, the server's own requests
+        always wait.
+        :param cost: the share of the engine the generation takes, i.e. its number of sequences
+        :param demand: the KV cache tokens the generation is expected to hold
+        :return: the turn to release
+        :raise AdmissionRejected: if an interactive request can't be admitted
+        """
+        rejectable = lane == Lane.INTERACTIVE
+        if rejectable and self.max_waiting and self.waiting >= self.max_waiting and not self._fits(demand):
+            position = self.waiting + 1
+            raise AdmissionRejected(position, self.retry_after(position))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (self._start_tag(lane, user, cost), next(self._sequence), future, demand)
+        heapq.heappush(self._queues[lane], entry)
+        self._dispatch()
+        try:
+            if rejectable and self.max_wait is not None:
+                await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+            else:
+                await future
+        except asyncio.TimeoutError:
+            if not future.done():
+                position = self._position(lane, entry)
+                future.cancel()  # skipped when it comes up
+                logger.warning(f"Rejecting a request that waited {self.max_wait}s at position {position}")
+                raise AdmissionRejected(position, self.retry_after(position))
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(future.result())  # the turn came with the cancellation
+            else:
+                future.cancel()  # skipped when it comes up
+            raise
+        return future.result()
+
+    def release(self, turn: Turn) -> None:
+        self.running -= 1
+        self.outstanding -= turn.demand
+        # moving average of the length of the generations, for the Retry-After estimates
+        self._turn_seconds = 0.9 * self._turn_seconds + 0.1 * (time.monotonic() - turn.started)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        for lane in Lane:
+            queue = self._queues[lane]
+            while queue:
+                start, _, future, demand = queue[0]
+                if future.done():
+                    heapq.heappop(queue)
+                    continue
+                if not self._fits(demand):
+                    return  # the lanes after wait too, so a big request isn't overtaken forever
+                heapq.heappop(queue)
+                self._virtual_time[lane] = max(self._virtual_time[lane], start)
+                self.running += 1
+                self.outstanding += demand
+                future.set_result(Turn(demand, time.monotonic()))
+
+    async def release_after(self, turn: Turn, stream: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+        """Hold the turn of a streamed generation until its stream ends."""
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            self.release(turn)
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import re
+import zlib
+from typing import Any, NamedTuple, Optional, Tuple
+
+import cachetools
+import numpy as np
+from vllm.utils import random_uuid
+
+from app.core.response_cache import CacheKey, ResponseCache
+from app.hijacks.protocols.extended_oai import ExtendedChatCompletionRequest
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+EMBEDDING_DIM = 1024
+NGRAM_SIZE = 3
+MAX_QUERY_CHARS = 256  # longer turns are rarely repeated, they are not worth the lookup
+MAX_CONTEXT_MESSAGES = 3  # messages after the system prompt, up to the second user turn
+MAX_SCOPES = 4096
+MAX_SCOPE_ENTRIES = 64
+# the embedding is lexical, a turn differing only by one of these would look the same: they must match exactly
+NEGATIONS = {"no", "not", "none", "never", "nor", "neither", "without", "nothing", "nobody", "nowhere", "cannot"}
+SAMPLING_FIELDS = ("temperature", "top_p", "top_k", "min_p", "seed", "stop", "presence_penalty", "frequency_penalty",
+                   "repetition_penalty")
+
+Scope = Tuple[str, str, str, bool, str]
+
+
+class SemanticQuery(NamedTuple):
+    scope: Scope
+    embedding: np.ndarray
+
+
+def embed(text: str) -> np.ndarray:
+    """
+    Embed a short text as the normalized counts of its hashed character n-grams, cheap enough to run on the event
+    loop and close for texts that only differ in case, punctuation or a few characters.
+    :param text: the text of a user turn
+    :return: a unit vector of EMBEDDING_DIM floats, zero for a text without words
+    """
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    padded = f" {' '.join(words)} "
+    grams = [padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)]
+    buckets = np.fromiter((zlib.crc32(gram.encode()) % EMBEDDING_DIM for gram in grams), dtype=np.int64,
+                          count=len(grams))
+    vector = np.bincount(buckets, minlength=EMBEDDING_DIM).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def literals(text: str) -> Tuple[str, ...]:
+    """The numbers and the negations of a text in order, two turns only match if they have the same."""
+    tokens = re.findall(r"\d+(?:[.,]\d+)*|[^\W\d]+(?:'t)?", text.lower().replace("\u2019", "'"))
+    return tuple(token for token in tokens if token[0].isdigit() or token in NEGATIONS or token.endswith("n't"))
+
+
+class SemanticCache:
+    """
+    Near-duplicate cache of the short Pulsar chat turns (i.e. "hello", "what can you do?").
+
+    An answer is served again when the last user turn is similar enough to a stored one asked in the same scope: the
+    user, the personality, the model and a fingerprint of the rest of the conversation (system prompt, previous turns,
+    generation limits and sampling), so nothing is ever shared between users and a turn only matches within the same
+    context. The similarity is lexical, so the numbers and negations of the turn are part of the fingerprint: "37
+    degrees" never matches "39 degrees", nor "with" "without". Only the first turns of a chat of deterministic
+    requests (temperature 0 or a seed) are looked up, a sampled answer is never replayed, and the requests can opt out
+    with disable_semantic_cache.
+    The answers are kept in a ResponseCache, the embeddings of a scope are searched with a single matrix product.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, threshold: float):
+        self.threshold = threshold
+        self._responses = ResponseCache(max_bytes, ttl)
+        self._scopes: cachetools.LRUCache = cachetools.LRUCache(maxsize=MAX_SCOPES)
+
+    @staticmethod
+    def _last_user_text(message: Any) -> Optional[str]:
+        if not isinstance(message, dict) or message.get("role") != "user":
+            return None
+        content = message.get("content")
+        return content if isinstance(content, str) and len(content) <= MAX_QUERY_CHARS else None
+
+    def make_query(self, request: Any, chat_template: Optional[str]) -> Optional[SemanticQuery]:
+        """
+        Build the lookup of a request.
+        :return: the query, None if the request is not eligible
+        """
+        if (not isinstance(request, ExtendedChatCompletionRequest) or request.disable_semantic_cache
+                or not ResponseCache.is_cacheable(request) or not request.user or request.is_regeneration
+                or (request.n or 1) != 1 or request.tools
+                or request.logprobs or not request.messages):
+            return None
+        text = self._last_user_text(request.messages[-1])
+        context = request.messages[:-1]
+        if text is None or not all(isinstance(message, dict) for message in context):
+            return None
+        system = [message for message in context if message.get("role") == "system"]
+        if len(context) - len(system) >= MAX_CONTEXT_MESSAGES:
+            return None
+
+        fingerprint = json.dumps({
+            "messages": [(message.get("role"), message.get("content")) for message in context],
+            "chat_template": request.chat_template or chat_template,
+            "max_tokens": request.max_tokens,
+            "response_format": request.response_format.model_dump() if request.response_format else None,
+            "sampling": {field: getattr(request, field, None) for field in SAMPLING_FIELDS},
+            "literals": literals(text),
+        }, sort_keys=True, default=str)
+        scope = (request.model, request.user, request.personality_id or "", bool(request.stream),
+                 hashlib.sha256(fingerprint.encode()).hexdigest())
+        return SemanticQuery(scope, embed(text))
+
+    def get(self, query: SemanticQuery) -> Optional[Any]:
+        """Serve the answer of the most similar stored turn of the scope, if above the threshold."""
+        index = self._scopes.get(query.scope)
+        if index is None or not query.embedding.any():
+            return None
+        embeddings, keys = index
+        similarities = embeddings @ query.embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        cached = self._responses.get(keys[best])
+        if cached is None:  # expired or evicted
+            self._remove(query.scope, best)
+        return cached
+
+    def _remove(self, scope: Scope, position: int) -> None:
+        embeddings, keys = self._scopes[scope]
+        if len(keys) == 1:
+            del self._scopes[scope]
+        else:
+            self._scopes[scope] = (np.delete(embeddings, position, axis=0), keys[:position] + keys[position + 1:])
+
+    def _add(self, query: SemanticQuery, key: CacheKey) -> None:
+        embeddings, keys = self._scopes.get(query.scope, (np.empty((0, EMBEDDING_DIM), dtype=np.float32), []))
+        embeddings = np.vstack([embeddings, query.embedding])[-MAX_SCOPE_ENTRIES:]
+        self._scopes[query.scope] = (embeddings, (keys + [key])[-MAX_SCOPE_ENTRIES:])
+
+    def capture(self, query: SemanticQuery, result: Any) -> Any:
+        """Store the result of a generation, the turn is searchable once its answer is stored."""
+        if not query.embedding.any():
+            return result
+        key: CacheKey = (query.scope[0], f"{query.scope[-1]}:{random_uuid()}")
+        return self._responses.capture(key, result, on_store=lambda: self._add(query, key))
+
+    def clear(self, model: Optional[str] = None) -> None:
+        """Drop the entries of a model or LoRA, all of them if None."""
+        self._responses.clear(model)
+        if model is None:
+            self._scopes.clear()
+            return
+        for scope in [scope for scope in self._scopes.keys() if scope[0] == model]:
+            self._scopes.pop(scope, None)
@@ -0,0 +1,178 @@
+import asyncio
+import json
+from typing import AsyncGenerator, AsyncIterator, List, Optional, Union
+
+from starlette.requests import Request
+
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+SSE_PREFIX = "data: "
+SLOW_WRITE_MS = 10.0  # a write taking longer than this means the client or the tunnel is pushing back
+MAX_WINDOW_FACTOR = 8.0  # the flush window grows at most this much for a slow connection
+WRITE_LATENCY_SMOOTHING = 0.2
+MERGEABLE_DELTA_FIELDS = {"role", "content"}
+LOOPBACK_HOSTS = {"127.0.0.1", "::1", "localhost"}
+
+
+def _merge_deltas(first: str, second: str) -> Optional[str]:
+    """
+    Merge two SSE chunks of the same completion into one, only when they carry nothing but the text of a single
+    choice: role changes, tool calls, logprobs and usage are kept as they are.
+    :return: the merged chunk, None if they can't be merged
+    """
+    if not (first.startswith(SSE_PREFIX + "{") and second.startswith(SSE_PREFIX + "{")):
+        return None
+    try:
+        data, next_data = json.loads(first[len(SSE_PREFIX):]), json.loads(second[len(SSE_PREFIX):])
+    except ValueError:
+        return None
+    if data.get("id") != next_data.get("id") or data.get("usage") or next_data.get("usage"):
+        return None
+    choices, next_choices = data.get("choices") or [], next_data.get("choices") or []
+    if len(choices) != 1 or len(next_choices) != 1:
+        return None
+    choice, next_choice = choices[0], next_choices[0]
+    delta, next_delta = choice.get("delta") or {}, next_choice.get("delta") or {}
+    if (choice.get("index") != next_choice.get("index") or choice.get("finish_reason")
+            or choice.get("logprobs") or next_choice.get("logprobs")
+            or not set(delta) <= MERGEABLE_DELTA_FIELDS or not set(next_delta) <= {"content"}):
+        return None
+    delta["content"] = (delta.get("content") or "") + (next_delta.get("content") or "")
+    choice["delta"] = delta
+    for field in ("finish_reason", "stop_reason"):
+        if field in next_choice:
+            choice[field] = next_choice[field]
+    # vllm writes compact JSON with the id first, the id is spliced by prefix downstream
+    return f"{SSE_PREFIX}{json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def merge_chunks(chunks: List[str]) -> List[str]:
+    """Merge the consecutive text deltas of a list of SSE chunks."""
+    merged = []
+    for chunk in chunks:
+        combined = _merge_deltas(merged[-1], chunk) if merged else None
+        if combined is None:
+            merged.append(chunk)
+        else:
+            merged[-1] = combined
+    return merged
+
+
+class StreamShaper:
+    """
+    Coalesces the SSE chunks of a stream into fewer, bigger writes, for the clients behind a tunnel where every
+    write costs a packet and a round trip.
+
+    The first chunk is sent as soon as it arrives, so the time to first token is untouched. The next pending chunks are
+    flushed together once flush_tokens of them are waiting or flush_ms went by since the first one, whichever comes
+    first. The write latency of the connection is measured on every flush: when the client or the
+    tunnel pushes back, the window grows up to MAX_WINDOW_FACTOR times. The pending chunks are bounded, once
+    max_pending are waiting the text deltas are merged and, if that is not enough, the upstream waits for the client.
+    One shaper is made per connection.
+    """
+
+    def __init__(self, flush_tokens: int, flush_ms: float, max_pending: int):
+        self.flush_tokens = max(flush_tokens, 1)
+        self.flush_ms = flush_ms
+        self.max_pending = max(max_pending, 2)
+        self.write_latency_ms = 0.0
+
+    @property
+    def window_factor(self) -> float:
+        return min(MAX_WINDOW_FACTOR, max(1.0, self.write_latency_ms / SLOW_WRITE_MS))
+
+    def _observe_write(self, seconds: float) -> None:
+        self.write_latency_ms += WRITE_LATENCY_SMOOTHING * (seconds * 1000 - self.write_latency_ms)
+
+    async def shape(self, stream: AsyncIterator[Union[str, bytes]]) -> AsyncGenerator[str, None]:
+        loop = asyncio.get_running_loop()
+        pending: List[str] = []
+        arrived = asyncio.Event()
+        drained = asyncio.Event()
+        finished = False
+        error: Optional[BaseException] = None
+
+        async def produce() -> None:
+            nonlocal finished, error
+            try:
+                async for chunk in stream:
+                    pending.append(chunk.decode() if isinstance(chunk, bytes) else chunk)
+                    if len(pending) >= self.max_pending:
+                        pending[:] = merge_chunks(pending)
+                        while len(pending) >= self.max_pending:
+                            drained.clear()
+                            await drained.wait()  # the client is behind, hold the upstream
+                    arrived.set()
+            except Exception as e:
+                error = e
+            finally:
+                finished = True
+                arrived.set()
+
+        producer = asyncio.create_task(produce())
+        first = True
+        try:
+            while True:
+                if not pending and not finished:
+                    arrived.clear()
+                    await arrived.wait()
+                factor = self.window_factor
+                deadline = loop.time() + self.flush_ms * factor / 1000
+                while not first and not finished and len(pending) < self.flush_tokens * factor:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    arrived.clear()
+                    try:
+                        await asyncio.wait_for(arrived.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                first = False
+                if pending:
+                    batch = "".join(pending)
+                    pending.clear()
+                    drained.set()
+                    started = loop.time()
+                    yield batch
+                    self._observe_write(loop.time() - started)
+                if finished and not pending:
+                    break
+        finally:
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+            if hasattr(stream, "aclose"):
+                # closed now, not when collected, so what it holds (i.e. its scheduler turn) is released on disconnect
+                await stream.aclose()
+        if error is not None:
+            raise error
+
+
+def is_direct_local_client(raw_request: Optional[Request]) -> bool:
+    """
+    Whether a request comes from this machine and not through a tunnel: the tunnels connect from localhost too, but
+    they keep the public host name of the request and add forwarding headers.
+    """
+    if raw_request is None or raw_request.client is None or raw_request.client.host not in LOOPBACK_HOSTS:
+        return False
+    if "x-forwarded-for" in raw_request.headers or "forwarded" in raw_request.headers:
+        return False
+    return raw_request.url.hostname in LOOPBACK_HOSTS
+
+
+def shape_stream(stream: AsyncIterator[Union[str, bytes]],
+                 raw_request: Optional[Request] = None) -> AsyncIterator[Union[str, bytes]]:
+    """
+    Shape an SSE stream with the settings of the engine, returned as is if stream shaping is disabled or the client is
+    on this machine, where writes are cheap and coalescing would only add latency.
+    """
+    from app.core.engine import async_engine_args
+    if async_engine_args is None or not async_engine_args.stream_flush_ms or is_direct_local_client(raw_request):
+        return stream
+    shaper = StreamShaper(async_engine_args.stream_flush_tokens, async_engine_args.stream_flush_ms,
+                          async_engine_args.stream_max_pending)
+    return shaper.shape(stream)
@@ -0,0 +1,167 @@
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Optional
+
+from app.core.load_metrics import start_load_timings, time_phase
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+DRAIN_POLL_INTERVAL = 0.05  # seconds
+
+_admitted: ContextVar[bool] = ContextVar("swap_admitted", default=False)
+
+
+class SwapCoordinator:
+    """
+    Serializes model swaps and keeps the server answering while they happen.
+
+    While a swap runs, the middleware holds new requests in a bounded queue instead of rejecting them, in-flight
+    generations get up to `drain_timeout` seconds to finish before they are aborted, and concurrent swaps to the same
+    target share a single engine reload. Held requests are replayed on the new engine once the swap is over.
+    A generation is in flight from the moment the serving chat admits it, before it reaches the engine (history
+    fitting, tokenization, waiting for its turn in the scheduler), until its response is complete.
+    """
+
+    def __init__(self, drain_timeout: float = 30.0, queue_size: int = 64):
+        self.drain_timeout = drain_timeout
+        self.queue_size = queue_size
+        self.held_requests = 0
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._lock = asyncio.Lock()
+        self._swaps: Dict[str, asyncio.Future] = {}
+
+    def configure(self, drain_timeout: Optional[float], queue_size: Optional[int]) -> None:
+        if drain_timeout is not None:
+            self.drain_timeout = drain_timeout
+        if queue_size is not None:
+            self.queue_size = queue_size
+
+    @property
+    def swapping(self) -> bool:
+        return not self._idle.is_set()
+
+    async def hold(self, bounded: bool = True) -> bool:
+        """
+        Wait for the running swap to end.
+        :param bounded: False for the server's own producers (titles, batches), they always wait
+        :return: False if the queue is full and the request should be rejected
+        """
+        if bounded and self.held_requests >= self.queue_size:
+            return False
+        self.held_requests += 1
+        try:
+            await self._idle.wait()
+        finally:
+            self.held_requests -= 1
+        return True
+
+    async def admitted(self, generate: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run a generation counted in flight until its response is complete, waiting for the running swap first.
+        The calls nested in an admitted one are counted once.
+        :param generate: starts the generation, called once the swap is over
+        :return: the result of generate, streams are counted until they end
+        """
+        if _admitted.get():
+            return await generate()
+        while self.swapping:
+            await self._idle.wait()
+        self.in_flight += 1
+        self._drained.clear()
+        token = _admitted.set(True)
+        try:
+            result = await generate()
+        except BaseException:
+            self._leave()
+            raise
+        finally:
+            _admitted.reset(token)
+        if hasattr(result, "__aiter__"):
+            return self._leave_after(result)
+        self._leave()
+        return result
+
+    def _leave(self) -> None:
+        self.in_flight -= 1
+        if not self.in_flight:
+            self._drained.set()
+
+    async def _leave_after(self, stream: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            self._leave()
+
+    async def drain(self) -> None:
+        """Wait for the admitted generations to finish, aborting whatever is left when the deadline is hit."""
+        from app.core.engine import async_engine
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.drain_timeout
+        try:
+            await asyncio.wait_for(self._drained.wait(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.in_flight} admitted requests did not finish within {self.drain_timeout}s")
+        if not async_engine:
+            return
+        # the requests sent to the engine without going through the serving chat
+        while async_engine.engine.has_unfinished_requests():  # noqa
+            if loop.time() >= deadline:
+                logger.warning(f"In-flight requests did not finish within {self.drain_timeout}s, aborting them")
+                await self._abort_all(async_engine)
+                return
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+
+    @staticmethod
+    async def _abort_all(engine) -> None:
+        try:
+            request_ids = list(engine._request_tracker._request_streams)  # noqa
+        except AttributeError:
+            return
+        for request_id in request_ids:
+            await engine.abort(request_id)
+
+    @asynccontextmanager
+    async def serialized(self):
+        """Run a block one at a time with the swaps but without stopping admissions, i.e. to load a side engine."""
+        async with self._lock:
+            yield
+
+    async def swap(self, target: str, swap_fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run swap_fn with admissions stopped and the engine drained. A call for a target that is already being
+        swapped to joins the running swap and gets its result (or its exception).
+        """
+        if target in self._swaps:
+            logger.info(f"A swap to {target} is already running, joining it")
+            return await asyncio.shield(self._swaps[target])
+
+        task = asyncio.ensure_future(self._run(target, swap_fn))
+        self._swaps[target] = task
+        task.add_done_callback(lambda _: self._swaps.pop(target, None))
+        return await asyncio.shield(task)
+
+    async def _run(self, target: str, swap_fn: Callable[[], Awaitable[Any]]) -> Any:
+        async with self._lock:
+            from app.core.engine import async_engine_args
+            if async_engine_args:
+                self.configure(async_engine_args.swap_drain_timeout, async_engine_args.swap_queue_size)
+            self._idle.clear()
+            start_load_timings()
+            try:
+                with time_phase("drain"):
+                    await self.drain()
+                return await swap_fn()
+            finally:
+                self._idle.set()
+                if self.held_requests:
+                    logger.info(f"Swap to {target} done, replaying {self.held_requests} held requests")
+
+
+swap_coordinator = SwapCoordinator()
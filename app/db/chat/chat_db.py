@@ -1,11 +1,15 @@
 import json
 import uuid
 from collections import defaultdict
+from itertools import groupby
 from typing import List, Optional, Union
 
-from sqlalchemy import select, and_
+from sqlalchemy import select, and_, or_, literal
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
+from .chat_tree_cache import chat_tree_cache
+from .message_writer import message_writer
 from ..model.chat import Chat, Message
 from ..model.personality import Personality
 from ...utils.definitions import ALLOWED_MESSAGE_FIELDS
@@ -32,6 +36,57 @@ async def _get_chat_history(db: AsyncSession, chat_id: str, up_to_message_id: st
     return result.scalars().all()
 
 
+async def _get_message_branch(db: AsyncSession, chat_id: str, up_to_message_id: Optional[str] = None,
+                              message_ids: Optional[List[str]] = None) -> List[tuple]:
+    """
+    Fetch the branch ending at up_to_message_id (the latest message if None) walking parent_message_id with a
+    recursive CTE, so only the messages of the branch are read whatever the number of regenerations in the chat.
+    The versions of a message share its parent, so the path doesn't depend on the selected versions. When
+    message_ids are given, at each depth with more than one version the one listed in message_ids replaces the one
+    on the path, or the first version if none is listed, as unpack_messages does.
+    :return: (id, content, version, parent_message_id, token_count) of each message, the root first
+    """
+    if up_to_message_id is None:
+        up_to_message_id = select(Message.id).where(Message.chat_id == chat_id).order_by(
+            Message.timestamp.desc()).limit(1).scalar_subquery()
+
+    branch = select(
+        Message.id, Message.parent_message_id, literal(0).label("depth")
+    ).where(and_(Message.chat_id == chat_id, Message.id == up_to_message_id)).cte("branch", recursive=True)
+    parent = aliased(Message)
+    branch = branch.union_all(
+        select(parent.id, parent.parent_message_id, branch.c.depth + 1)
+        .where(and_(parent.chat_id == chat_id, parent.id == branch.c.parent_message_id))
+    )
+
+    on_path = aliased(Message)
+    query = select(
+        branch.c.depth, on_path.id, on_path.content, on_path.version, on_path.parent_message_id, on_path.token_count
+    ).join(on_path, on_path.id == branch.c.id)
+    if message_ids:
+        # every version at each depth, the message on the path included; the root versions have a NULL parent
+        version = aliased(Message)
+        query = query.add_columns(version.id, version.content, version.version, version.token_count).join(
+            version, and_(version.chat_id == chat_id,
+                          or_(version.parent_message_id == branch.c.parent_message_id,
+                              and_(version.parent_message_id.is_(None), branch.c.parent_message_id.is_(None))))
+        ).order_by(branch.c.depth.desc(), version.timestamp)
+    else:
+        query = query.order_by(branch.c.depth.desc())
+
+    selected_ids = set(message_ids or [])
+    rows = []
+    for _, group in groupby((await db.execute(query)).all(), key=lambda row: row[0]):
+        group = list(group)
+        _, msg_id, content, version, parent_id, token_count = group[0][:6]
+        versions = [row[6:] for row in group] if message_ids else []
+        if len(versions) > 1:
+            msg_id, content, version, token_count = next(
+                (row for row in versions if row[0] in selected_ids), versions[0])
+        rows.append((msg_id, content, version, parent_id, token_count))
+    return rows
+
+
 async def async_unpack_chat_history(
         db: AsyncSession,
         chat: Union[Chat, str],
@@ -40,12 +95,33 @@ async def async_unpack_chat_history(
         personality: Optional[Personality] = None,
         full_history: bool = False
 ) -> List[dict]:
-    # Get the chat history
     chat_id = chat.id if isinstance(chat, Chat) else chat
-    messages = await _get_chat_history(db, chat_id, up_to_message_id)
-
-    # Unpack the messages
-    return unpack_messages(messages, personality, message_ids, full_history)
+    if full_history:
+        await message_writer.flush(chat_id)
+        # every version of every message, the clients rebuild the tree themselves
+        messages = await _get_chat_history(db, chat_id, up_to_message_id)
+        return unpack_messages(messages, personality, message_ids, full_history)
+
+    branch = chat_tree_cache.get(chat_id, up_to_message_id, message_ids)
+    if branch is None:
+        await message_writer.flush(chat_id)
+        rows = await _get_message_branch(db, chat_id, up_to_message_id, message_ids)
+        branch = [unpack_message(*row) for row in rows if isinstance(row[1], dict)]
+        if up_to_message_id is not None:
+            chat_tree_cache.put(chat_id, branch, message_ids)
+    return filter_system_prompts(branch, personality)
+
+
+def write_messages(chat_id: str, *messages: dict) -> None:
+    """
+    Queue the messages of a turn for writing and append them to the cached branch of the chat, in order.
+    :param messages: the values of each message: id, parent_message_id, model_id, content and token_count
+    """
+    for message in messages:
+        row = message_writer.add_message(chat_id=chat_id, **message)
+        if isinstance(row['content'], dict):
+            chat_tree_cache.append(chat_id, unpack_message(row['id'], row['content'], 1, row['parent_message_id'],
+                                                           row['token_count']))
 
 
 async def validate_uuid(uuid_id: str):
@@ -128,3 +204,23 @@ def unpack_messages(messages: List[Message], personality: Optional[Personality],
         return get_message_chain(last_message.id)
     else:
         return []
+
+
+def unpack_message(message_id: str, content: dict, version: int, parent_message_id: Optional[str],
+                   token_count: Optional[int] = None) -> dict:
+    unpacked_msg = content.copy()
+    unpacked_msg['id'] = message_id
+    unpacked_msg['version'] = version
+    unpacked_msg['parent_message_id'] = parent_message_id
+    unpacked_msg['token_count'] = token_count
+    if 'content' in unpacked_msg:
+        unpacked_msg['content'] = unpack_multimodal_content(unpacked_msg['content'])
+    return unpacked_msg
+
+
+def filter_system_prompts(messages: List[dict], personality: Optional[Personality]) -> List[dict]:
+    """In personality chats only the root system prompt, the personality one, is kept."""
+    if not personality:
+        return messages
+    return [message for message in messages
+            if message.get('role') != "system" or message['parent_message_id'] is None]
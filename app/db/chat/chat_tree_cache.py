@@ -0,0 +1,72 @@
+from dataclasses import dataclass, field
+from typing import FrozenSet, Iterable, List, Optional
+
+import cachetools
+
+CHAT_TREE_CACHE_SIZE = 256  # chats
+
+
+@dataclass
+class CachedBranch:
+    """The unpacked messages of the branch last used to prompt a chat, the root first."""
+    messages: List[dict]
+    selected_ids: FrozenSet[str] = field(default_factory=frozenset)
+
+    @property
+    def tip(self) -> Optional[str]:
+        return self.messages[-1]['id'] if self.messages else None
+
+
+class ChatTreeCache:
+    """
+    Bounded LRU of the parsed branch of the active chats, so follow-up turns build the prompt without reading
+    and re-parsing the history: the messages written by a turn are appended to the branch they continue and
+    anything else (a regeneration, a version switch, a deleted chat) drops the chat, which is read again with the
+    recursive query on the next turn.
+    """
+
+    def __init__(self, maxsize: int = CHAT_TREE_CACHE_SIZE):
+        self._branches: cachetools.LRUCache = cachetools.LRUCache(maxsize=maxsize)
+
+    def get(self, chat_id: str, up_to_message_id: Optional[str],
+            message_ids: Optional[Iterable[str]]) -> Optional[List[dict]]:
+        """The branch ending at up_to_message_id with the given versions selected, None if it isn't cached."""
+        branch: Optional[CachedBranch] = self._branches.get(chat_id)
+        if branch is None or up_to_message_id is None or branch.tip != up_to_message_id:
+            return None
+        if branch.selected_ids != frozenset(message_ids or ()):
+            return None
+        # the callers own the returned messages
+        return [message.copy() for message in branch.messages]
+
+    def put(self, chat_id: str, messages: List[dict], message_ids: Optional[Iterable[str]]) -> None:
+        self._branches[chat_id] = CachedBranch([message.copy() for message in messages],
+                                               frozenset(message_ids or ()))
+
+    def append(self, chat_id: str, message: dict) -> None:
+        """Extend the cached branch of a chat with a message that was just written."""
+        if message.get('parent_message_id') is None:
+            # the system prompt of a new chat
+            self._branches[chat_id] = CachedBranch([message.copy()])
+            return
+        branch: Optional[CachedBranch] = self._branches.get(chat_id)
+        if branch is None:
+            return
+        on_branch = {cached['id'] for cached in branch.messages}
+        # a selected version outside of the branch could be a sibling of the new message and replace it
+        if branch.tip != message['parent_message_id'] or not branch.selected_ids <= on_branch:
+            self.invalidate(chat_id)
+            return
+        branch.messages.append(message.copy())
+
+    def invalidate(self, chat_id: str) -> None:
+        self._branches.pop(chat_id, None)
+
+    def clear(self) -> None:
+        self._branches.clear()
+
+    def __len__(self) -> int:
+        return len(self._branches)
+
+
+chat_tree_cache = ChatTreeCache()
@@ -0,0 +1,191 @@
+import asyncio
+import json
+import os
+from collections import Counter
+from itertools import groupby
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+
+from .chat_tree_cache import chat_tree_cache
+from ..model.base import utc_now
+from ..model.chat import Chat, Message
+from ...utils.definitions import FAILED_CHAT_WRITES_FILE
+from ...utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+FLUSH_INTERVAL = 0.5  # seconds
+MAX_BATCH_SIZE = 256  # writes, a flush starts as soon as this many are pending
+MAX_WRITE_ATTEMPTS = 5  # flushes a write is tried in before it is set aside
+
+# executemany needs the same keys on every row
+MESSAGE_FIELDS = ("id", "chat_id", "parent_message_id", "model_id", "content", "token_count", "timestamp")
+CHAT_FIELDS = ("id", "user_id", "model_id", "timestamp")
+
+
+class MessageWriter:
+    """
+    Write-behind queue of the chat writes, so the streaming requests don't wait for the database.
+
+    The writes are applied in order in one transaction per flush, consecutive inserts of the same table with a single
+    executemany. The readers of a chat call flush(chat_id) before reading it, so they always see their own writes,
+    and the queue is flushed on shutdown and before a restart. A write that fails (i.e. the database is locked) is
+    queued again for the next flush; the ones that can never succeed or keep failing are appended to
+    FAILED_CHAT_WRITES_FILE instead of being lost.
+    """
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL, max_batch_size: int = MAX_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self._pending: List[Tuple[str, Dict[str, Any]]] = []
+        self._attempts: Dict[int, int] = {}  # failed attempts by id() of the values of a pending write
+        self.failed_writes = 0
+        self._pending_chats: Counter = Counter()
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def _enqueue(self, kind: str, values: Dict[str, Any]) -> None:
+        self._pending.append((kind, values))
+        self._pending_chats[values["chat_id"] if kind == "message" else values["id"]] += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        if len(self._pending) >= self.max_batch_size:
+            self._wakeup.set()
+
+    def add_chat(self, **values) -> None:
+        values.setdefault("timestamp", utc_now())
+        self._enqueue("chat", {field: values.get(field) for field in CHAT_FIELDS})
+
+    def add_message(self, **values) -> Dict[str, Any]:
+        """
+        Queue a message insert. The timestamp is taken now, with the clock of the column default: the rows of a batch
+        are inserted in one transaction, where the database's now() would give them all the same time.
+        """
+        values.setdefault("timestamp", utc_now())
+        row = {field: values.get(field) for field in MESSAGE_FIELDS}
+        self._enqueue("message", row)
+        return row
+
+    def update_chat(self, chat_id: str, **values) -> None:
+        self._enqueue("chat_update", {"id": chat_id, **values})
+
+    def is_pending(self, chat_id: str) -> bool:
+        return self._pending_chats[chat_id] > 0
+
+    async def flush(self, chat_id: Optional[str] = None) -> None:
+        """Write the pending writes, only if some belong to chat_id when given."""
+        if chat_id is not None and not self.is_pending(chat_id):
+            return
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            if batch:
+                await self._write(batch)
+
+    async def _write(self, batch: List[Tuple[str, Dict[str, Any]]]) -> None:
+        from app.db.db_setup import SessionLocal
+        try:
+            async with SessionLocal() as session:
+                async with session.begin():
+                    for kind, writes in groupby(batch, key=lambda write: write[0]):
+                        await self._apply(session, kind, [values for _, values in writes])
+        except Exception as e:
+            logger.error(f"Batched chat write failed, retrying the {len(batch)} writes one by one: {e}")
+            retries = await self._write_one_by_one(batch)
+        else:
+            retries = []
+            for _, values in batch:
+                self._attempts.pop(id(values), None)
+        finally:
+            for kind, values in batch:
+                self._pending_chats[values["chat_id"] if kind == "message" else values["id"]] -= 1
+            self._pending_chats += Counter()  # drop the chats without pending writes
+        if retries:
+            # before the writes queued since, so the rows keep their order
+            self._pending[:0] = retries
+            for kind, values in retries:
+                self._pending_chats[values["chat_id"] if kind == "message" else values["id"]] += 1
+
+    async def _write_one_by_one(self, batch: List[Tuple[str, Dict[str, Any]]]) -> List[Tuple[str, Dict[str, Any]]]:
+        """:return: the writes to try again on the next flush"""
+        from app.db.db_setup import SessionLocal
+        retries = []
+        for kind, values in batch:
+            try:
+                async with SessionLocal() as session:
+                    async with session.begin():
+                        await self._apply(session, kind, [values])
+                self._attempts.pop(id(values), None)
+                continue
+            except IntegrityError as e:
+                error = e  # a duplicate or a missing parent, it would fail again
+            except Exception as e:
+                attempts = self._attempts[id(values)] = self._attempts.get(id(values), 0) + 1
+                if attempts < MAX_WRITE_ATTEMPTS:
+                    logger.warning(f"Could not write a {kind}, attempt {attempts} of {MAX_WRITE_ATTEMPTS}: {e}")
+                    retries.append((kind, values))
+                    continue
+                error = e
+            self._attempts.pop(id(values), None)
+            self._set_aside([(kind, values)], error)
+        return retries
+
+    def _set_aside(self, writes: List[Tuple[str, Dict[str, Any]]], error: Exception) -> None:
+        """Report writes that could not be applied, keeping them in FAILED_CHAT_WRITES_FILE to be recovered."""
+        self.failed_writes += len(writes)
+        for kind, values in writes:
+            chat_id = values["chat_id"] if kind == "message" else values["id"]
+            logger.error(f"Could not write a {kind} of chat {chat_id}, saved it in {FAILED_CHAT_WRITES_FILE}: {error}")
+            chat_tree_cache.invalidate(chat_id)
+        try:
+            os.makedirs(os.path.dirname(FAILED_CHAT_WRITES_FILE), exist_ok=True)
+            with open(FAILED_CHAT_WRITES_FILE, "a") as f:
+                for kind, values in writes:
+                    f.write(json.dumps({"kind": kind, "values": values, "error": str(error)}, default=str) + "\n")
+        except OSError as e:
+            logger.error(f"Could not save {len(writes)} failed chat writes, they are lost: {e}")
+
+    @staticmethod
+    async def _apply(session, kind: str, rows: List[Dict[str, Any]]) -> None:
+        if kind == "chat":
+            await session.execute(insert(Chat), rows)
+        elif kind == "message":
+            await session.execute(insert(Message), rows)
+        else:
+            for values in rows:
+                await session.execute(update(Chat).where(Chat.id == values["id"]).values(
+                    **{key: value for key, value in values.items() if key != "id"}))
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error while flushing the chat writes: {e}")
+
+    async def close(self) -> None:
+        """Stop the background flushes and write what is left."""
+        task, self._task = self._task, None
+        if task is not None:
+            # not while it is writing, a cancelled write would lose its batch
+            async with self._lock:
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self._pending:  # failed again, there is no next flush
+            batch, self._pending = self._pending, []
+            self._set_aside(batch, RuntimeError("the server stopped before the write succeeded"))
+            self._pending_chats.clear()
+
+
+message_writer = MessageWriter()
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import secrets
 import string
@@ -145,13 +146,15 @@ async def ensure_default_token(session):
         await session.commit()
 
 
-async def init_db():
+async def init_db(scan_models: bool = True):
     try:
-        run_migrations(DATABASE_URL.replace("+asyncpg", ""),
-                       os.path.join(os.path.dirname(__file__), "migration", "alembic.ini"))
+        # alembic is synchronous, keep the event loop free for the other startup stages
+        await asyncio.to_thread(run_migrations, DATABASE_URL.replace("+asyncpg", ""),
+                                os.path.join(os.path.dirname(__file__), "migration", "alembic.ini"))
         async with engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
-        await post_creation_task()
+        if scan_models:
+            await post_creation_task()
         async with SessionLocal() as session:
             await ensure_default_token(session)
     except Exception as e:
@@ -10,15 +10,20 @@ from starlette.responses import JSONResponse
 from vllm.usage.usage_lib import UsageContext
 
 from app.core.engine import initialize_engine, create_serving_instances
+from app.core.engine_pool import engine_pool
+from app.core.fallback.catalog import pick_gguf_variant
+from app.core.swap import swap_coordinator
 from app.db.auth.auth_db import get_user
 from app.db.db_common import get_entity
 from app.db.model.auth import User
 from app.db.model.ml_model import Model
 from app.hijacks.vllm import ExtendedAsyncCompleteServerArgs
-from app.middlewares.model_loader_block import set_block_requests
 from app.utils.database.images import save_image
 from app.utils.log import setup_custom_logger
-from app.utils.models.hf_downloader import download_model_async, check_file_in_huggingface_repo
+from app.utils.memory.cuda_mem import get_engine_cuda_memory
+from app.utils.memory.estimator import MIN_USABLE_CONTEXT
+from app.utils.memory.weight_cache import weight_cache
+from app.utils.models.hf_downloader import download_model_async, check_file_in_huggingface_repo, get_repo_file_sizes
 from app.utils.models.list_model import list_models_paths_in_hf_cache, format_repo_name_to_hf
 from app.utils.formatting.pydantic.privacy import PrivacyOptions
 from app.utils.models.model_paths import get_hf_path
@@ -119,6 +124,33 @@ async def change_model_id_and_owner(db: AsyncSession, model_local_id: str, model
     await db.commit()
 
 
+async def pick_file_variant(model_url: str) -> Optional[str]:
+    """
+    Pick the best quantization of a GGUF repo that fits in VRAM, so a download without a variant does not fetch
+    every file of the repo.
+
+    Args:
+        model_url (str): The URL of the model.
+
+    Returns:
+        Optional[str]: The file name of the variant, or None if the repo is not a GGUF one.
+    """
+    from app.core.engine import async_engine_args
+    try:
+        file_sizes = await asyncio.to_thread(get_repo_file_sizes, model_url)
+    except Exception as e:
+        logger.error(f"Could not list the files of {model_url}: {e}")
+        return None
+    if any(file_name.endswith(".safetensors") for file_name in file_sizes):
+        return None
+    available_memory = get_engine_cuda_memory(async_engine_args)
+    file_variant = pick_gguf_variant(file_sizes, available_memory,
+                                     min_context=async_engine_args.max_model_len or MIN_USABLE_CONTEXT)
+    if file_variant:
+        logger.info(f"No variant given for {model_url}, picked {file_variant}")
+    return file_variant
+
+
 async def download_model_api_(
         model_id: str,
         model_name: str,
@@ -155,6 +187,8 @@ async def download_model_api_(
     Returns:
         Optional[Union[JSONResponse, HTTPException]]: A success message or an HTTP error.
     """
+    if not file_variant:
+        file_variant = await pick_file_variant(model_url)
     model_in_db = await get_model(db, model_url)
     image_filename = await save_image(current_user, image)
 
@@ -320,7 +354,8 @@ async def generate_entry_for_db(
     Returns:
         Model: The newly created model object.
     """
-    from app.core.engine import (openai_serving_chat, delete_engine_model_from_vram, async_engine_args)
+    from app.core.engine import delete_engine_model_from_vram, async_engine_args
+    previous_model = async_engine_args.model
     # create a restoration server configuration
     server_conf = ExtendedAsyncCompleteServerArgs.from_yaml("last.yml")
     server_conf.gpu_memory_utilization = async_engine_args.gpu_memory_utilization
@@ -340,25 +375,30 @@ async def generate_entry_for_db(
                       working=False, users=[current_user],
                       description=str(e))
     # try to load the new model, if it fails reload the previous model
-    try:
-        set_block_requests(True)
-        while openai_serving_chat.engine_client.engine.has_unfinished_requests():  # noqa
-            await asyncio.sleep(0.1)
-
-        delete_engine_model_from_vram()
-        server_conf.model = model_url
-        server_conf.tokenizer = model_url
-        server_conf.served_model_name = [model_url]
-        await initialize_engine(server_conf.get_async_eng_args(), UsageContext.OPENAI_API_SERVER)
-        create_serving_instances(server_conf.served_model_name, server_conf)
-
-        server_conf.save_to_yaml()
+    async def swap_engine() -> None:
+        from app.api.open_ai import load_serving_entrypoints
+        try:
+            # the model is about to become the main one, don't keep it loaded twice
+            await engine_pool.unload(model_url)
+            delete_engine_model_from_vram()
+            server_conf.model = model_url
+            server_conf.tokenizer = model_url
+            server_conf.served_model_name = [model_url]
+            engine_pool.fit_main_engine(server_conf)
+            await initialize_engine(server_conf.get_async_eng_args(), UsageContext.OPENAI_API_SERVER)
+            create_serving_instances(server_conf.served_model_name, server_conf)
+            load_serving_entrypoints()
+
+            server_conf.save_to_yaml()
+            weight_cache.prefetch(previous_model)
+        except Exception:
+            background_tasks.add_task(restart(server_conf, True))
+            raise
 
+    try:
+        await swap_coordinator.swap(model_url, swap_engine)
     except Exception as e:
-        background_tasks.add_task(restart(server_conf, True))
         raise HTTPException(status_code=500, detail="Model loading had failed, restarting server, " + str(e))
-    finally:
-        set_block_requests(False)
     return model
 
 
@@ -1,8 +1,18 @@
+import datetime
+
 from sqlalchemy import Table, Column, String, ForeignKey
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
 
+
+def utc_now() -> datetime.datetime:
+    """
+    The clock of the timestamp columns, naive UTC: the column defaults and the rows queued by the message writer
+    use it alike, so the order of the timestamps is the order of the writes.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
 # Many-to-Many between User and X
 user_lora_association = Table('user_lora_association', Base.metadata,
                               Column('user_id', String, ForeignKey('users.id'), primary_key=True),
@@ -1,9 +1,9 @@
 
 from sqlalchemy import Column, Integer, String
-from sqlalchemy import ForeignKey, JSON, DateTime, func
+from sqlalchemy import ForeignKey, JSON, DateTime
 from sqlalchemy.orm import relationship
 
-from app.db.model.base import Base
+from app.db.model.base import Base, utc_now
 
 
 class Message(Base):
@@ -13,11 +13,12 @@ class Message(Base):
     user_id = Column(String, ForeignKey('users.id'))
     model_id = Column(String, ForeignKey('models.name'))
     lora_id = Column(String, ForeignKey('loras.name'), nullable=True)
-    chat_id = Column(String, ForeignKey('chats.id'), nullable=True)
+    chat_id = Column(String, ForeignKey('chats.id'), nullable=True, index=True)
     completion_id = Column(String, ForeignKey('completions.id'), nullable=True)
-    timestamp = Column(DateTime, default=func.now())
+    timestamp = Column(DateTime, default=utc_now)
     version = Column(Integer, default=1)
-    parent_message_id = Column(String, ForeignKey('messages.id'), nullable=True)
+    parent_message_id = Column(String, ForeignKey('messages.id'), nullable=True, index=True)
+    token_count = Column(Integer, nullable=True)  # with the tokenizer of the model that was loaded when written
 
     # Relationships
     chat = relationship("Chat", back_populates="messages")
@@ -31,7 +32,7 @@ class Chat(Base):
     __tablename__ = "chats"
     id = Column(String, primary_key=True, unique=True, index=True)
     summary = Column(String, nullable=True)
-    timestamp = Column(DateTime, onupdate=func.now(), nullable=True)
+    timestamp = Column(DateTime, onupdate=utc_now, nullable=True)
 
     user_id = Column(String, ForeignKey('users.id'))
     model_id = Column(String, ForeignKey('models.name'))
@@ -2,11 +2,22 @@ import uuid
 from typing import Union, AsyncGenerator, Optional
 
 from starlette.requests import Request
-from vllm.entrypoints.openai.protocol import ErrorResponse, ChatCompletionResponse
+from vllm.entrypoints.openai.protocol import ErrorResponse, ChatCompletionResponse, ChatCompletionRequest
 from vllm.entrypoints.openai.serving_chat import OpenAIServingChat
+from vllm.entrypoints.openai.serving_engine import AnyRequest, TextTokensPrompt
+from vllm.transformers_utils.tokenizer import AnyTokenizer
 
+from app.core.admission import estimate_demand
+from app.core.prompt_token_cache import PromptTokenCache
+from app.core.request_coalescer import RequestCoalescer
+from app.core.response_cache import ResponseCache
+from app.core.scheduler import FairScheduler, get_current_lane, get_current_user
+from app.core.semantic_cache import SemanticCache
+from app.core.swap import swap_coordinator
 from app.hijacks.protocols.extended_oai import ExtendedChatCompletionRequest
 from app.utils.formatting.chat.formatter import extract_parameter_from_request
+from app.utils.formatting.chat.history_budget import (count_content_tokens, fit_history_to_budget,
+                                                      MESSAGE_OVERHEAD_TOKENS)
 from app.utils.log import setup_custom_logger
 from app.services.logic_booster.pulsar_boost import PulsarBoost
 
@@ -14,19 +25,176 @@ logger = setup_custom_logger(__name__)
 
 
 class ExtendedOpenAIServingChat(OpenAIServingChat):
-    def __init__(self, api_url, *args, **kwargs):
+    def __init__(self, api_url, *args, prompt_token_cache_mb: int = 128, response_cache_mb: int = 64,
+                 response_cache_ttl: float = 600.0, semantic_cache_mb: int = 0, semantic_cache_threshold: float = 0.97,
+                 enable_request_coalescing: bool = True, scheduler_max_running: int = 0,
+                 use_engine_priority: bool = False, admission_capacity: int = 0, admission_max_waiting: int = 0,
+                 admission_max_wait: Optional[float] = None, is_engine_saturated=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.pulsar_boost_solver = PulsarBoost(api_url, self.model_config.model)
+        self.prompt_token_cache = PromptTokenCache(prompt_token_cache_mb * 1024 ** 2) \
+            if prompt_token_cache_mb else None
+        self.response_cache = ResponseCache(response_cache_mb * 1024 ** 2, response_cache_ttl) \
+            if response_cache_mb else None
+        self.semantic_cache = SemanticCache(semantic_cache_mb * 1024 ** 2, response_cache_ttl,
+                                            semantic_cache_threshold) if semantic_cache_mb else None
+        self.request_coalescer = RequestCoalescer() if enable_request_coalescing else None
+        self.scheduler = FairScheduler(scheduler_max_running, capacity=admission_capacity,
+                                       max_waiting=admission_max_waiting, max_wait=admission_max_wait,
+                                       is_saturated=is_engine_saturated) if scheduler_max_running else None
+        self.use_engine_priority = use_engine_priority
+        self.retired = False  # set once a model swap replaced this instance
+
+    @property
+    def current(self) -> "ExtendedOpenAIServingChat":
+        """The instance serving in place of this one, itself unless a model swap retired it."""
+        if not self.retired:
+            return self
+        from app.core.engine import openai_serving_chat
+        return openai_serving_chat
+
+    async def create_chat_completion(
+            self,
+            request: ChatCompletionRequest,
+            raw_request: Optional[Request] = None,
+    ) -> Union[AsyncGenerator[str, None], ChatCompletionResponse, ErrorResponse]:
+        """
+        Admit the request for the model swaps, which drain it before unloading the engine. A request admitted once
+        a swap is over is served by the new instance.
+        """
+        return await swap_coordinator.admitted(
+            lambda: self.current.create_coalesced_chat_completion(request, raw_request))
+
+    async def create_coalesced_chat_completion(
+            self,
+            request: ChatCompletionRequest,
+            raw_request: Optional[Request] = None,
+    ) -> Union[AsyncGenerator[str, None], ChatCompletionResponse, ErrorResponse]:
+        """Attach the duplicates of a deterministic request in flight to its generation, so they don't run again."""
+        if self.request_coalescer is None or not self.request_coalescer.can_coalesce(request):
+            return await self.create_cached_chat_completion(request, raw_request)
+        key = self.request_coalescer.make_key(request, self.chat_template)
+        return await self.request_coalescer.run(
+            key, raw_request, lambda shared_request: self.create_cached_chat_completion(request, shared_request))
+
+    async def create_cached_chat_completion(
+            self,
+            request: ChatCompletionRequest,
+            raw_request: Optional[Request] = None,
+    ) -> Union[AsyncGenerator[str, None], ChatCompletionResponse, ErrorResponse]:
+        """
+        Serve the deterministic requests from the response cache and the short Pulsar turns from the semantic cache,
+        storing them on a miss.
+        """
+        key = None
+        if self.response_cache is not None and self.response_cache.is_cacheable(request):
+            key = self.response_cache.make_key(request, self.chat_template)
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                return cached
+        query = self.semantic_cache.make_query(request, self.chat_template) if self.semantic_cache else None
+        if query is not None:
+            cached = self.semantic_cache.get(query)
+            if cached is not None:
+                return cached
+
+        result = await self.schedule_chat_completion(request, raw_request)
+        if key is not None:
+            result = self.response_cache.capture(key, result)
+        if query is not None:
+            result = self.semantic_cache.capture(query, result)
+        return result
+
+    async def schedule_chat_completion(
+            self,
+            request: ChatCompletionRequest,
+            raw_request: Optional[Request] = None,
+    ) -> Union[AsyncGenerator[str, None], ChatCompletionResponse, ErrorResponse]:
+        """
+        Hand the request to the engine once the fair scheduler gives it its turn, in the lane and on behalf of the
+        user of the current scheduling context. The turn is held until the response is complete.
+        :raise AdmissionRejected: if the engine is full and the request can't wait
+        """
+        lane = get_current_lane()
+        if self.use_engine_priority and 'priority' in ChatCompletionRequest.model_fields:
+            request.priority = int(lane)
+        if self.scheduler is None:
+            return await super().create_chat_completion(request, raw_request)
+
+        turn = await self.scheduler.acquire(lane, get_current_user(request.user), cost=request.n or 1,
+                                            demand=estimate_demand(request, self.max_model_len))
+        try:
+            result = await super().create_chat_completion(request, raw_request)
+        except BaseException:
+            self.scheduler.release(turn)
+            raise
+        if isinstance(result, (ChatCompletionResponse, ErrorResponse)):
+            self.scheduler.release(turn)
+            return result
+        return self.scheduler.release_after(turn, result)
+
+    def _normalize_prompt_text_to_input(
+            self,
+            request: AnyRequest,
+            tokenizer: AnyTokenizer,
+            prompt: str,
+            truncate_prompt_tokens: Optional[int],
+            add_special_tokens: bool,
+    ) -> TextTokensPrompt:
+        """Tokenize the prompts of the Pulsar chats incrementally, the messages carry the ids of their branch."""
+        branch_ids = [message.get('id') for message in getattr(request, 'messages', None) or []
+                      if isinstance(message, dict)]
+        if (self.prompt_token_cache is None or truncate_prompt_tokens is not None
+                or not isinstance(request, ExtendedChatCompletionRequest) or not branch_ids or not all(branch_ids)):
+            return super()._normalize_prompt_text_to_input(request, tokenizer, prompt, truncate_prompt_tokens,
+                                                           add_special_tokens)
+        chat_template = request.chat_template or self.chat_template
+        template_key = self.prompt_token_cache.get_template_key(request.model, chat_template, add_special_tokens)
+        input_ids = self.prompt_token_cache.tokenize(tokenizer, prompt, add_special_tokens, template_key,
+                                                     chat_template, request.chat_id, branch_ids)
+        return self._validate_input(request, input_ids, prompt)
 
     async def create_pulsar_chat_completion(
             self,
             request: ExtendedChatCompletionRequest,
             raw_request: Optional[Request] = None,
     ) -> Union[AsyncGenerator[str, None], ChatCompletionResponse, ErrorResponse]:
-        request.truncate_prompt_tokens = int(
-            float(request.chat_history_cutoff_percentage / 100)
-            * self.max_model_len ) # this set the "history" if the user does not set it himself
-        return await super().create_chat_completion(request, raw_request)
+        async def generate():
+            serving_chat = self.current
+            request.messages = await serving_chat.fit_history(request)
+            return await serving_chat.create_chat_completion(request, raw_request)
+
+        # admitted before the history is fitted, a swap must not unload the tokenizer under it
+        return await swap_coordinator.admitted(generate)
+
+    async def fit_history(self, request: ExtendedChatCompletionRequest) -> list:
+        """
+        Drop the oldest turns of the history that don't fit the prompt budget, using the token counts stored with the
+        messages, messages without one (i.e. written before they were stored) are tokenized here.
+        The budget is the context left to the completion, capped by chat_history_cutoff_percentage if set.
+        """
+        budget = self.max_model_len - (request.max_tokens or 0)
+        if request.chat_history_cutoff_percentage:
+            budget = min(budget, int(request.chat_history_cutoff_percentage / 100 * self.max_model_len))
+        messages = [message for message in request.messages if isinstance(message, dict)]
+        if len(messages) != len(request.messages):
+            return request.messages
+
+        tokenizer = None
+        if any(message.get('token_count') is None for message in messages):
+            try:
+                lora_request, _ = self._maybe_get_adapters(request)
+            except ValueError:
+                return request.messages  # unknown model, create_chat_completion reports it
+            tokenizer = await self.engine_client.get_tokenizer(lora_request)
+
+        def count(message: dict) -> int:
+            token_count = message.get('token_count')
+            if token_count is None:
+                token_count = message['token_count'] = count_content_tokens(tokenizer, message.get('content'))
+            return token_count + MESSAGE_OVERHEAD_TOKENS
+
+        return fit_history_to_budget(messages, budget, count)
 
     async def stream_chat_completion_with_rstar(
             self,
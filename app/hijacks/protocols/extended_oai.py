@@ -16,6 +16,11 @@ ChatCompletionMessageParam = Union[
 ]
 
 
+class ChatBatchRequest(BaseModel):
+    requests: List[ChatCompletionRequest]
+    max_concurrency: Optional[int] = None
+
+
 class ExtendedChatCompletionRequest(ChatCompletionRequest):
     messages: List[ChatCompletionMessageParam]
     personality_id: Optional[str] = None
@@ -26,6 +31,7 @@ class ExtendedChatCompletionRequest(ChatCompletionRequest):
     chat_history_cutoff_percentage: Optional[float] = None
     max_depth: Optional[int] = None
     is_regeneration: Optional[bool] = None
+    disable_semantic_cache: Optional[bool] = None
 
     class Config:
         extra = "allow"
@@ -61,6 +67,7 @@ class ExtendedChatCompletionRequest(ChatCompletionRequest):
                 msg_dict.pop('id', None)
                 msg_dict.pop('version', None)
                 msg_dict.pop('parent_message_id', None)
+                msg_dict.pop('token_count', None)
                 converted_messages.append(msg_dict)
             else:
                 # If it's already in a format accepted by ChatCompletionRequest, use it as is
@@ -1,41 +1,75 @@
 import json
 import asyncio
+from typing import AsyncGenerator
+
 from starlette.responses import StreamingResponse
 from starlette.types import Send
-from app.db.model.chat import Message
+from app.core.stream_shaper import shape_stream
+from app.db.chat.chat_db import write_messages
+from app.utils.formatting.chat.history_budget import count_message_tokens
 from app.utils.log import setup_custom_logger
 
 logger = setup_custom_logger(__name__)
 
+SSE_PREFIX = "data: "
+SSE_DONE = "[DONE]"
+ID_PREFIX = '{"id":'
+
+
 class WrappedStreamingResponse(StreamingResponse):
-    def __init__(self, content, db_session, chat, response_id, parent_message_id, model_id, *args,
-                 **kwargs):
-        self.db_session = db_session
+    def __init__(self, content, chat, response_id, parent_message_id, model_id, *args, raw_request=None, **kwargs):
+        """:param raw_request: the request being answered, the stream is not shaped for the clients of this machine"""
         self.chat = chat
+        self.raw_request = raw_request
         self.response_id = response_id
         self.parent_id = parent_message_id
         self.model_id = model_id
-        self.accumulated_content = ""
+        self._content_parts = []
+        self._id_field = f'{ID_PREFIX}{json.dumps(response_id)},"chat_id":{json.dumps(chat.id)}'
         super().__init__(content, *args, **kwargs)
 
-    def substitute_id(self, chunk):
-        if not isinstance(chunk, str):
-            return chunk
-        parts = chunk.split("data: ")
-        if len(parts) < 2:
+    @property
+    def accumulated_content(self) -> str:
+        return "".join(self._content_parts)
+
+    def relay_chunk(self, chunk: str) -> str:
+        """
+        Set the response and chat id of an SSE chunk and collect its content, parsing the JSON only once.
+        vllm serializes the id as the first field, so it is spliced in place instead of re-serializing the chunk.
+        """
+        if not chunk.startswith(SSE_PREFIX):
             return chunk
-        json_part = parts[1]
-        if json_part.strip() == "[DONE]":
+        payload = chunk[len(SSE_PREFIX):].rstrip()
+        if payload == SSE_DONE:
             return chunk
         try:
-            data = json.loads(json_part)
-            data['chat_id'] = self.chat.id
-            data['id'] = self.response_id
-            updated_json_string = json.dumps(data)
-            return f"data: {updated_json_string}\n\n"
+            data = json.loads(payload)
         except json.JSONDecodeError:
+            logger.error(f"Error parsing JSON content: {payload}")
+            return chunk
+        if not isinstance(data, dict):
             return chunk
 
+        if 'INTERNAL-' not in payload:  # This is done in order to not log the internal process state
+            choices = data.get('choices')
+            if choices:
+                content = choices[0].get('delta', {}).get('content')
+                if content:
+                    self._content_parts.append(content)
+
+        original_id = f"{ID_PREFIX}{json.dumps(data.get('id'))}"
+        if payload.startswith(original_id):
+            return f"{SSE_PREFIX}{self._id_field}{payload[len(original_id):]}\n\n"
+        data['chat_id'] = self.chat.id
+        data['id'] = self.response_id
+        return f"{SSE_PREFIX}{json.dumps(data)}\n\n"
+
+    async def relayed_chunks(self) -> AsyncGenerator[str, None]:
+        async for chunk in self.body_iterator:
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode(self.charset)
+            yield self.relay_chunk(chunk)
+
     async def stream_response(self, send: Send) -> None:
         await send(
             {
@@ -45,18 +79,11 @@ class WrappedStreamingResponse(StreamingResponse):
             }
         )
         try:
-            async for chunk in self.body_iterator:
-                chunk = self.substitute_id(chunk)
-                if not isinstance(chunk, bytes):
-                    chunk = chunk.encode(self.charset)
-
-                decoded_chunk = chunk.decode(self.charset)
-                self.accumulate_content(decoded_chunk)
-
-                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            # the relayed chunks are coalesced into fewer writes for the slow or remote clients
+            async for chunk in shape_stream(self.relayed_chunks(), self.raw_request):
+                await send({"type": "http.response.body", "body": chunk.encode(self.charset), "more_body": True})
         except asyncio.CancelledError:
             logger.warn("Stream cancelled by client")
-            await self._safe_save_message_to_db()
             raise
         except Exception as e:
             logger.warn(f"Stream interrupted: {str(e)}")
@@ -68,34 +95,12 @@ class WrappedStreamingResponse(StreamingResponse):
                 logger.error(f"Error saving message to database: {e}")
             await send({"type": "http.response.body", "body": b"", "more_body": False})
 
-    def accumulate_content(self, chunk):
-        if 'INTERNAL-' in chunk:
-            return  # This is done in order to not log the internal process state
-        if chunk.startswith("data: "):
-            content = chunk[6:].strip()  # Remove "data: " prefix
-            if content != "[DONE]":
-                try:
-                    data = json.loads(content)
-                    if 'choices' in data and len(data['choices']) > 0:
-                        delta = data['choices'][0].get('delta', {})
-                        if 'content' in delta:
-                            self.accumulated_content += delta['content']
-                except json.JSONDecodeError:
-                    logger.error(f"Error parsing JSON content: {content}")
-                    pass  # Ignore malformed JSON
-
     async def save_message_to_db(self):
-        try:
-            async with self.db_session.begin():
-                if self.accumulated_content:
-                    new_message = Message(
-                        chat=self.chat,
-                        id=self.response_id,
-                        parent_message_id=self.parent_id,
-                        model_id=self.model_id,
-                        content={"role": "assistant", "content": self.accumulated_content}
-                    )
-                    self.db_session.add(new_message)
-        except Exception as e:
-            logger.error(f"Error saving message to database: {str(e)}")
-            raise
+        accumulated_content = self.accumulated_content
+        if not accumulated_content:
+            return
+        # queued, the message writer batches it with the other chat writes
+        write_messages(self.chat.id, dict(id=self.response_id, parent_message_id=self.parent_id,
+                                          model_id=self.model_id,
+                                          content={"role": "assistant", "content": accumulated_content},
+                                          token_count=await count_message_tokens(accumulated_content)))
@@ -10,6 +10,7 @@ import yaml
 from vllm import AsyncEngineArgs
 
 from app.utils.log import setup_custom_logger
+from app.utils.server.cli import add_pulsar_arguments
 from app.utils.memory.cuda_mem import get_total_cuda_memory, get_used_cuda_memory
 
 logger = setup_custom_logger(__name__)
@@ -21,17 +22,7 @@ def astra_parser_wrapper(parser):
     :param parser:
     :return:
     """
-    parser.description = "vLLM Based OpenAI-Compatible RESTful API server By AstraMind AI"
-    parser.add_argument("--auto-quantized-fallback", type=bool, default=True,
-                        help="Automatically pick a quantized model if the model is too big")
-    parser.add_argument("--quant-type-preference", type=str, default="GPTQ",
-                        help="The preference for quantization types, either GPTQ or AWQ")
-    parser.add_argument("--use-config-file", type=bool, default=True, help="Whether to use a server config file")
-    parser.add_argument("--server-config-file", type=str, default="last.yml",
-                        help="The path to the server configuration file")
-    parser.add_argument("--enable-tts", type=bool, default=False, help="Whether to enable TTS")
-    parser.add_argument("--enable-txt2img", type=bool, default=False, help="Whether to enable txt2img")
-    return parser
+    return add_pulsar_arguments(parser)
 
 
 @dataclass
@@ -44,6 +35,26 @@ class ExtendedAsyncEngineArgs(AsyncEngineArgs):
     server_config_file: str = "last.yml"
     allow_unsafe_local_requests: bool = False
     will_local_auth_token_rotate: bool = False
+    weight_cache_budget_gb: Optional[float] = None
+    swap_drain_timeout: float = 30.0
+    swap_queue_size: int = 64
+    engine_pool_size: int = 2
+    background_model: Optional[str] = None
+    prompt_token_cache_mb: int = 128
+    response_cache_mb: int = 64
+    response_cache_ttl: float = 600.0
+    semantic_cache_mb: int = 0
+    semantic_cache_threshold: float = 0.97
+    enable_request_coalescing: bool = True
+    scheduler_max_running: Optional[int] = None
+    admission_kv_overcommit: float = 1.5
+    admission_max_waiting: int = 64
+    admission_max_wait: Optional[float] = 30.0
+    batch_max_concurrency: int = 32
+    batch_max_items: int = 1024
+    stream_flush_tokens: int = 8
+    stream_flush_ms: float = 25.0
+    stream_max_pending: int = 256
     trust_remote_code = True
 
     @classmethod
@@ -4,9 +4,15 @@ from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 from starlette.responses import JSONResponse
 
+from app.core.swap import swap_coordinator
+
 block_requests = False
 lock = threading.Lock()
 
+# requests that must go through while a swap is running, /model/load so concurrent loads can be merged
+SWAP_PASSTHROUGH_PATHS = {"/model/load", "/health", "/metrics"}
+SWAP_RETRY_AFTER = 5  # seconds
+
 
 class BlockRequestsMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
@@ -17,6 +23,12 @@ class BlockRequestsMiddleware(BaseHTTPMiddleware):
                     "detail": "Server is not accepting requests, a restart is about to happen try again in a minute "
                               "or so"},
                     status_code=503)
+        if swap_coordinator.swapping and request.url.path not in SWAP_PASSTHROUGH_PATHS:
+            # hold the request until the new model is loaded and replay it on the new engine
+            if not await swap_coordinator.hold():
+                return JSONResponse(content={
+                    "detail": "A model swap is in progress and the request queue is full, try again in a few seconds"},
+                    status_code=503, headers={"Retry-After": str(SWAP_RETRY_AFTER)})
         response = await call_next(request)
         return response
 
@@ -0,0 +1,26 @@
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from app.utils.server.startup import startup
+
+STARTUP_WAIT_TIMEOUT = 120  # seconds
+STARTUP_RETRY_AFTER = 10  # seconds
+
+
+class StartupGateMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        stages = startup.get_required_stages(request.url.path)
+        if not all(startup.is_done(stage) for stage in stages):
+            # hold the request until the stages it depends on are done instead of failing it
+            if not await startup.wait_for(*stages, timeout=STARTUP_WAIT_TIMEOUT):
+                failed = [stage for stage in stages if startup.get_error(stage)]
+                return JSONResponse(content={
+                    "detail": f"Server is still starting up ({', '.join(failed)} failed)" if failed else
+                    "Server is still starting up, try again in a few seconds"},
+                    status_code=503, headers={"Retry-After": str(STARTUP_RETRY_AFTER)})
+        elif any(startup.get_error(stage) for stage in stages):
+            return JSONResponse(content={"detail": "A startup stage this endpoint depends on failed, check the logs"},
+                                status_code=503)
+        response = await call_next(request)
+        return response
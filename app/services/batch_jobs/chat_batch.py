@@ -0,0 +1,65 @@
+import asyncio
+import json
+from http import HTTPStatus
+from typing import AsyncGenerator, List, Optional, Tuple
+
+from starlette.requests import Request
+from vllm.entrypoints.openai.protocol import ChatCompletionRequest, ErrorResponse
+
+from app.core.scheduler import Lane, scheduling_context
+from app.core.swap import swap_coordinator
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+
+async def run_chat_completion(request: ChatCompletionRequest, raw_request: Optional[Request] = None) -> dict:
+    """
+    Run a single non streamed chat completion on the engine serving its model.
+    :return: {"response": ...} or {"error": ...} with the OpenAI error body, errors are never raised
+    """
+    await swap_coordinator.hold(bounded=False)  # a swap is tearing the serving chat down
+    from app.core.engine import openai_serving_chat
+    from app.core.engine_pool import engine_pool
+    serving_chat = engine_pool.get_serving_chat(request.model) or openai_serving_chat
+    request.stream = False
+    try:
+        result = await serving_chat.create_chat_completion(request, raw_request)
+    except Exception as e:
+        logger.error(f"Error in a batched chat completion: {e}")
+        result = serving_chat.create_error_response(str(e), err_type="InternalServerError",
+                                                    status_code=HTTPStatus.INTERNAL_SERVER_ERROR)
+    if isinstance(result, ErrorResponse):
+        return {"error": result.model_dump()}
+    return {"response": result.model_dump()}
+
+
+async def run_chat_batch(requests: List[ChatCompletionRequest], max_concurrency: int,
+                         raw_request: Optional[Request] = None,
+                         user: Optional[str] = None) -> AsyncGenerator[Tuple[int, dict], None]:
+    """
+    Run independent chat completions together, so the engine batches them, at most max_concurrency at a time.
+    They are scheduled in the background lane on behalf of the user, and cancelled if the consumer stops.
+    :return: the index of each request and its result, in completion order
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(index: int, request: ChatCompletionRequest) -> Tuple[int, dict]:
+        async with semaphore:
+            return index, await run_chat_completion(request, raw_request)
+
+    with scheduling_context(Lane.BACKGROUND, user):
+        tasks = [asyncio.create_task(run(index, request)) for index, request in enumerate(requests)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def stream_chat_batch_ndjson(requests: List[ChatCompletionRequest], max_concurrency: int,
+                                   raw_request: Optional[Request] = None,
+                                   user: Optional[str] = None) -> AsyncGenerator[str, None]:
+    async for index, result in run_chat_batch(requests, max_concurrency, raw_request, user):
+        yield json.dumps({"index": index, **result}) + "\n"
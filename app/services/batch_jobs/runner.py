@@ -0,0 +1,301 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Any, AsyncGenerator, Dict, List, Optional, Set, Tuple
+
+import aiofiles
+from pydantic import ValidationError
+from vllm.entrypoints.openai.protocol import ChatCompletionRequest
+
+from app.core.scheduler import Lane, scheduling_context
+from app.services.batch_jobs.chat_batch import run_chat_completion
+from app.utils.definitions import BATCH_JOBS_DIRECTORY
+from app.utils.log import setup_custom_logger
+from app.utils.server.startup import startup
+
+logger = setup_custom_logger(__name__)
+
+INPUT_FILE = "input.jsonl"
+OUTPUT_FILE = "output.jsonl"
+JOB_FILE = "job.json"
+BATCH_URL = "/v1/chat/completions"
+RESUMABLE_STATUSES = {"queued", "in_progress"}
+FINAL_STATUSES = {"completed", "failed", "cancelled"}
+PROGRESS_SAVE_INTERVAL = 2.0  # seconds between two saves of the job counters
+
+
+@dataclass
+class BatchJob:
+    id: str
+    user_id: str
+    status: str = "queued"
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+    created_at: int = field(default_factory=lambda: int(time.time()))
+    started_at: Optional[int] = None
+    finished_at: Optional[int] = None
+    error: Optional[str] = None
+
+    @property
+    def directory(self) -> str:
+        return os.path.join(BATCH_JOBS_DIRECTORY, self.id)
+
+    @property
+    def input_path(self) -> str:
+        return os.path.join(self.directory, INPUT_FILE)
+
+    @property
+    def output_path(self) -> str:
+        return os.path.join(self.directory, OUTPUT_FILE)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"object": "batch", **asdict(self)}
+
+    def save(self) -> None:
+        # written aside and moved, a crash never leaves a truncated job file
+        path = os.path.join(self.directory, JOB_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(asdict(self), f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, job_id: str) -> Optional["BatchJob"]:
+        try:
+            with open(os.path.join(BATCH_JOBS_DIRECTORY, job_id, JOB_FILE)) as f:
+                return cls(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+
+def parse_batch_line(line: str, line_number: int, default_model: Optional[str]) -> Tuple[str, ChatCompletionRequest]:
+    """
+    Read a line of an input file. The lines follow the OpenAI Batch API ({"custom_id", "body", ...}) or are bare chat
+    requests; a line whose body is a text (i.e. {"request_id", "title", "body"}) is sent as a single user message.
+    :return: the id of the line and its request
+    :raise ValueError: if the line is not a valid chat request
+    """
+    values = json.loads(line)
+    if not isinstance(values, dict):
+        raise ValueError("The line is not a JSON object")
+    if values.get("url", BATCH_URL) != BATCH_URL:
+        raise ValueError(f"Only {BATCH_URL} is supported in a batch")
+    custom_id = str(values.get("custom_id") or values.get("request_id") or line_number)
+    body = values.get("body", values)
+    if isinstance(body, str):
+        content = f"{values['title']}\n\n{body}" if values.get("title") else body
+        body = {"messages": [{"role": "user", "content": content}]}
+    if not isinstance(body, dict):
+        raise ValueError("The body is not a JSON object")
+    body = {key: value for key, value in body.items() if key in ChatCompletionRequest.model_fields}
+    if default_model:
+        body.setdefault("model", default_model)
+    try:
+        return custom_id, ChatCompletionRequest(**body)
+    except ValidationError as e:
+        # without the input values, the output is downloadable and must not echo the content of the file
+        raise ValueError("; ".join(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}"
+                                   for error in e.errors(include_url=False, include_context=False,
+                                                         include_input=False)))
+
+
+class BatchJobRunner:
+    """
+    Runs JSONL files of chat requests in the background, one job at a time, like the OpenAI Batch API does locally.
+
+    The requests of a job are kept in flight max_concurrency at a time, so the engine batches are kept full, and in
+    the background lane so they only use what the users leave. Each result is appended to the output file as soon as
+    it is done: the output is the checkpoint, a job interrupted by a restart skips the lines already answered.
+    """
+
+    def __init__(self, max_concurrency: Optional[int] = None):
+        """:param max_concurrency: the requests of a job in flight, batch_max_concurrency of the engine if None"""
+        self.max_concurrency = max_concurrency
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._current: Optional[BatchJob] = None
+
+    async def create(self, user_id: str, content: Optional[AsyncGenerator[bytes, None]] = None,
+                     input_path: Optional[str] = None) -> BatchJob:
+        """
+        Create a job from an uploaded file or a local one and queue it.
+        :param content: the chunks of the uploaded file
+        :param input_path: a JSONL file of the server, copied so it can change while the job runs
+        """
+        job = BatchJob(id=f"batch_{uuid.uuid4().hex}", user_id=user_id)
+        os.makedirs(job.directory, exist_ok=True)
+        async with aiofiles.open(job.input_path, "wb") as f:
+            if input_path is not None:
+                async with aiofiles.open(input_path, "rb") as source:
+                    async for line in source:
+                        await f.write(line)
+            else:
+                async for chunk in content:
+                    await f.write(chunk)
+        async with aiofiles.open(job.input_path, "rb") as f:
+            job.total = sum([bool(line.strip()) async for line in f])
+        job.save()
+        self._enqueue(job.id)
+        logger.info(f"Queued batch job {job.id} of {job.total} requests")
+        return job
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        if self._current is not None and self._current.id == job_id:
+            return self._current
+        return BatchJob.load(job_id)
+
+    def list(self, user_id: str) -> List[BatchJob]:
+        if not os.path.isdir(BATCH_JOBS_DIRECTORY):
+            return []
+        jobs = [self.get(job_id) for job_id in os.listdir(BATCH_JOBS_DIRECTORY)]
+        return sorted((job for job in jobs if job is not None and job.user_id == user_id),
+                      key=lambda job: job.created_at, reverse=True)
+
+    def cancel(self, job: BatchJob) -> BatchJob:
+        if job.status in FINAL_STATUSES:
+            return job
+        job.status = "cancelled"
+        job.finished_at = int(time.time())
+        job.save()
+        return job
+
+    def _enqueue(self, job_id: str) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._queue.put_nowait(job_id)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def resume(self) -> None:
+        """Queue again the jobs a shutdown interrupted, oldest first."""
+        if not os.path.isdir(BATCH_JOBS_DIRECTORY):
+            return
+        jobs = [BatchJob.load(job_id) for job_id in os.listdir(BATCH_JOBS_DIRECTORY)]
+        for job in sorted((job for job in jobs if job is not None and job.status in RESUMABLE_STATUSES),
+                          key=lambda job: job.created_at):
+            logger.info(f"Resuming batch job {job.id}, {job.completed + job.failed}/{job.total} requests done")
+            self._enqueue(job.id)
+
+    async def _run(self) -> None:
+        while True:
+            job = BatchJob.load(await self._queue.get())
+            if job is None or job.status not in RESUMABLE_STATUSES:
+                continue
+            self._current = job
+            try:
+                await self._run_job(job)
+            except asyncio.CancelledError:
+                job.save()  # resumed on the next start
+                raise
+            except Exception as e:
+                logger.error(f"Batch job {job.id} failed: {e}")
+                job.status, job.error, job.finished_at = "failed", str(e), int(time.time())
+                job.save()
+            finally:
+                self._current = None
+
+    @staticmethod
+    async def _read_done_lines(job: BatchJob) -> Dict[int, bool]:
+        """The lines already answered in the output, and whether they failed."""
+        done = {}
+        if not os.path.exists(job.output_path):
+            return done
+        async with aiofiles.open(job.output_path, "r") as f:
+            async for line in f:
+                try:
+                    record = json.loads(line)
+                    done[record["line"]] = record["error"] is not None
+                except (ValueError, KeyError):
+                    continue  # a line cut by a crash, its request runs again
+        return done
+
+    async def _run_job(self, job: BatchJob) -> None:
+        if not await startup.wait_for("engine"):
+            raise RuntimeError("The engine could not be started")
+        from app.core.engine import async_engine_args, openai_serving_chat
+        default_model = openai_serving_chat.base_model_paths[0].name if openai_serving_chat else None
+        max_concurrency = self.max_concurrency or async_engine_args.batch_max_concurrency
+        done = await self._read_done_lines(job)
+        # the saved counters may be behind the output
+        job.failed = sum(done.values())
+        job.completed = len(done) - job.failed
+        job.status = "in_progress"
+        job.started_at = job.started_at or int(time.time())
+        job.save()
+
+        in_flight: Set[asyncio.Task] = set()
+        last_save = time.monotonic()
+        async with aiofiles.open(job.input_path, "r") as source, aiofiles.open(job.output_path, "a") as output:
+            async def write(line_number: int, custom_id: str, result: dict) -> None:
+                nonlocal last_save
+                error = result.get("error")
+                record = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": custom_id, "line": line_number,
+                          "response": None if error else {"status_code": 200, "body": result["response"]},
+                          "error": error}
+                await output.write(json.dumps(record) + "\n")
+                await output.flush()
+                if error:
+                    job.failed += 1
+                else:
+                    job.completed += 1
+                if time.monotonic() - last_save > PROGRESS_SAVE_INTERVAL:
+                    job.save()
+                    last_save = time.monotonic()
+
+            async def run(line_number: int, custom_id: str, request: ChatCompletionRequest) -> None:
+                await write(line_number, custom_id, await run_chat_completion(request))
+
+            async def drain(return_when: str) -> None:
+                finished, _ = await asyncio.wait(in_flight, return_when=return_when)
+                in_flight.difference_update(finished)
+                for task in finished:
+                    task.result()
+
+            try:
+                with scheduling_context(Lane.BACKGROUND, job.user_id):
+                    line_number = 0
+                    async for line in source:
+                        if not line.strip():
+                            continue
+                        line_number += 1
+                        if line_number in done:
+                            continue
+                        if job.status == "cancelled":  # set by cancel() on this same object
+                            break
+                        try:
+                            custom_id, request = parse_batch_line(line, line_number, default_model)
+                        except ValueError as e:
+                            await write(line_number, str(line_number), {"error": {
+                                "object": "error", "message": f"Invalid request: {e}", "type": "BadRequestError",
+                                "code": 400}})
+                            continue
+                        if len(in_flight) >= max_concurrency:
+                            await drain(asyncio.FIRST_COMPLETED)
+                        in_flight.add(asyncio.create_task(run(line_number, custom_id, request)))
+                    if in_flight:
+                        await drain(asyncio.ALL_COMPLETED)
+            finally:
+                for task in in_flight:
+                    task.cancel()
+
+        if job.status != "cancelled":
+            job.status = "completed"
+        job.finished_at = int(time.time())
+        job.save()
+        logger.info(f"Batch job {job.id} {job.status}: {job.completed} completed, {job.failed} failed")
+
+    async def close(self) -> None:
+        """Stop the running job, it is resumed on the next start."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+batch_job_runner = BatchJobRunner()
@@ -1,9 +1,9 @@
 import os
 import uuid
+from functools import lru_cache
 from pathlib import Path
 
 from dotenv import set_key, load_dotenv
-from vllm.model_executor.models import _MODELS  # noqa
 
 from app.utils.models.model_paths import get_model_path
 
@@ -38,13 +38,30 @@ ALLOWED_EXTENSIONS = [
 ABSOLUTE_UPLOAD_DIRECTORY = Path(UPLOAD_DIRECTORY).resolve()
 MAX_SIZE = (1024, 1024)
 
+# Batch jobs related
+BATCH_JOBS_DIRECTORY = os.path.join(".", "static", "batch_jobs")
+BATCH_INPUTS_DIRECTORY = os.path.join(".", "static", "batch_inputs")  # the files a job can be created from by path
+FAILED_CHAT_WRITES_FILE = os.path.join(".", "static", "failed_chat_writes.jsonl")
+
 # Model related
 VALID_EXTENSIONS = ('.pt', '.ckpt', '.safetensors', '.bin', '.pth', '.gguf')
 MIN_MODEL_SIZE = 250 * 1024 * 1024  # 250 MB in bytes
 MIN_LORA_SIZE = 10 * 1024 * 1024  # 10 MB in bytes
-SUPPORTED_VLLM_ARCHS = {elem for pair in _MODELS.values() for elem in pair}
 MODEL_PATHS = get_model_path()
 
+
+# importing the vllm model registry pulls in torch and every model, only pay for it when it is needed
+@lru_cache(maxsize=1)
+def get_vllm_models() -> dict:
+    from vllm.model_executor.models import _MODELS  # noqa
+    return _MODELS
+
+
+@lru_cache(maxsize=1)
+def get_supported_vllm_archs() -> frozenset:
+    return frozenset(elem for pair in get_vllm_models().values() for elem in pair)
+
+
 # Personality related
 PERSONALITY_REGEX_SCHEMAS = {
     "name": ("regex", "Write only the character's name, keeping it short and memorable", ".{1,50}"),
@@ -93,6 +110,8 @@ INITIAL_CHUNK_SIZE = 8_000_000  # 8 MB
 GITHUB_REPO = "astramind-ai/Pulsar"
 GITHUB_API_URL = f"https://api.github.com/repos/{GITHUB_REPO}/releases/latest"
 CONF_FILE = "last.yml"
+FIT_PROFILE_FILE = "fit_profiles.json"
+CHAT_TEMPLATE_CACHE_FILE = "chat_templates.json"
 
 
 LOCAL_TOKEN = os.environ.get("LOCAL_TOKEN", None)
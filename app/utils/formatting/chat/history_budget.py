@@ -0,0 +1,78 @@
+from typing import Any, Callable, List, Optional
+
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+# role header and end of turn tokens the chat template adds around each message
+MESSAGE_OVERHEAD_TOKENS = 8
+
+
+def count_content_tokens(tokenizer, content: Any) -> int:
+    """
+    Count the tokens of the content of a message, only the text parts of multimodal contents are counted
+    :param tokenizer: the tokenizer of the model
+    :param content: a string, a stored multimodal string or a list of content parts
+    :return: the number of tokens
+    """
+    from app.db.chat.chat_db import unpack_multimodal_content
+    content = unpack_multimodal_content(content)
+    if isinstance(content, list):
+        content = "\n".join(part.get("text", "") for part in content if isinstance(part, dict))
+    if not isinstance(content, str) or not content:
+        return 0
+    return len(tokenizer.encode(content, add_special_tokens=False))
+
+
+async def count_message_tokens(content: Any) -> Optional[int]:
+    """
+    Count the tokens of a message with the tokenizer of the loaded model, to store them with the message.
+    :return: the number of tokens, None if no model is loaded
+    """
+    from app.core.engine import async_engine
+    if async_engine is None:
+        return None
+    try:
+        return count_content_tokens(await async_engine.get_tokenizer(), content)
+    except Exception as e:
+        logger.error(f"Could not count the tokens of a message: {e}")
+        return None
+
+
+def _split_turns(messages: List[dict]) -> List[List[dict]]:
+    """Group the messages in turns, each starting with a user message, so roles keep alternating when cutting."""
+    turns = []
+    for message in messages:
+        if not turns or message.get("role") == "user":
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def fit_history_to_budget(messages: List[dict], budget: int, count: Callable[[dict], int]) -> List[dict]:
+    """
+    Drop the oldest whole turns of a chat until its prompt fits the budget.
+    The leading system prompt and the last turn are always kept.
+    :param messages: the messages of the branch, in chronological order
+    :param budget: the maximum number of prompt tokens
+    :param count: returns the tokens of a message, template overhead included
+    :return: the messages to send
+    """
+    head = []
+    while len(head) < len(messages) and messages[len(head)].get("role") == "system":
+        head.append(messages[len(head)])
+    turns = _split_turns(messages[len(head):])
+    if not turns:
+        return messages
+
+    used = sum(count(message) for message in head)
+    kept = []
+    for turn in reversed(turns):
+        turn_tokens = sum(count(message) for message in turn)
+        if kept and used + turn_tokens > budget:
+            break
+        kept.append(turn)
+        used += turn_tokens
+    if len(kept) < len(turns):
+        logger.info(f"Dropped {len(turns) - len(kept)} old turns to fit the history in {budget} tokens")
+    return head + [message for turn in reversed(kept) for message in turn]
@@ -1,40 +1,176 @@
-from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+import re
+from typing import List, Optional, Tuple
+
 from starlette.requests import Request
 from vllm.entrypoints.openai.protocol import ChatCompletionRequest
-from vllm.entrypoints.openai.serving_chat import OpenAIServingChat
 
-from app.db.model.chat import Chat
+from app.core.scheduler import Lane, scheduling_context
+from app.core.swap import swap_coordinator
+from app.hijacks.openai import ExtendedOpenAIServingChat
+from app.db.chat.message_writer import message_writer
 from app.utils.definitions import SUMMARIZATION_TEMPLATE
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+TITLE_BATCH_SIZE = 8
+TITLE_BATCH_WINDOW = 2.0  # seconds to gather the new chats of a batch
+ENGINE_BUSY_REQUESTS = 4  # unfinished requests above which titles are not generated by the model
+MAX_TITLE_DELAY = 30.0  # seconds a batch waits for the engine to calm down before falling back
+EXTRACTIVE_TITLE_WORDS = 5
+DEFAULT_TITLE = "New Chat"
 
 
-async def summarize(summerizer_request: ChatCompletionRequest, raw_request: Request, chat_completor: OpenAIServingChat):
+async def summarize(summerizer_request: ChatCompletionRequest, raw_request: Optional[Request],
+                    chat_completor: ExtendedOpenAIServingChat):
     summerizer_request.stream = False
-    return await chat_completor.create_chat_completion(summerizer_request, raw_request)
+    # straight to the scheduler, the caches and the coalescer would give a chat the title of a similar one
+    return await swap_coordinator.admitted(
+        lambda: chat_completor.current.schedule_chat_completion(summerizer_request, raw_request))
 
 
-async def populate_and_summarize_chat(chat: Chat, db: AsyncSession, chat_completor: OpenAIServingChat,
-                                      request: ChatCompletionRequest, raw_request: Request):
+async def populate_and_summarize_chat(first_user_message: str, chat_completor: ExtendedOpenAIServingChat,
+                                      model: str, raw_request: Optional[Request] = None) -> str:
     """
-    This function simulates the process of populating a chat with messages and then summarizing the chat.
-
+    Ask the model a title for a chat
+    :param first_user_message: the message that opened the chat
+    :param chat_completor: the serving instance of the model
+    :param model: the model (or LoRA) to ask
+    :return: the title
     """
-    first_user_message = next((msg.content['content'] for msg in chat.messages if msg.content['role'] == 'user'), None)
     summarizer_chat = [{'content': 'You are a very helpful and skilled summerizer,'
                                    'You need to briefly summerize the user text in 3/5 words, i.e: Tell me recepie '
                                    'for a pumpkin pie -> Pumpkin Pie Recepie ',
                         'role': 'system'},
                        {'content': SUMMARIZATION_TEMPLATE.format(first_user_message=first_user_message),
                         'role': 'user'}]
-    request = request.model_copy()
-    request.temperature = 0.7
-    request.max_tokens = 10
-    request.top_k = -1
-    request.top_p = 0.1
-    request.repetition_penalty = 1.0
-    request.messages = summarizer_chat
+    # a request of its own, nothing of the chat request (its chat_id, user, n...) must leak into it
+    request = ChatCompletionRequest(model=model, messages=summarizer_chat, n=1, temperature=0.7, max_tokens=10,
+                                    top_k=-1, top_p=0.1, repetition_penalty=1.0)
 
     summary = await summarize(request, raw_request, chat_completor)
+    if not hasattr(summary, 'choices'):  # an ErrorResponse
+        raise ValueError(getattr(summary, 'message', str(summary)))
+    return summary.choices[0].message.content.strip().strip('"\'')
+
+
+def extractive_title(first_user_message: str) -> str:
+    """A title made of the first words of the message, used when the model can't be asked."""
+    from app.db.chat.chat_db import unpack_multimodal_content
+    content = unpack_multimodal_content(first_user_message)
+    if isinstance(content, list):
+        content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    words = re.findall(r"[\w'-]+", content if isinstance(content, str) else "")[:EXTRACTIVE_TITLE_WORDS]
+    if not words:
+        return DEFAULT_TITLE
+    title = " ".join(words)
+    return title[0].upper() + title[1:]
+
+
+def is_engine_busy(engine=None) -> bool:
+    """:param engine: the engine serving the titles, the main one if None"""
+    from app.core.engine import async_engine
+    engine = engine or async_engine
+    if engine is None:
+        return True
+    return engine.engine.get_num_unfinished_requests() > ENGINE_BUSY_REQUESTS
+
+
+class TitleSummarizer:
+    """
+    Generates the titles of the new chats in the background, off the request that opened them.
+
+    The chats opened within a short window are titled together: their requests are sent at once so the engine
+    decodes them in the same steps. A batch waits for the engine to have few unfinished requests, so titles don't
+    compete with the users' answers, and falls back to an extractive title if it stays busy.
+    """
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self, chat_id: str, first_user_message: str, request: ChatCompletionRequest) -> None:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._queue.put_nowait((chat_id, first_user_message, request.model))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _next_batch(self) -> List[Tuple[str, str, str]]:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + TITLE_BATCH_WINDOW
+        while len(batch) < TITLE_BATCH_SIZE:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    @staticmethod
+    async def _wait_for_idle_engine(engine=None) -> bool:
+        deadline = asyncio.get_running_loop().time() + MAX_TITLE_DELAY
+        while is_engine_busy(engine):
+            if asyncio.get_running_loop().time() >= deadline:
+                return False
+            await asyncio.sleep(0.5)
+        return True
+
+    async def _summarize_batch(self, batch: List[Tuple[str, str, str]]) -> None:
+        from app.core.engine_pool import engine_pool
+        # the titles go to the background model when it is loaded in the engine pool
+        background = engine_pool.get_background_serving_chat()
+        if await self._wait_for_idle_engine(background.engine_client if background else None):
+            await swap_coordinator.hold(bounded=False)  # a swap is tearing the serving chat down
+            from app.core.engine import openai_serving_chat
+
+            def title(message: str, model: str):
+                if background:
+                    return populate_and_summarize_chat(message, background, background.base_model_paths[0].name)
+                return populate_and_summarize_chat(message, engine_pool.get_serving_chat(model) or openai_serving_chat,
+                                                   model)
+
+            with scheduling_context(Lane.BACKGROUND):
+                titles = await asyncio.gather(*(title(message, model) for _, message, model in batch),
+                                              return_exceptions=True)
+        else:
+            logger.info(f"The engine is busy, using extractive titles for {len(batch)} chats")
+            titles = [None] * len(batch)
+
+        for (chat_id, message, _), title in zip(batch, titles):
+            if isinstance(title, BaseException):
+                logger.error(f"Error while summarizing chat {chat_id}: {title}")
+            if not isinstance(title, str) or not title:
+                title = extractive_title(message)
+            message_writer.update_chat(chat_id, summary=title)
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._summarize_batch(batch)
+            except asyncio.CancelledError:
+                for chat_id, message, _ in batch:
+                    message_writer.update_chat(chat_id, summary=extractive_title(message))
+                raise
+            except Exception as e:
+                logger.error(f"Error while summarizing {len(batch)} chats: {e}")
+
+    async def close(self) -> None:
+        """Stop the worker, the chats still queued get an extractive title."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self._queue is not None and not self._queue.empty():
+            chat_id, message, _ = self._queue.get_nowait()
+            message_writer.update_chat(chat_id, summary=extractive_title(message))
+
 
-    # Update the chat summary
-    chat.summary = summary.choices[0].message.content
-    await db.commit()
+title_summarizer = TitleSummarizer()
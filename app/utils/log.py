@@ -1,11 +1,9 @@
 import logging
 
-from vllm.logger import init_logger
-
 
 def setup_custom_logger(name):
     # Create a logger
-    logger = init_logger(name)
+    logger = logging.getLogger(name)  # same as vllm's init_logger, without importing the whole vllm package
     logger.setLevel(logging.INFO)  # Set the logging level
     logger.propagate = False  # Prevent the log messages from propagating to the root logger
 
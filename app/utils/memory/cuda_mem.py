@@ -19,3 +19,26 @@ def get_total_cuda_memory():
     cuda_device = torch.cuda.current_device()
     _, total_memory = torch.cuda.mem_get_info(cuda_device)
     return total_memory
+
+
+def get_engine_cuda_memory(engine_args) -> int:
+    # the weights and the kv cache of an engine are sharded over tensor_parallel_size * pipeline_parallel_size
+    # devices, gpu_memory_utilization applies to each of them
+    shards = ((getattr(engine_args, "tensor_parallel_size", 1) or 1)
+              * (getattr(engine_args, "pipeline_parallel_size", 1) or 1))
+    device_count = max(min(shards, torch.cuda.device_count()), 1)
+    total_memory = sum(torch.cuda.mem_get_info(device)[1] for device in range(device_count))
+    return int(total_memory * engine_args.gpu_memory_utilization)
+
+
+def get_gpu_count():
+    return torch.cuda.device_count() if torch.cuda.is_available() else 0
+
+
+def get_gpu_signature():
+    if not torch.cuda.is_available():
+        return "cpu"
+    device_count = torch.cuda.device_count()
+    gpu_name = torch.cuda.get_device_name(torch.cuda.current_device())
+    total_memory_gb = round(get_total_cuda_memory() / 1024 ** 3)
+    return f"{device_count}x{gpu_name}@{total_memory_gb}GB"
@@ -0,0 +1,217 @@
+import json
+import os
+import struct
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Optional, Dict, Any, Tuple
+
+from app.utils.definitions import MODEL_PATHS
+from app.utils.log import setup_custom_logger
+from app.utils.memory.weight_cache import resolve_snapshot
+from app.utils.models.gguf_util import extract_gguf_info_local
+
+logger = setup_custom_logger(__name__)
+
+DTYPE_BYTES = {
+    "float32": 4, "float": 4,
+    "bfloat16": 2, "float16": 2, "half": 2,
+    "fp8": 1, "fp8_e4m3": 1, "fp8_e5m2": 1,
+}
+MAX_LEN_KEYS = ("max_position_embeddings", "n_positions", "max_seq_len", "seq_length",
+                "model_max_length", "max_sequence_length")
+RUNTIME_OVERHEAD_BYTES = 1024 ** 3  # activations of the profiling run, cuBLAS workspaces and friends
+MM_ACTIVATION_BYTES_PER_ITEM = 256 * 1024 ** 2  # vision encoder activations per image in a prompt
+LORA_EXTRA_VOCAB_SIZE = 256
+MIN_USABLE_CONTEXT = 2048
+CONTEXT_ALIGNMENT = 256
+MAX_CACHED_FOOTPRINTS = 32
+
+
+@dataclass
+class FitEstimate:
+    weight_bytes: int
+    kv_bytes_per_token: int
+    overhead_bytes: int
+    native_max_model_len: Optional[int]
+    max_model_len: int
+
+    @property
+    def fits(self) -> bool:
+        return self.max_model_len >= min(MIN_USABLE_CONTEXT, self.native_max_model_len or MIN_USABLE_CONTEXT)
+
+    def to_dict(self) -> Dict[str, Any]:
+        estimate = asdict(self)
+        estimate["fits"] = self.fits
+        return estimate
+
+
+def _find_model_dir(model: str, revision: Optional[str] = None) -> Optional[str]:
+    """The directory of a local model or the cached snapshot of the revision the engine will load."""
+    if os.path.isdir(model):
+        return model
+    snapshot = resolve_snapshot(model, revision)
+    if snapshot is None and revision is None:
+        # a repo downloaded by commit has no refs/main, the latest snapshot is the one that was last fetched
+        snapshot_root = os.path.join(MODEL_PATHS, "models--" + model.replace("/", "--"), "snapshots")
+        if os.path.isdir(snapshot_root):
+            snapshots = [os.path.join(snapshot_root, name) for name in os.listdir(snapshot_root)]
+            snapshot = max(snapshots, key=os.path.getmtime, default=None)
+    if snapshot and os.path.exists(os.path.join(snapshot, "config.json")):
+        return snapshot
+    return None
+
+
+def _read_safetensors_bytes(file_path: str) -> int:
+    """Sum the tensor sizes declared in a safetensors header without touching the tensor data."""
+    with open(file_path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    return sum(end - start for name, tensor in header.items() if name != "__metadata__"
+               for start, end in [tensor["data_offsets"]])
+
+
+def _config_from_gguf(file_path: str) -> Dict[str, Any]:
+    metadata = extract_gguf_info_local(file_path)["metadata"]
+    arch = metadata["general.architecture"]
+    hidden_size = metadata.get(f"{arch}.embedding_length", 0)
+    num_heads = metadata.get(f"{arch}.attention.head_count", 0)
+    return {
+        "num_hidden_layers": metadata.get(f"{arch}.block_count", 0),
+        "hidden_size": hidden_size,
+        "intermediate_size": metadata.get(f"{arch}.feed_forward_length", 0),
+        "num_attention_heads": num_heads,
+        "num_key_value_heads": metadata.get(f"{arch}.attention.head_count_kv", num_heads),
+        "head_dim": metadata.get(f"{arch}.attention.key_length", hidden_size // num_heads if num_heads else 0),
+        "max_position_embeddings": metadata.get(f"{arch}.context_length"),
+        "torch_dtype": "float16",
+    }
+
+
+_footprints: "OrderedDict[Tuple[str, int], tuple]" = OrderedDict()
+
+
+def read_model_footprint(model: str, revision: Optional[str] = None) -> Optional[tuple]:
+    """
+    Read the architecture config and the weight size of a local model (HF snapshot, directory or GGUF file).
+    :param revision: the revision of the engine args when the model is an HF repo id, the main branch if None
+    :return: (config, weight_bytes) or None if the model is not on disk
+    """
+    if os.path.isfile(model) and model.lower().endswith(".gguf"):
+        path = model
+    else:
+        path = _find_model_dir(model, revision)
+        if not path:
+            return None
+    # keyed on the path and its mtime: a new snapshot, a re-download or a deleted model is never served stale
+    key = (os.path.realpath(path), os.stat(path).st_mtime_ns)
+    if key in _footprints:
+        _footprints.move_to_end(key)
+        return _footprints[key]
+    footprint = _read_model_footprint(path)
+    _footprints[key] = footprint
+    while len(_footprints) > MAX_CACHED_FOOTPRINTS:
+        _footprints.popitem(last=False)
+    return footprint
+
+
+def _read_model_footprint(path: str) -> tuple:
+    if os.path.isfile(path):
+        return _config_from_gguf(path), os.path.getsize(path)
+
+    model_dir = path
+    with open(os.path.join(model_dir, "config.json")) as f:
+        config = json.load(f)
+
+    files = [os.path.join(model_dir, file) for file in os.listdir(model_dir)]
+    safetensors = [file for file in files if file.endswith(".safetensors")]
+    if safetensors:
+        weight_bytes = sum(_read_safetensors_bytes(file) for file in safetensors)
+    else:
+        weight_bytes = sum(os.path.getsize(file) for file in files if file.endswith((".bin", ".pt", ".pth")))
+    return config, weight_bytes
+
+
+def get_text_config(config: Dict[str, Any]) -> Dict[str, Any]:
+    # multimodal models (llava, mllama, qwen2-vl...) nest the language model config
+    return {**config, **config["text_config"]} if isinstance(config.get("text_config"), dict) else config
+
+
+def get_native_max_model_len(config: Dict[str, Any]) -> Optional[int]:
+    config = get_text_config(config)
+    lengths = [config[key] for key in MAX_LEN_KEYS if isinstance(config.get(key), int)]
+    return min(lengths) if lengths else None
+
+
+def kv_cache_bytes_per_token(config: Dict[str, Any], kv_cache_dtype: str = "auto") -> int:
+    config = get_text_config(config)
+    num_layers = config.get("num_hidden_layers", config.get("n_layer", config.get("n_layers", 0)))
+    num_heads = config.get("num_attention_heads", config.get("n_head", config.get("n_heads", 0)))
+    hidden_size = config.get("hidden_size", config.get("n_embd", config.get("d_model", 0)))
+    num_kv_heads = config.get("num_key_value_heads", config.get("num_kv_heads", num_heads))
+    if config.get("multi_query"):
+        num_kv_heads = 1
+    head_dim = config.get("head_dim") or (hidden_size // num_heads if num_heads else 0)
+    if kv_cache_dtype == "auto":
+        dtype_bytes = DTYPE_BYTES.get(str(config.get("torch_dtype", "float16")), 2)
+        dtype_bytes = min(dtype_bytes, 2)  # vllm runs float32 checkpoints in half precision
+    else:
+        dtype_bytes = DTYPE_BYTES.get(kv_cache_dtype, 2)
+    return 2 * num_layers * num_kv_heads * head_dim * dtype_bytes  # key and value
+
+
+def lora_bytes(config: Dict[str, Any], max_loras: int, max_lora_rank: int) -> int:
+    """Memory vllm preallocates for the LoRA slots of the attention and MLP projections."""
+    config = get_text_config(config)
+    num_layers = config.get("num_hidden_layers", 0)
+    hidden_size = config.get("hidden_size", 0)
+    intermediate_size = config.get("intermediate_size", 4 * hidden_size)
+    per_layer = max_lora_rank * (4 * 2 * hidden_size + 3 * (hidden_size + intermediate_size))
+    extra_vocab = LORA_EXTRA_VOCAB_SIZE * hidden_size * 2
+    return max_loras * (num_layers * per_layer + extra_vocab) * 2
+
+
+def estimate_fit(config: Dict[str, Any], weight_bytes: int, available_bytes: int,
+                 kv_cache_dtype: str = "auto", enable_lora: bool = False, max_loras: int = 1,
+                 max_lora_rank: int = 16, limit_mm_per_prompt: Optional[Dict[str, int]] = None) -> FitEstimate:
+    """
+    Estimate the longest context that fits next to the weights in the given amount of VRAM.
+    """
+    overhead = RUNTIME_OVERHEAD_BYTES
+    if enable_lora:
+        overhead += lora_bytes(config, max_loras, max_lora_rank)
+    if limit_mm_per_prompt:
+        overhead += sum(limit_mm_per_prompt.values()) * MM_ACTIVATION_BYTES_PER_ITEM
+
+    per_token = kv_cache_bytes_per_token(config, kv_cache_dtype)
+    native_max_len = get_native_max_model_len(config)
+    kv_budget = max(available_bytes - weight_bytes - overhead, 0)
+    max_len = kv_budget // per_token if per_token else 0
+    if native_max_len:
+        max_len = min(max_len, native_max_len)
+    if max_len > CONTEXT_ALIGNMENT:
+        max_len -= max_len % CONTEXT_ALIGNMENT
+    return FitEstimate(weight_bytes=weight_bytes, kv_bytes_per_token=per_token, overhead_bytes=overhead,
+                       native_max_model_len=native_max_len, max_model_len=int(max_len))
+
+
+def estimate_model_fit(model: str, available_bytes: int, engine_args=None) -> Optional[FitEstimate]:
+    """
+    Estimate the fit of a local model using the LoRA, kv cache and multimodal settings of the engine arguments.
+    :return: the estimate, or None if the model could not be read from disk
+    """
+    try:
+        footprint = read_model_footprint(model, getattr(engine_args, "revision", None))
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        logger.debug(f"Could not read the footprint of {model}: {e}")
+        return None
+    if not footprint:
+        return None
+    config, weight_bytes = footprint
+    return estimate_fit(
+        config, weight_bytes, available_bytes,
+        kv_cache_dtype=getattr(engine_args, "kv_cache_dtype", "auto") or "auto",
+        enable_lora=bool(getattr(engine_args, "enable_lora", False)),
+        max_loras=getattr(engine_args, "max_loras", 1) or 1,
+        max_lora_rank=getattr(engine_args, "max_lora_rank", 16) or 16,
+        limit_mm_per_prompt=getattr(engine_args, "limit_mm_per_prompt", None),
+    )
@@ -0,0 +1,229 @@
+import asyncio
+import concurrent.futures
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from app.utils.definitions import MODEL_PATHS, VALID_EXTENSIONS
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+READ_CHUNK_SIZE = 64 * 1024 * 1024  # 64 MB
+
+
+def get_total_host_memory() -> int:
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def resolve_snapshot(model: str, revision: Optional[str]) -> Optional[str]:
+    """The snapshot of an HF repo in the cache that a revision (a branch, a tag or a commit) points to."""
+    repo_root = os.path.join(MODEL_PATHS, "models--" + model.replace("/", "--"))
+    revision = revision or "main"
+    ref_path = os.path.join(repo_root, "refs", revision)
+    if os.path.isfile(ref_path):
+        with open(ref_path) as f:
+            revision = f.read().strip()
+    snapshot = os.path.join(repo_root, "snapshots", revision)
+    return snapshot if os.path.isdir(snapshot) else None
+
+
+def resolve_weight_files(model: str, revision: Optional[str] = None) -> List[str]:
+    """
+    Resolve a model path, a GGUF file or an HF repo id to the weight files the engine will read.
+    Only the snapshot of the revision is read: the other snapshots and the GGUF variants next to the weights are
+    never opened by the engine, warming them would evict pages that matter.
+    :param revision: the revision of the engine args, the main branch if None
+    """
+    if os.path.isfile(model):
+        return [os.path.realpath(model)]
+    directory = model if os.path.isdir(model) else resolve_snapshot(model, revision)
+    if directory is None:
+        return []
+
+    files = []
+    for file_name in os.listdir(directory):
+        file_path = os.path.join(directory, file_name)
+        # vllm loads a GGUF from its file only, a directory or a repo id is loaded from the other formats
+        if file_name.endswith(VALID_EXTENSIONS) and not file_name.endswith('.gguf') and os.path.isfile(file_path):
+            files.append(file_path)
+
+    # vllm only reads the safetensors when a repo ships both formats
+    safetensors = [file for file in files if file.endswith('.safetensors')]
+    files = safetensors or files
+    # HF snapshots are symlinks to blobs, the page cache is keyed on the blob
+    return sorted({os.path.realpath(file) for file in files})
+
+
+def _cache_key(model: str, revision: Optional[str]) -> Tuple[str, Optional[str]]:
+    """Two revisions of a repo are different weights, a local path has no revision."""
+    if os.path.exists(model):
+        return model, None
+    return model, revision or "main"
+
+
+def _read_into_page_cache(files: List[str]) -> None:
+    buffer = bytearray(READ_CHUNK_SIZE)
+    view = memoryview(buffer)
+    for file_path in files:
+        with open(file_path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while f.readinto(view):
+                pass
+
+
+def _drop_from_page_cache(files: List[str]) -> None:
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for file_path in files:
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+class HostWeightCache:
+    """
+    LRU of recently used model weights kept resident in the host page cache.
+
+    vLLM reads weights through safetensors' mmap (or the GGUF reader), so keeping the files in the page cache is
+    what makes a reload skip the disk. Entries are keyed by (model, revision) and evicted with POSIX_FADV_DONTNEED
+    once the byte budget is exceeded.
+    """
+
+    def __init__(self, budget_bytes: Optional[int] = None):
+        self.budget_bytes = budget_bytes if budget_bytes is not None else get_total_host_memory() // 2
+        self._entries: "OrderedDict[Tuple[str, Optional[str]], List[str]]" = OrderedDict()
+        self._sizes = {}
+        self._loading = {}
+        self._background_reads: "Dict[Tuple[str, Optional[str]], Tuple[List[str], concurrent.futures.Future]]" = {}
+        self._prefetch_tasks: Set[asyncio.Task] = set()
+
+    def set_budget(self, budget_gb: Optional[float]) -> None:
+        """Set the budget in GB, None means half of the host RAM and 0 disables the cache."""
+        self.budget_bytes = int(budget_gb * 1024 ** 3) if budget_gb is not None else get_total_host_memory() // 2
+        self._evict_until(0)
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget_bytes > 0
+
+    @property
+    def used_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def __contains__(self, model: str) -> bool:
+        return any(entry_model == model for entry_model, _ in self._entries)
+
+    def _evict_until(self, needed_bytes: int) -> None:
+        while self._entries and self.used_bytes + needed_bytes > self.budget_bytes:
+            key, files = self._entries.popitem(last=False)
+            self._sizes.pop(key, None)
+            logger.info(f"Evicting {key[0]} ({key[1] or 'local'}) from the host weight cache")
+            _drop_from_page_cache(files)
+
+    async def warm(self, model: str, revision: Optional[str] = None) -> bool:
+        """
+        Make sure the weights of a model are resident in host memory, reading them if needed.
+        :param revision: the revision of the weights when the model is an HF repo id
+        :return: True if the model is resident once the call returns
+        """
+        if not self.enabled or not model:
+            return False
+        key = _cache_key(model, revision)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return True
+        if key in self._loading:  # a prefetch of the same weights is already running
+            await asyncio.shield(self._loading[key])
+            return key in self._entries
+        if key in self._background_reads:  # started by warm_in_background before the event loop existed
+            files, future = self._background_reads.pop(key)
+            try:
+                await asyncio.wrap_future(future)
+            except Exception:
+                self._sizes.pop(key, None)
+                raise
+            self._entries[key] = files
+            return True
+
+        files = await asyncio.to_thread(resolve_weight_files, model, revision)
+        if not files:
+            return False
+        size = sum(os.path.getsize(file) for file in files)
+        if size > self.budget_bytes:
+            logger.info(f"Model {model} ({size / 1024 ** 3:.1f} GB) exceeds the host weight cache budget, "
+                        f"it will be read from disk")
+            return False
+
+        self._evict_until(size)
+        self._sizes[key] = size  # reserve the space while reading
+        logger.info(f"Reading {model} ({size / 1024 ** 3:.1f} GB) into the host weight cache")
+        task = asyncio.ensure_future(asyncio.to_thread(_read_into_page_cache, files))
+        self._loading[key] = task
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            self._sizes.pop(key, None)
+            raise
+        finally:
+            self._loading.pop(key, None)
+        self._entries[key] = files
+        return True
+
+    def warm_in_background(self, model: Optional[str], revision: Optional[str] = None) -> None:
+        """
+        Start reading a model into the page cache from a thread, without an event loop: the launcher calls it before
+        importing vllm, so the disk reads overlap the imports. The next warm of the same weights waits for this read.
+        """
+        if not self.enabled or not model:
+            return
+        key = _cache_key(model, revision)
+        files = resolve_weight_files(model, revision)
+        size = sum(os.path.getsize(file) for file in files)
+        if not files or size > self.budget_bytes or key in self._background_reads:
+            return
+        self._sizes[key] = size
+        future = concurrent.futures.Future()
+
+        def _read():
+            try:
+                _read_into_page_cache(files)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+
+        logger.info(f"Reading {model} ({size / 1024 ** 3:.1f} GB) into the host weight cache while the server starts")
+        threading.Thread(target=_read, name="weight-cache-warm", daemon=True).start()
+        self._background_reads[key] = (files, future)
+
+    def prefetch(self, model: Optional[str], revision: Optional[str] = None) -> None:
+        """Warm a model in the background while the current one keeps serving."""
+        if not self.enabled or not model:
+            return
+        key = _cache_key(model, revision)
+        if key in self._entries or key in self._loading:
+            return
+
+        async def _prefetch():
+            try:
+                await self.warm(model, revision)
+            except Exception as e:
+                logger.error(f"Error while prefetching {model} into the host weight cache: {e}")
+
+        task = asyncio.create_task(_prefetch())
+        self._prefetch_tasks.add(task)
+        task.add_done_callback(self._prefetch_tasks.discard)
+
+
+weight_cache = HostWeightCache()
@@ -1,16 +1,21 @@
 import asyncio
 import json
 import os
-from typing import Union
+from typing import Dict, Union
 
+import cachetools
 import huggingface_hub
 from huggingface_hub import snapshot_download, hf_hub_download
-from vllm.model_executor.models import _MODELS # noqa
 
+from app.utils.definitions import get_vllm_models
 from app.utils.log import setup_custom_logger
+from app.utils.memory.weight_cache import resolve_snapshot
 
 logger = setup_custom_logger(__name__)
 
+REPO_FILES_TTL = 600  # seconds a listing of the files of a repo is reused
+_repo_file_sizes: cachetools.TTLCache = cachetools.TTLCache(maxsize=128, ttl=REPO_FILES_TTL)
+
 
 def download_model(model_name: str, file_variant=None):
     if file_variant:
@@ -19,6 +24,40 @@ def download_model(model_name: str, file_variant=None):
     snapshot_download(repo_id=model_name, token=os.environ.get("PULSAR_HF_TOKEN", None))
 
 
+def get_local_repo_file_sizes(repo_id: str) -> Dict[str, int]:
+    """Return the files of the cached snapshot of a Hugging Face repo with their size, empty if it is not cached."""
+    snapshot = resolve_snapshot(repo_id, None)
+    if snapshot is None:
+        return {}
+    file_sizes = {}
+    for directory, _, file_names in os.walk(snapshot):
+        for file_name in file_names:
+            file_path = os.path.join(directory, file_name)
+            file_sizes[os.path.relpath(file_path, snapshot)] = os.path.getsize(file_path)
+    return file_sizes
+
+
+def get_repo_file_sizes(repo_id: str) -> Dict[str, int]:
+    """
+    Return the files of a Hugging Face repo with their size, without downloading them.
+    The listing is reused for REPO_FILES_TTL seconds, and the cached snapshot answers when the hub is unreachable.
+    """
+    if repo_id in _repo_file_sizes:
+        return _repo_file_sizes[repo_id]
+    try:
+        model_info = huggingface_hub.HfApi().model_info(repo_id, files_metadata=True,
+                                                         token=os.environ.get("PULSAR_HF_TOKEN", None))
+    except OSError as e:  # requests' connection and HTTP errors
+        file_sizes = get_local_repo_file_sizes(repo_id)
+        if not file_sizes:
+            raise
+        logger.warning(f"Could not list the files of {repo_id} on the hub ({e}), using the cached snapshot")
+        return file_sizes
+    file_sizes = {sibling.rfilename: sibling.size or 0 for sibling in model_info.siblings}
+    _repo_file_sizes[repo_id] = file_sizes
+    return file_sizes
+
+
 async def download_and_return_dict(repo_id: str, file: str, token: str) -> Union[dict, str, None]:
     try:
         response = huggingface_hub.hf_hub_download(repo_id=repo_id, filename=file, token=token)
@@ -54,7 +93,7 @@ async def check_file_in_huggingface_repo(user_repo_id,
                 if model_base is None:
                     model_base = response['model_name']
                 model_config = await download_and_return_dict(repo_id=model_base, file="config.json", token=model_token)
-                if model_config['architectures'][0] not in _MODELS.keys():
+                if model_config['architectures'][0] not in get_vllm_models():
                     logger.error(f"Model {user_repo_id} is either not a CausalLM model or it not suppoerted by vllm.")
                     return False
 
@@ -67,7 +106,7 @@ async def check_file_in_huggingface_repo(user_repo_id,
                     model_config = await download_and_return_dict(repo_id=model_name, file="config.json",
                                                                   token=model_token)
 
-                    if model_config['architectures'][0] not in _MODELS.keys():
+                    if model_config['architectures'][0] not in get_vllm_models():
                         logger.error(
                             f"Model {user_repo_id} is either not a CausalLM model or it not suppoerted by vllm.")
                         return False
@@ -101,7 +140,7 @@ async def check_file_in_huggingface_repo(user_repo_id,
             model_arch = model_config.get('architectures', None)
             if model_arch is None:
                 return False
-            if model_arch[0] not in _MODELS.keys():
+            if model_arch[0] not in get_vllm_models():
                 logger.error(
                     f"Model {user_repo_id} is either not a CausalLM model or it not suppoerted by vllm.")
                 return False
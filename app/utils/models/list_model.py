@@ -2,8 +2,8 @@ import asyncio
 import json
 import os
 
-from app.utils.definitions import VALID_EXTENSIONS, MIN_MODEL_SIZE, MIN_LORA_SIZE, _MODELS, MODEL_PATHS, \
-    SUPPORTED_VLLM_ARCHS
+from app.utils.definitions import VALID_EXTENSIONS, MIN_MODEL_SIZE, MIN_LORA_SIZE, MODEL_PATHS, \
+    get_vllm_models, get_supported_vllm_archs
 from app.utils.models.gguf_util import extract_gguf_info_local
 
 
@@ -33,7 +33,7 @@ async def check_vllm_compatibility(config_path):
     try:
         with open(config_path, 'r') as config_file:
             config_data = json.load(config_file)
-        return any(arch in _MODELS.keys() for arch in config_data.get('architectures', []))
+        return any(arch in get_vllm_models() for arch in config_data.get('architectures', []))
     except (json.JSONDecodeError, IOError):
         return False
 
@@ -70,11 +70,11 @@ async def process_model_directory(model_dir, filename=None):
             if isinstance(valid_model, list):
                 # Multiple .gguf files
                 gguf_metadatas = extract_gguf_info_local(valid_model[0])['metadata']
-                if gguf_metadatas.get('general.architecture', None) in SUPPORTED_VLLM_ARCHS:
+                if gguf_metadatas.get('general.architecture', None) in get_supported_vllm_archs():
                     return valid_model
             elif not filename and valid_model.lower().endswith('.gguf'):
                 gguf_metadatas = extract_gguf_info_local(valid_model)['metadata']
-                if gguf_metadatas['general.architecture'] in SUPPORTED_VLLM_ARCHS:
+                if gguf_metadatas['general.architecture'] in get_supported_vllm_archs():
                     return [valid_model]
             elif filename or await check_vllm_compatibility(os.path.join(snapshot_dir, 'config.json')):
                 return [valid_model]
@@ -1,51 +1,154 @@
+import asyncio
 import json
-from typing import Optional
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Tuple
 
 from huggingface_hub import hf_hub_download
-from huggingface_hub.utils import EntryNotFoundError
-from transformers import AutoConfig, AutoTokenizer
+from huggingface_hub.utils import EntryNotFoundError, LocalEntryNotFoundError, RepositoryNotFoundError
 
+from app.utils.definitions import CHAT_TEMPLATE_CACHE_FILE, MODEL_PATHS
+from app.utils.log import setup_custom_logger
 from app.utils.models.list_model import fix_model_name, check_if_path_is_in_hf_format
 
+logger = setup_custom_logger(__name__)
+
+CACHE_PATH = os.path.join(Path(__file__).resolve().parents[3], "configs", CHAT_TEMPLATE_CACHE_FILE)
+# entries whose revision can't be checked locally, and repos without a template, are looked up again after a while
+UNVERIFIED_TTL = 7 * 24 * 3600
+NEGATIVE_TTL = 24 * 3600
+MAX_CHAIN_LENGTH = 8
+
+_file_lock = threading.Lock()
+_cache: Optional[dict] = None
+
+
+def _load_cache() -> dict:
+    global _cache
+    if _cache is None:
+        try:
+            with open(CACHE_PATH) as f:
+                _cache = json.load(f)
+        except FileNotFoundError:
+            _cache = {}
+        except (json.JSONDecodeError, OSError) as e:
+            logger.error(f"Chat template cache could not be read, ignoring it: {e}")
+            _cache = {}
+    return _cache
+
+
+def _save_cache() -> None:
+    tmp_path = f"{CACHE_PATH}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(_cache, f)
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError as e:
+        logger.error(f"Could not save the chat template cache: {e}")
+
+
+def get_local_revision(repo_id: str) -> Optional[str]:
+    """The commit the local HF cache points main to, None if the repo was never downloaded."""
+    ref_path = os.path.join(MODEL_PATHS, "models--" + repo_id.replace("/", "--"), "refs", "main")
+    try:
+        with open(ref_path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _download_json(repo_id: str, file_name: str) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    Download a json file of a repo, returning it with the revision it comes from.
+    :raise LocalEntryNotFoundError: if the hub can't be reached and the file is not in the local cache
+    """
+    try:
+        path = hf_hub_download(repo_id, file_name)
+    except LocalEntryNotFoundError:
+        raise  # offline or a network error, not a missing file: nothing must be cached
+    except EntryNotFoundError:
+        return None, None
+    with open(path) as f:
+        # the file lives in snapshots/<revision>/
+        return json.load(f), os.path.basename(os.path.dirname(path))
+
+
+def _template_from_tokenizer_config(tokenizer_config: dict) -> Optional[str]:
+    template = tokenizer_config.get("chat_template")
+    if isinstance(template, list):  # named templates, i.e. default, tool_use, rag
+        templates = {item.get("name"): item.get("template") for item in template if isinstance(item, dict)}
+        return templates.get("default") or next(iter(templates.values()), None)
+    return template
+
+
+def _fetch_template(repo_id: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Read the chat template of a repo from its tokenizer files, without instantiating the tokenizer.
+    :return: (template, revision, the repo to follow if the template is not there)
+    """
+    tokenizer_config, revision = _download_json(repo_id, "tokenizer_config.json")
+    if tokenizer_config and (template := _template_from_tokenizer_config(tokenizer_config)):
+        return template, revision, None
+    chat_template, template_revision = _download_json(repo_id, "chat_template.json")
+    if chat_template and chat_template.get("chat_template"):
+        return chat_template["chat_template"], template_revision, None
+
+    # adapters point to their base model, fine-tunes (sometimes) to the model they come from
+    adapter_config, adapter_revision = _download_json(repo_id, "adapter_config.json")
+    if adapter_config and adapter_config.get("base_model_name_or_path"):
+        return None, revision or adapter_revision, adapter_config["base_model_name_or_path"]
+    config, config_revision = _download_json(repo_id, "config.json")
+    parent = config.get("_name_or_path") if config else None
+    return None, revision or config_revision, parent if parent != repo_id else None
+
+
+def _get_cached(repo_id: str) -> Optional[dict]:
+    entry = _load_cache().get(repo_id)
+    if not entry:
+        return None
+    age = time.time() - entry["updated_at"]
+    local_revision = get_local_revision(repo_id)
+    if local_revision and entry.get("revision"):
+        if local_revision != entry["revision"]:
+            return None  # the repo was updated, resolve it again
+    elif age > UNVERIFIED_TTL:
+        return None
+    if entry["template"] is None and entry.get("parent") is None and age > NEGATIVE_TTL:
+        return None
+    return entry
+
+
+def resolve_chat_template(repo_id: str) -> Optional[str]:
+    """Follow the adapter / base model chain of a repo until a chat template is found, caching every hop."""
+    seen = set()
+    while repo_id and repo_id not in seen and len(seen) < MAX_CHAIN_LENGTH:
+        seen.add(repo_id)
+        with _file_lock:
+            entry = _get_cached(repo_id)
+        if entry is None:
+            try:
+                template, revision, parent = _fetch_template(repo_id)
+            except LocalEntryNotFoundError as e:
+                logger.warning(f"The hub could not be reached for the tokenizer files of {repo_id}: {e}")
+                return None
+            except (RepositoryNotFoundError, OSError, ValueError) as e:
+                logger.error(f"Could not read the tokenizer files of {repo_id}: {e}")
+                return None
+            entry = {"template": template, "revision": revision, "parent": parent, "updated_at": int(time.time())}
+            with _file_lock:
+                _load_cache()[repo_id] = entry
+                _save_cache()
+        if entry["template"]:
+            return entry["template"]
+        repo_id = entry.get("parent")
+    return None
+
 
 async def maybe_get_chat_template(path: str) -> Optional[str]:
     """Try to infer the chat template from a given model path."""
-    # Try to get the chat template from the tokenizer class
     if not await check_if_path_is_in_hf_format(path):
         # we fix the path name
         path = await fix_model_name(path.split('/')[-1])
-    try:
-        if template:= AutoTokenizer.from_pretrained(path).chat_template:
-            # we return the template if it exists
-            return template
-        config = AutoConfig.from_pretrained(path)
-    except ValueError as e:
-        if 'model_type' in str(e):
-            # if the conf file is not found, we try to download the config file of an adapter
-            try:
-                config_path = hf_hub_download(path, 'adapter_config.json')  # We try to first download the config file of an adapter
-            except EntryNotFoundError:
-                config_path = hf_hub_download(path, 'config.json')
-            config = json.loads(open(config_path).read())
-        else:
-            # if the config file is not found, we return None
-            return None
-
-    if isinstance(config, dict) and 'base_model_name_or_path' in config:
-        template = AutoTokenizer.from_pretrained(config['base_model_name_or_path']).chat_template
-        if template:
-            return template
-
-        old_model_name = config['base_model_name_or_path']
-        config = json.loads(open(hf_hub_download(config['base_model_name_or_path'], 'config.json')).read())
-
-        while '_name_or_path' in config and old_model_name != config['_name_or_path']:
-            # We try to recursively find the chat template
-            template = AutoTokenizer.from_pretrained(config['_name_or_path']).chat_template
-            if template:
-                return template
-            config = json.loads(open(hf_hub_download(config['_name_or_path'], 'config.json')).read())
-            old_model_name = config['_name_or_path']
-
-    return None
-
+    return await asyncio.to_thread(resolve_chat_template, path)
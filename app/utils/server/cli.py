@@ -0,0 +1,94 @@
+import argparse
+import hashlib
+import importlib.metadata
+import os
+import sys
+from pathlib import Path
+from typing import List, Optional
+
+ROOT_PATH = Path(__file__).resolve().parents[3]
+HELP_CACHE_PATH = os.path.join(ROOT_PATH, "configs", "cli_help.txt")
+# the sources the help text is built from, a change to any of them rebuilds it
+HELP_SOURCES = (Path(__file__).resolve(), ROOT_PATH / "app" / "hijacks" / "vllm.py")
+
+
+def add_pulsar_arguments(parser):
+    """
+    Add the Pulsar specific arguments to a parser
+    :param parser:
+    :return:
+    """
+    parser.description = "vLLM Based OpenAI-Compatible RESTful API server By AstraMind AI"
+    parser.add_argument("--auto-quantized-fallback", type=bool, default=True,
+                        help="Automatically pick a quantized model if the model is too big")
+    parser.add_argument("--quant-type-preference", type=str, default="GPTQ",
+                        help="The preference for quantization types, either GPTQ or AWQ")
+    parser.add_argument("--use-config-file", type=bool, default=True, help="Whether to use a server config file")
+    parser.add_argument("--server-config-file", type=str, default="last.yml",
+                        help="The path to the server configuration file")
+    parser.add_argument("--enable-tts", type=bool, default=False, help="Whether to enable TTS")
+    parser.add_argument("--enable-txt2img", type=bool, default=False, help="Whether to enable txt2img")
+    return parser
+
+
+def make_server_parser():
+    """The full parser of the server, the vLLM engine arguments included. Building it imports vllm."""
+    from vllm.entrypoints.openai.cli_args import make_arg_parser
+    from vllm.utils import FlexibleArgumentParser
+    from app.hijacks.vllm import astra_parser_wrapper
+    parser = FlexibleArgumentParser(
+        description="Pulsar Application backed by a vLLM OpenAI-Compatible RESTful API server.")
+    parser = make_arg_parser(parser)
+    return astra_parser_wrapper(parser)
+
+
+def get_help_cache_key() -> Optional[str]:
+    """The vllm version and the parser sources the help was built from, None if vllm is not installed."""
+    try:
+        key = hashlib.sha256(importlib.metadata.version("vllm").encode())
+    except importlib.metadata.PackageNotFoundError:
+        return None
+    for source in HELP_SOURCES:
+        key.update(source.read_bytes())
+    return key.hexdigest()
+
+
+def print_help() -> None:
+    """
+    Print the help of the full parser. Building it imports vllm, which takes seconds, so the text is kept in a file
+    keyed on the vllm version and the parser sources: only the first --help after an update pays for the import.
+    """
+    key = get_help_cache_key()
+    if key and os.path.isfile(HELP_CACHE_PATH):
+        with open(HELP_CACHE_PATH) as f:
+            cached_key, _, help_text = f.read().partition("\n")
+        if cached_key == key:
+            sys.stdout.write(help_text)
+            return
+    help_text = make_server_parser().format_help()
+    if key:
+        with open(HELP_CACHE_PATH, "w") as f:
+            f.write(f"{key}\n{help_text}")
+    sys.stdout.write(help_text)
+
+
+def _dashed(arg: str) -> str:
+    if not arg.startswith("--"):
+        return arg
+    name, separator, value = arg.partition("=")
+    return name.replace("_", "-") + separator + value
+
+
+def parse_pulsar_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Parse the Pulsar arguments without importing vllm, the engine arguments are read from the config file.
+    --help prints the help of the full parser and exits.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if {"-h", "--help"} & set(argv):
+        print_help()
+        sys.exit(0)
+    # same spelling as vllm's FlexibleArgumentParser, the restarter passes --use_config_file
+    argv = [_dashed(arg) for arg in argv]
+    parser = add_pulsar_arguments(argparse.ArgumentParser(add_help=False))
+    return parser.parse_known_args(argv)[0]
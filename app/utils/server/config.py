@@ -1,25 +1,32 @@
-from transformers.testing_utils import get_gpu_count
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import yaml
-from app.utils.memory.cuda_mem import  get_free_cuda_memory
-
-template = {
-    "host": '0.0.0.0',
-    "port": 40000,
-    "uvicorn_log_level": "info",
-    "allow_credentials": False,
-    "allowed_origins": ["*"],
-    "allowed_methods": ["*"],
-    "allowed_headers": ["*"],
-    "trust_remote_code": True,
-    "tensor_parallel_size": get_gpu_count(),
-    "enforce_eager": get_free_cuda_memory() < 16 * 1024 ** 3,
-    "engine_use_ray": get_gpu_count() > 1,
-    "auto_quantized_fallback": True,
-    "quant_type_preference": "GPTQ",
-    "enable_tts": False,
-    "tts_model": None,
-}
+from app.utils.memory.cuda_mem import get_free_cuda_memory, get_gpu_count
+from app.utils.memory.estimator import estimate_fit
+
+
+def get_template():
+    # built on demand, querying the GPUs at import time made every import of this module initialize CUDA
+    gpu_count = get_gpu_count()
+    return {
+        "host": '0.0.0.0',
+        "port": 40000,
+        "uvicorn_log_level": "info",
+        "allow_credentials": False,
+        "allowed_origins": ["*"],
+        "allowed_methods": ["*"],
+        "allowed_headers": ["*"],
+        "trust_remote_code": True,
+        "tensor_parallel_size": gpu_count,
+        "enforce_eager": get_free_cuda_memory() < 16 * 1024 ** 3,
+        "engine_use_ray": gpu_count > 1,
+        "auto_quantized_fallback": True,
+        "quant_type_preference": "GPTQ",
+        "enable_tts": False,
+        "tts_model": None,
+    }
 
 models = {
     "roleplay": {
@@ -63,7 +70,37 @@ models = {
 }
 
 
-def get_model_choice():
+MIN_CHOICE_CONTEXT = 8192
+CONFIG_DOWNLOAD_WORKERS = 8
+
+
+def _download_config(model):
+    from huggingface_hub import hf_hub_download
+    try:
+        with open(hf_hub_download(model, "config.json")) as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def download_configs(models):
+    """Fetch the config.json of the candidates at once, one round trip to the hub per model in a row was slow."""
+    with ThreadPoolExecutor(max_workers=min(len(models), CONFIG_DOWNLOAD_WORKERS) or 1) as executor:
+        return dict(zip(models, executor.map(_download_config, models)))
+
+
+def fits_in_memory(model, required_memory, available_memory, config=None, kv_cache_dtype="auto"):
+    # required_memory is the size of the weights in GB, the kv cache is estimated from the model config
+    # config is the config.json of the model, None if it could not be fetched
+    # the kv cache dtype must be the one the engine will run with, the generated config leaves it to "auto"
+    if config is None:
+        return available_memory >= (
+        required_memory * 1024 ** 3 * 1.5 if required_memory < 12 else required_memory * 1024 ** 3 + 4096)  # we multiply by 1024**3 to convert from GB to bytes and times 1.5 to leave space for KV Cache
+    estimate = estimate_fit(config, int(required_memory * 1024 ** 3), available_memory, kv_cache_dtype=kv_cache_dtype)
+    return estimate.max_model_len >= min(MIN_CHOICE_CONTEXT, estimate.native_max_model_len or MIN_CHOICE_CONTEXT)
+
+
+def get_model_choice(kv_cache_dtype="auto"):
     use_type = os.environ.get('PRIMARY_USE', "general")
     is_adult_content = os.environ.get('IS_ADULT_CONTENT', "False") == 'True'
     available_memory = get_free_cuda_memory()
@@ -74,17 +111,17 @@ def get_model_choice():
         raise ValueError(f"Invalid use type or content type: {use_type}, {content_type}")
 
     suitable_models = models[use_type][content_type]
+    configs = download_configs(list(suitable_models))
 
     for model, required_memory in sorted(suitable_models.items(), key=lambda x: x[1], reverse=True):
-        if available_memory >= (
-        required_memory * 1024 ** 3 * 1.5 if required_memory < 12 else required_memory * 1024 ** 3 + 4096):  # we multiply by 1024**3 to convert from GB to bytes and times 1.5 to leave space for KV Cache
+        if fits_in_memory(model, required_memory, available_memory, configs[model], kv_cache_dtype):
             return model
 
     raise ValueError("No suitable model found for the available memory, try closing some applications that are using gpu memory")
 
 
 def generate_yaml_entry(path):
-    config = template.copy()
+    config = get_template()
     chosen_model = get_model_choice()
     config['model'] = chosen_model
     config['tokenizer'] = chosen_model
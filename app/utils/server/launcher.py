@@ -0,0 +1,31 @@
+import os
+
+import yaml
+
+from app.utils.log import setup_custom_logger
+from app.utils.memory.weight_cache import weight_cache
+from app.utils.server.cli import parse_pulsar_args
+
+logger = setup_custom_logger(__name__)
+
+
+def prepare_launch(config_path: str) -> None:
+    """
+    The part of the start that needs neither vllm nor the routers, run by server.py before importing them.
+    --help answers from the cached help, a missing config is generated, and the weights of the configured model start
+    streaming into the page cache while vllm and the routers are imported: on a start or a restart the engine then
+    finds them resident instead of reading them once the imports are over.
+    :param config_path: the server config the engine will be loaded from
+    """
+    parse_pulsar_args()
+    if not os.path.exists(config_path):
+        from app.utils.server.config import generate_yaml_entry
+        generate_yaml_entry(config_path)
+
+    try:
+        with open(config_path) as f:
+            config = yaml.safe_load(f) or {}
+        weight_cache.set_budget(config.get("weight_cache_budget_gb"))
+        weight_cache.warm_in_background(config.get("model"), config.get("revision"))
+    except (OSError, yaml.YAMLError) as e:
+        logger.error(f"Could not start reading the model weights early: {e}")
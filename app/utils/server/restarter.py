@@ -1,12 +1,81 @@
+import asyncio
 import os
 import sys
 from time import sleep
+from typing import Awaitable, Callable, List, Optional
 
+from app.utils.log import setup_custom_logger
 
-def restart(server_conf=None, dont_save_config: bool = False):
-    if server_conf and dont_save_config==False:
-        server_conf.save_to_yaml()
+logger = setup_custom_logger(__name__)
+
+SHUTDOWN_HOOKS_TIMEOUT = 60  # seconds given to the hooks before the process is replaced anyway
+
+_shutdown_hooks: List[Callable[[], Awaitable]] = []
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_restart_task: Optional[asyncio.Task] = None
+
+
+def register_shutdown_hook(hook: Callable[[], Awaitable]) -> None:
+    """
+    Run an async hook on shutdown and before a restart replaces the process, i.e. to write the queued chat messages:
+    os.execv skips the lifespan of the server. Must be called from the event loop, the hooks run in registration order.
+    """
+    global _loop
+    _loop = asyncio.get_running_loop()
+    _shutdown_hooks.append(hook)
+
+
+async def run_shutdown_hooks() -> None:
+    """Run the registered hooks once, a failing hook does not stop the others."""
+    while _shutdown_hooks:
+        hook = _shutdown_hooks.pop(0)
+        try:
+            await hook()
+        except Exception as e:
+            logger.error(f"Error in a shutdown hook: {e}")
+
+
+async def _run_hooks_with_timeout() -> None:
+    try:
+        await asyncio.wait_for(run_shutdown_hooks(), SHUTDOWN_HOOKS_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"The shutdown hooks did not finish within {SHUTDOWN_HOOKS_TIMEOUT}s, restarting anyway")
+
+
+def _exec() -> None:
     sleep(0.3)
     arguments = [sys.argv[0]]
     arguments.extend(['--use_config_file', "True", '--server_config_file', 'last.yml'])
     os.execv(sys.executable, ['python3'] + arguments)
+
+
+async def _run_hooks_and_exec() -> None:
+    await _run_hooks_with_timeout()
+    _exec()
+
+
+def restart(server_conf=None, dont_save_config: bool = False):
+    """
+    Replace the process with a new server, once the shutdown hooks are done.
+    Called from the event loop it can't block on the hooks: it returns and the process is replaced as soon as they
+    are done. Called from another thread it blocks until then.
+    """
+    global _restart_task
+    if server_conf and dont_save_config==False:
+        server_conf.save_to_yaml()
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+
+    if running_loop is not None and running_loop is _loop:
+        if _restart_task is None:
+            logger.info("Restarting the server once the queued work is written")
+            _restart_task = running_loop.create_task(_run_hooks_and_exec())
+        return
+    if _loop is not None and _loop.is_running():
+        try:
+            asyncio.run_coroutine_threadsafe(_run_hooks_with_timeout(), _loop).result()
+        except Exception as e:
+            logger.error(f"Could not run the shutdown hooks before restarting: {e}")
+    _exec()
@@ -0,0 +1,98 @@
+import asyncio
+import time
+from typing import Awaitable, Dict, Optional, Set, Tuple
+
+from app.utils.log import setup_custom_logger
+
+logger = setup_custom_logger(__name__)
+
+STAGES = ("update_check", "database", "model_scan", "engine", "server", "tunnel")
+
+# the stages each endpoint needs, the first matching prefix wins, everything else only needs the database
+STAGE_GATES: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ("/versions", ()),
+    ("/metrics", ()),
+    ("/health", ("engine",)),
+    ("/tokenize", ("engine",)),
+    ("/detokenize", ("engine",)),
+    ("/v1/", ("database", "engine")),
+    ("/abort/", ("engine",)),
+    ("/personality/create", ("database", "engine")),
+    ("/lora/load", ("database", "engine")),
+    ("/lora/unload", ("database", "engine")),
+    ("/get_app_init_config", ("database", "model_scan")),
+    ("/model/", ("database", "model_scan", "engine")),
+)
+DEFAULT_GATE = ("database",)
+
+
+class StartupOrchestrator:
+    """
+    Runs the independent startup stages concurrently and lets requests wait only for the stages they depend on.
+
+    The update check runs in a thread, the database migrations and the HF cache scan run while the engine is loading
+    and uvicorn accepts connections from the start, the tunnel is opened once the engine and the server are up.
+    """
+
+    def __init__(self):
+        self._done: Dict[str, asyncio.Event] = {stage: asyncio.Event() for stage in STAGES}
+        self._errors: Dict[str, BaseException] = {}
+        self._durations: Dict[str, float] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self, stage: str, coro: Awaitable) -> asyncio.Task:
+        """Run a stage in the background, marking it as done when it completes, even if it fails."""
+
+        async def _run():
+            start = time.perf_counter()
+            try:
+                await coro
+            except Exception as e:
+                self._errors[stage] = e
+                logger.error(f"Startup stage {stage} failed: {e}")
+                raise
+            finally:
+                self._durations[stage] = time.perf_counter() - start
+                self.mark_done(stage)
+            logger.info(f"Startup stage {stage} done in {self._durations[stage]:.2f}s")
+
+        task = asyncio.create_task(_run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def mark_done(self, stage: str) -> None:
+        self._done[stage].set()
+
+    def is_done(self, stage: str) -> bool:
+        return self._done[stage].is_set()
+
+    def get_error(self, stage: str) -> Optional[BaseException]:
+        return self._errors.get(stage)
+
+    async def wait_for(self, *stages: str, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the given stages.
+        :return: False if the timeout expired or one of the stages failed
+        """
+        try:
+            await asyncio.wait_for(asyncio.gather(*(self._done[stage].wait() for stage in stages)), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return not any(stage in self._errors for stage in stages)
+
+    @staticmethod
+    def get_required_stages(path: str) -> Tuple[str, ...]:
+        for prefix, stages in STAGE_GATES:
+            if path.startswith(prefix):
+                return stages
+        return DEFAULT_GATE
+
+    def describe(self) -> Dict[str, Dict]:
+        return {stage: {"done": self.is_done(stage),
+                        "seconds": round(self._durations[stage], 3) if stage in self._durations else None,
+                        "error": str(self._errors[stage]) if stage in self._errors else None}
+                for stage in STAGES}
+
+
+startup = StartupOrchestrator()
@@ -43,22 +43,30 @@ def git_pull():
         return False
 
 
-def check_and_update():
+def find_update():
+    """
+    Compare the local version with the latest release.
+    :return: the latest version if it is newer, None otherwise
+    """
     current_version = get_current_version()
     if current_version is None:
         logger.error("Unable to determine current version. Exiting.")
-        return
+        return None
 
     latest_version = get_latest_release_version()
     if latest_version is None:
-        return
+        return None
 
     logger.info(f"Current version: {current_version}")
     logger.info(f"Latest available version: {latest_version}")
 
     if version.parse(latest_version) > version.parse(current_version):
         logger.info(f"New version available: {latest_version}")
-        if git_pull():
-            restart(dont_save_config=True)
-    else:
-        logger.info("No update available")
+        return latest_version
+    logger.info("No update available")
+    return None
+
+
+def check_and_update():
+    if find_update() and git_pull():
+        restart(dont_save_config=True)
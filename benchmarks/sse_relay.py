@@ -0,0 +1,77 @@
+"""
+Microbenchmark of the SSE relay of WrappedStreamingResponse: chunks/s for a long streamed response, compared with the
+previous relay (json.loads + json.dumps to set the id, a second json.loads and string concatenation to accumulate).
+
+    python -m benchmarks.sse_relay --tokens 20000
+"""
+import argparse
+import json
+import time
+from types import SimpleNamespace
+
+from app.hijacks.starlette import WrappedStreamingResponse
+
+
+def make_chunks(tokens: int):
+    chunks = []
+    for i in range(tokens):
+        chunk = {"id": "chat-5c1f0f6bd4a04f6c9d1e4f0b7a2c3d4e", "object": "chat.completion.chunk",
+                 "created": 1729000000, "model": "meta-llama/Meta-Llama-3.1-8B-Instruct",
+                 "choices": [{"index": 0, "delta": {"content": f" token{i}"}, "logprobs": None,
+                              "finish_reason": None}]}
+        chunks.append(f"data: {json.dumps(chunk, separators=(',', ':'))}\n\n")
+    chunks.append("data: [DONE]\n\n")
+    return chunks
+
+
+def legacy_relay(chunks, chat_id, response_id):
+    accumulated_content = ""
+    for chunk in chunks:
+        parts = chunk.split("data: ")
+        if len(parts) >= 2 and parts[1].strip() != "[DONE]":
+            data = json.loads(parts[1])
+            data['chat_id'] = chat_id
+            data['id'] = response_id
+            chunk = f"data: {json.dumps(data)}\n\n"
+        decoded_chunk = chunk.encode().decode()
+        content = decoded_chunk[6:].strip()
+        if content != "[DONE]":
+            data = json.loads(content)
+            accumulated_content += data['choices'][0]['delta'].get('content', '')
+    return accumulated_content
+
+
+def relay(chunks, chat_id, response_id):
+    response = WrappedStreamingResponse.__new__(WrappedStreamingResponse)
+    response.chat = SimpleNamespace(id=chat_id)
+    response.response_id = response_id
+    response._content_parts = []
+    response._id_field = f'{{"id":{json.dumps(response_id)},"chat_id":{json.dumps(chat_id)}'
+    for chunk in chunks:
+        response.relay_chunk(chunk).encode()
+    return response.accumulated_content
+
+
+def bench(name, func, chunks, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        content = func(chunks, "chat-id", "response-id")
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<8} {len(chunks) / best:>12,.0f} chunks/s  ({best * 1000:.1f} ms, {len(content)} chars)")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=20000, help="number of streamed chunks")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per relay, the best one is kept")
+    args = parser.parse_args()
+    chunks = make_chunks(args.tokens)
+    legacy = bench("legacy", legacy_relay, chunks, args.repeat)
+    current = bench("current", relay, chunks, args.repeat)
+    print(f"speedup  {legacy / current:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
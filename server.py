@@ -2,16 +2,22 @@ from dotenv import load_dotenv, set_key
 
 load_dotenv()
 
+import os
+
 from app.utils.definitions import CONF_FILE
+
+if __name__ == "__main__":
+    # before vllm and the routers are imported: --help, the config generation and the early weight read
+    from app.utils.server.launcher import prepare_launch
+    prepare_launch(os.path.join(os.path.dirname(__file__), "configs", CONF_FILE))
+
 from app.utils.formatting.pydantic.request import EnvVar
-from app.utils.server.config import generate_yaml_entry
-from app.utils.server.restarter import restart
+from app.utils.server.restarter import restart, register_shutdown_hook, run_shutdown_hooks
 
 import asyncio
 import importlib
 import inspect
 import logging
-import os
 import re
 import uuid
 from contextlib import asynccontextmanager
@@ -30,11 +36,10 @@ from prometheus_client import make_asgi_app
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.routing import Mount
 from vllm import AsyncLLMEngine
-from vllm.entrypoints.openai.cli_args import make_arg_parser
 from vllm.usage.usage_lib import UsageContext
-from vllm.utils import FlexibleArgumentParser
 
 from app.api.authorization import router as auth_router
+from app.api.batches import router as batch_router
 from app.api.chats import router as chat_router
 from app.api.loras import router as lora_router
 from app.api.models import router as model_router
@@ -43,21 +48,29 @@ from app.api.personas import router as persona_router
 from app.api.reverse_proxy import router as reverse_proxy_router
 from app.api.open_ai import router as openai_router, load_serving_entrypoints
 
+from app.core.admission import AdmissionRejected
 from app.core.engine import initialize_engine, create_serving_instances
 from app.core.error_checking.health_monitoring import setup_server_monitoring
-from app.db.auth.auth_db import get_current_user, ensure_local_request
-from app.db.db_setup import init_db
+from app.db.auth.auth_db import get_current_user, ensure_local_request, get_user
+from app.db.chat.message_writer import message_writer
+from app.db.db_setup import init_db, post_creation_task, SessionLocal
 from app.db.lora.lora_db import get_lora_list
 from app.db.model.auth import User
 from app.db.personality.personality_db import get_user_personality_list
 from app.db.tokens.db_token import set_local_url_online
 from app.hijacks.openai import ExtendedOpenAIServingChat
-from app.hijacks.vllm import astra_parser_wrapper, ExtendedAsyncCompleteServerArgs
+from app.hijacks.vllm import ExtendedAsyncCompleteServerArgs
 from app.middlewares.model_loader_block import BlockRequestsMiddleware
+from app.middlewares.startup_gate import StartupGateMiddleware
 from app.tunneling.tunnel_manager import start_tunnel_after_server
 from app.utils.database.get import get_db
+from app.services.batch_jobs.runner import batch_job_runner
+from app.utils.formatting.chat.summerizer import title_summarizer
 from app.utils.log import setup_custom_logger
-from app.utils.server.updater import check_and_update, get_current_version
+from app.utils.memory.weight_cache import weight_cache
+from app.utils.server.cli import make_server_parser
+from app.utils.server.startup import startup
+from app.utils.server.updater import find_update, get_current_version, git_pull
 
 openai_serving_chat: Optional[ExtendedOpenAIServingChat] = None
 async_engine: Optional[AsyncLLMEngine] = None
@@ -83,15 +96,31 @@ async def lifespan(app: fastapi.FastAPI):
     async def _force_log():
         while True:
             await asyncio.sleep(10)
-            await async_engine.do_log_stats()
+            if async_engine:
+                await async_engine.do_log_stats()
 
-    from app.core.engine import openai_serving_chat as _openai_serving_chat, async_engine as _async_engine
-    openai_serving_chat, async_engine = _openai_serving_chat, _async_engine
+    async def _scan_models():
+        if not await startup.wait_for("database"):
+            raise RuntimeError("The database could not be initialized")
+        await post_creation_task()
+
+        # warm the models the users were last on, so switching back to them does not hit the disk
+        async with SessionLocal() as session:
+            for user in await get_user(session, return_all=True):
+                if user.last_model and user.last_model != eng_args.model:
+                    weight_cache.prefetch(user.last_model)
 
     monitor = await setup_server_monitoring()    # start the health monitoring
 
+    # the database and the HF cache scan run while the engine is loading, requests wait for what they need
+    startup.start("database", init_db(scan_models=False))
+    startup.start("model_scan", _scan_models())
+    batch_job_runner.resume()  # the jobs wait for the engine
 
-    await init_db()
+    # on shutdown and before a restart replaces the process, in this order
+    register_shutdown_hook(batch_job_runner.close)  # resumed from its output on the next start
+    register_shutdown_hook(title_summarizer.close)
+    register_shutdown_hook(message_writer.close)  # write the chat messages still queued
 
     if eng_args.disable_log_stats:
         task = asyncio.create_task(_force_log())
@@ -101,10 +130,12 @@ async def lifespan(app: fastapi.FastAPI):
     yield
 
     monitor.stop_monitoring()
+    await run_shutdown_hooks()
 
 
 app = fastapi.FastAPI(lifespan=lifespan)
 app.add_middleware(BlockRequestsMiddleware) # Block requests when new model is loading
+app.add_middleware(StartupGateMiddleware) # Hold requests until the startup stages they depend on are done
 # Add prometheus asgi middleware to route /metrics requests
 route = Mount("/metrics", make_asgi_app())
 # Workaround for 307 Redirect for /metrics
@@ -120,13 +151,11 @@ app.include_router(lora_router)
 app.include_router(chat_router)
 app.include_router(reverse_proxy_router)
 app.include_router(openai_router)
+app.include_router(batch_router)
 
 
 def parse_args():
-    parser = FlexibleArgumentParser(
-        description="Pulsar Application backed by a vLLM OpenAI-Compatible RESTful API server.")
-    parser = make_arg_parser(parser)
-    parser = astra_parser_wrapper(parser)
+    parser = make_server_parser()
     parsed_args = parser.parse_args()
     parsed_args.enforce_eager = True
     return parsed_args
@@ -149,6 +178,14 @@ async def validation_exception_handler(_, exc):
     return JSONResponse(err.model_dump(), status_code=HTTPStatus.BAD_REQUEST)
 
 
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(_, exc: AdmissionRejected):
+    err = openai_serving_chat.create_error_response(message=str(exc), err_type="RateLimitError",
+                                                    status_code=HTTPStatus.TOO_MANY_REQUESTS)
+    return JSONResponse({**err.model_dump(), "queue_position": exc.queue_position},
+                        status_code=HTTPStatus.TOO_MANY_REQUESTS, headers={"Retry-After": str(exc.retry_after)})
+
+
 @app.get("/health")
 async def health() -> Response:
     """Health check."""
@@ -214,10 +251,34 @@ async def show_version():
     return JSONResponse(content=ver)
 
 
+async def start_engine(engine_args, server_args):
+    global openai_serving_chat, async_engine
+    await initialize_engine(engine_args, UsageContext.OPENAI_API_SERVER)
+    create_serving_instances(engine_args.served_model_name, server_args)
+    load_serving_entrypoints()
+    from app.core.engine import openai_serving_chat as _openai_serving_chat, async_engine as _async_engine
+    openai_serving_chat, async_engine = _openai_serving_chat, _async_engine
+
+
+async def update_after_startup():
+    """
+    Check for an update while the server starts, but only pull and restart once the other stages are over: a pull
+    while they run would change the code under the lazy imports and the restart would kill a half loaded engine or
+    interrupt the migrations.
+    """
+    if not await asyncio.to_thread(find_update):
+        return
+    await startup.wait_for("database", "model_scan", "engine")
+    if await asyncio.to_thread(git_pull):
+        restart(dont_save_config=True)
+
+
 async def main():
-    check_and_update()
+    # the update check calls GitHub, it must not delay the engine
+    startup.start("update_check", update_after_startup())
     global eng_args
     if not os.path.exists(os.path.join(CONFIG_FILE_PATH, CONF_FILE)):
+        from app.utils.server.config import generate_yaml_entry
         generate_yaml_entry(os.path.join(CONFIG_FILE_PATH, CONF_FILE))
 
     server_args = ExtendedAsyncCompleteServerArgs.from_yaml(CONF_FILE)
@@ -250,10 +311,6 @@ async def main():
     logger.info("vLLM API server version %s", vllm.__version__)
     logger.info("server args: %s", server_args)
 
-    # Initialize and passing the engine to the global variable
-    await initialize_engine(eng_args, UsageContext.OPENAI_API_SERVER)
-    create_serving_instances(eng_args.served_model_name, server_args)
-    load_serving_entrypoints()
     config = uvicorn.Config(
         app,  # Assicurati che questo corrisponda al nome del tuo file e dell'istanza FastAPI
         host=server_args.host,
@@ -269,15 +326,25 @@ async def main():
         limit_max_requests=10000)  # Imposta un limite alto per le richieste massime)
     server = uvicorn.Server(config)
 
-    # Start the server in a separate task
+    # Start the server in a separate task, requests are held by StartupGateMiddleware until the engine is up
     server_task = asyncio.create_task(server.serve())
+    # Initialize and passing the engine to the global variable
+    engine_task = startup.start("engine", start_engine(eng_args, server_args))
 
     # Wait for the server to start
     while not server.started:
         await asyncio.sleep(0.1)
+    startup.mark_done("server")
 
-    # Start tunneling after the server is up
-    await start_tunnel_after_server(server_args)
+    try:
+        await engine_task
+    except Exception:
+        server.should_exit = True
+        await server_task
+        raise
+
+    # Start tunneling after the server and the engine are up
+    await startup.start("tunnel", start_tunnel_after_server(server_args))
 
     # Wait for the server task to complete
     await server_task
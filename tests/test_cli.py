@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from app.utils.server.cli import parse_pulsar_args
+
+ROOT_PATH = Path(__file__).resolve().parents[1]
+HEAVY_MODULES = ("vllm", "torch", "transformers", "fastapi", "sqlalchemy")
+
+
+def test_launcher_does_not_import_the_heavy_dependencies():
+    # server.py runs the launcher before importing vllm and the routers, it must stay cheap
+    code = ("import sys, app.utils.server.launcher; "
+            f"print(' '.join(module for module in {HEAVY_MODULES!r} if module in sys.modules))")
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT_PATH, capture_output=True, text=True,
+                            env={**os.environ, "SECRET_KEY": "test"})
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == ""
+
+
+def test_parse_pulsar_args_accepts_the_restarter_spelling():
+    args = parse_pulsar_args(["--use_config_file", "True", "--server_config_file=other.yml", "--model", "some/model"])
+    assert args.use_config_file is True
+    assert args.server_config_file == "other.yml"
@@ -0,0 +1,69 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("torch")
+
+from app.core import fit_profile  # noqa: E402
+from app.core.fit_profile import (apply_fit_profile, forget_fit_profile, get_profile_key,  # noqa: E402
+                                  load_fit_profile, save_fit_profile)
+
+
+@pytest.fixture(autouse=True)
+def profile_path(tmp_path, monkeypatch):
+    path = tmp_path / "fit_profiles.json"
+    monkeypatch.setattr(fit_profile, "PROFILE_PATH", str(path))
+    monkeypatch.setattr(fit_profile, "get_gpu_signature", lambda: "1xTest GPU@24GB")
+    return path
+
+
+def make_args(**overrides):
+    args = dict(model="org/model", tokenizer=None, kv_cache_dtype="auto", max_model_len=None,
+                gpu_memory_utilization=0.9, swap_space=4, enable_lora=False, max_loras=1, max_lora_rank=16,
+                limit_mm_per_prompt=None, chat_template=None)
+    args.update(overrides)
+    return SimpleNamespace(**args)
+
+
+def test_profile_key_changes_with_what_sizes_the_engine():
+    key = get_profile_key(make_args())
+    assert key == get_profile_key(make_args())
+    assert key != get_profile_key(make_args(model="org/other"))
+    assert key != get_profile_key(make_args(kv_cache_dtype="fp8"))
+    assert key != get_profile_key(make_args(max_model_len=8192))
+
+
+def test_saved_profile_is_loaded_back_for_the_original_arguments():
+    requested = make_args()
+    key = get_profile_key(requested)
+    fitted = make_args(max_model_len=4096, gpu_memory_utilization=0.85)
+    save_fit_profile(key, fitted)
+
+    profile = load_fit_profile(requested)
+    assert profile["max_model_len"] == 4096
+    apply_fit_profile(requested, profile)
+    assert requested.max_model_len == 4096
+    assert requested.gpu_memory_utilization == 0.85
+
+
+def test_apply_fit_profile_only_sets_the_profiled_fields():
+    args = make_args()
+    apply_fit_profile(args, {"max_model_len": 2048, "model": "org/other"})
+    assert args.max_model_len == 2048
+    assert args.model == "org/model"
+
+
+def test_forgotten_profile_is_not_loaded(profile_path):
+    args = make_args()
+    key = get_profile_key(args)
+    save_fit_profile(key, make_args(max_model_len=4096))
+    forget_fit_profile(key)
+    assert load_fit_profile(args) is None
+    assert json.loads(profile_path.read_text()) == {}
+
+
+def test_missing_or_corrupt_profiles_are_ignored(profile_path):
+    assert load_fit_profile(make_args()) is None
+    profile_path.write_text("{not json")
+    assert load_fit_profile(make_args()) is None
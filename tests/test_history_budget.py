@@ -0,0 +1,62 @@
+import json
+
+from app.utils.formatting.chat.history_budget import count_content_tokens, fit_history_to_budget
+
+
+class WordTokenizer:
+    """One token per word."""
+
+    def encode(self, text, add_special_tokens=True):
+        return text.split()
+
+
+def count_words(message):
+    return len(message["content"].split())
+
+
+def make_chat(turns):
+    messages = [{"role": "system", "content": "be nice"}]
+    for question, answer in turns:
+        messages.append({"role": "user", "content": question})
+        messages.append({"role": "assistant", "content": answer})
+    return messages
+
+
+def test_history_that_fits_is_kept_whole():
+    messages = make_chat([("one two", "three"), ("four", "five six")])
+    assert fit_history_to_budget(messages, 100, count_words) == messages
+
+
+def test_oldest_turns_are_dropped_first():
+    messages = make_chat([("a b c d", "e f g h"), ("i j", "k l"), ("m", "n")])
+    # system 2 + last turn 2 + middle turn 4 fit in 9, the first turn of 8 doesn't
+    assert fit_history_to_budget(messages, 9, count_words) == messages[:1] + messages[3:]
+
+
+def test_system_prompt_and_last_turn_are_kept_over_budget():
+    messages = make_chat([("a b", "c d"), ("e f g h i j", "k l m n")])
+    assert fit_history_to_budget(messages, 1, count_words) == messages[:1] + messages[3:]
+
+
+def test_kept_history_starts_with_a_user_message():
+    messages = make_chat([("a", "b c d"), ("e", "f")])
+    kept = fit_history_to_budget(messages, 5, count_words)
+    assert [message["role"] for message in kept] == ["system", "user", "assistant"]
+
+
+def test_only_system_messages_are_returned_unchanged():
+    messages = [{"role": "system", "content": "a b c"}]
+    assert fit_history_to_budget(messages, 0, count_words) == messages
+
+
+def test_count_content_tokens_of_text():
+    assert count_content_tokens(WordTokenizer(), "one two three") == 3
+    assert count_content_tokens(WordTokenizer(), "") == 0
+    assert count_content_tokens(WordTokenizer(), None) == 0
+
+
+def test_count_content_tokens_counts_only_the_text_parts():
+    parts = [{"type": "text", "text": "one two"}, {"type": "image_url", "image_url": {"url": "x"}},
+             {"type": "text", "text": "three"}]
+    assert count_content_tokens(WordTokenizer(), parts) == 3
+    assert count_content_tokens(WordTokenizer(), "<_MultiModalContent_>" + json.dumps(parts)) == 3
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("vllm")
+
+from vllm.entrypoints.openai.protocol import (ChatCompletionRequest, ChatCompletionResponse,  # noqa: E402
+                                              ChatCompletionResponseChoice, ChatMessage, ErrorResponse, UsageInfo)
+
+from app.core.response_cache import SSE_DONE, ResponseCache  # noqa: E402
+
+MODEL = "org/model"
+
+
+def make_request(content="Hello", **fields):
+    return ChatCompletionRequest(model=fields.pop("model", MODEL), messages=[{"role": "user", "content": content}],
+                                 **fields)
+
+
+def make_response(response_id="chat-original"):
+    return ChatCompletionResponse(id=response_id, model=MODEL, usage=UsageInfo(), choices=[
+        ChatCompletionResponseChoice(index=0, message=ChatMessage(role="assistant", content="Hi"), finish_reason="stop")])
+
+
+def stream_chunks(response_id="chat-original"):
+    return [f'data: {{"id":"{response_id}","choices":[{{"index":0,"delta":{{"content":"{text}"}}}}]}}\n\n'
+            for text in ("Hi", " there")] + [SSE_DONE]
+
+
+async def as_stream(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def consume(stream):
+    return [chunk async for chunk in stream]
+
+
+def test_only_deterministic_requests_are_cacheable():
+    assert ResponseCache.is_cacheable(make_request(temperature=0))
+    assert ResponseCache.is_cacheable(make_request(temperature=0.7, seed=42))
+    assert not ResponseCache.is_cacheable(make_request(temperature=0.7))
+
+
+def test_key_ignores_the_fields_that_dont_change_the_text():
+    key = ResponseCache.make_key(make_request(temperature=0), None)
+    assert key[0] == MODEL
+    assert key == ResponseCache.make_key(make_request(temperature=0, user="someone"), None)
+    assert key != ResponseCache.make_key(make_request("Hello!", temperature=0), None)
+    assert key != ResponseCache.make_key(make_request(temperature=0), "{{ messages }}")
+    assert key != ResponseCache.make_key(make_request(temperature=0, model="org/lora"), None)
+
+
+def test_response_is_replayed_with_a_new_id():
+    cache = ResponseCache(max_bytes=1 << 20, ttl=60)
+    key = ResponseCache.make_key(make_request(temperature=0), None)
+    assert cache.get(key) is None
+    stored = []
+    assert cache.capture(key, make_response(), on_store=lambda: stored.append(True)).id == "chat-original"
+    assert stored == [True]
+
+    replayed = cache.get(key)
+    assert replayed.choices[0].message.content == "Hi"
+    assert replayed.id != "chat-original"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_completed_stream_is_replayed_with_a_new_id():
+    cache = ResponseCache(max_bytes=1 << 20, ttl=60)
+    key = ResponseCache.make_key(make_request(temperature=0, stream=True), None)
+    chunks = stream_chunks()
+    assert asyncio.run(consume(cache.capture(key, as_stream(chunks)))) == chunks
+
+    replayed = asyncio.run(consume(cache.get(key)))
+    assert len(replayed) == len(chunks)
+    assert replayed[-1] == SSE_DONE
+    assert all("chat-original" not in chunk for chunk in replayed)
+    assert [chunk.split('"', 4)[4] for chunk in replayed[:-1]] == [chunk.split('"', 4)[4] for chunk in chunks[:-1]]
+
+
+def test_interrupted_stream_and_errors_are_not_stored():
+    cache = ResponseCache(max_bytes=1 << 20, ttl=60)
+    key = ResponseCache.make_key(make_request(temperature=0, stream=True), None)
+    asyncio.run(consume(cache.capture(key, as_stream(stream_chunks()[:-1]))))
+    assert cache.get(key) is None
+
+    error = ErrorResponse(message="failed", type="BadRequestError", code=400)
+    assert cache.capture(key, error) is error
+    assert cache.get(key) is None
+
+
+def test_entries_bigger_than_the_cache_are_not_stored():
+    cache = ResponseCache(max_bytes=10, ttl=60)
+    key = ResponseCache.make_key(make_request(temperature=0), None)
+    cache.capture(key, make_response())
+    assert cache.get(key) is None
+
+
+def test_clear_drops_the_entries_of_a_model():
+    cache = ResponseCache(max_bytes=1 << 20, ttl=60)
+    key = ResponseCache.make_key(make_request(temperature=0), None)
+    lora_key = ResponseCache.make_key(make_request(temperature=0, model="org/lora"), None)
+    cache.capture(key, make_response())
+    cache.capture(lora_key, make_response())
+
+    cache.clear("org/lora")
+    assert cache.get(lora_key) is None
+    assert cache.get(key) is not None
+    cache.clear()
+    assert cache.get(key) is None
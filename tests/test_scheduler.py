@@ -0,0 +1,147 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("vllm")
+
+from app.core.admission import AdmissionRejected, MAX_RETRY_AFTER  # noqa: E402
+from app.core.scheduler import FairScheduler, Lane  # noqa: E402
+
+
+async def served_order(scheduler, requests):
+    """
+    Hold the only turn while the requests queue, then release the turns one by one.
+    :param requests: (name, lane, user, demand) in arrival order
+    :return: the names in the order their turns came
+    """
+    order = []
+
+    async def wait_turn(name, lane, user, demand):
+        turn = await scheduler.acquire(lane, user, demand=demand)
+        order.append(name)
+        await asyncio.sleep(0)
+        scheduler.release(turn)
+
+    holder = await scheduler.acquire(Lane.INTERACTIVE, "holder")
+    tasks = []
+    for request in requests:
+        tasks.append(asyncio.create_task(wait_turn(*request)))
+        await asyncio.sleep(0)
+    assert order == []
+    scheduler.release(holder)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_lanes_are_served_in_order():
+    requests = [("background", Lane.BACKGROUND, "a", 0), ("internal", Lane.INTERNAL, "a", 0),
+                ("interactive", Lane.INTERACTIVE, "a", 0)]
+    order = asyncio.run(served_order(FairScheduler(max_running=1), requests))
+    assert order == ["interactive", "internal", "background"]
+
+
+def test_users_are_interleaved_within_a_lane():
+    requests = [(f"a{i}", Lane.INTERACTIVE, "a", 0) for i in range(3)] + [("b0", Lane.INTERACTIVE, "b", 0)]
+    order = asyncio.run(served_order(FairScheduler(max_running=1), requests))
+    assert order == ["a0", "b0", "a1", "a2"]
+
+
+def test_weights_give_a_user_a_bigger_share():
+    requests = [(f"a{i}", Lane.INTERACTIVE, "a", 0) for i in range(4)] + \
+               [(f"b{i}", Lane.INTERACTIVE, "b", 0) for i in range(2)]
+    scheduler = FairScheduler(max_running=1, weights={"a": 2.0})
+    order = asyncio.run(served_order(scheduler, requests))
+    assert order == ["a0", "b0", "a1", "a2", "b1", "a3"]
+
+
+def test_demand_is_bounded_by_the_capacity():
+    async def run():
+        scheduler = FairScheduler(max_running=4, capacity=100)
+        first = await scheduler.acquire(Lane.INTERACTIVE, "a", demand=60)
+        waiting = asyncio.create_task(scheduler.acquire(Lane.INTERACTIVE, "b", demand=60))
+        await asyncio.sleep(0)
+        assert not waiting.done() and scheduler.outstanding == 60
+        scheduler.release(first)
+        second = await waiting
+        assert scheduler.outstanding == 60
+        scheduler.release(second)
+        # a request bigger than the cache still gets the engine once it is alone
+        scheduler.release(await scheduler.acquire(Lane.INTERACTIVE, "c", demand=500))
+        assert (scheduler.running, scheduler.outstanding) == (0, 0)
+
+    asyncio.run(run())
+
+
+def test_interactive_requests_are_rejected_when_the_queue_is_full():
+    async def run():
+        scheduler = FairScheduler(max_running=1, max_waiting=1)
+        holder = await scheduler.acquire(Lane.INTERACTIVE, "a")
+        waiting = asyncio.create_task(scheduler.acquire(Lane.INTERACTIVE, "b"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            await scheduler.acquire(Lane.INTERACTIVE, "c")
+        assert rejected.value.queue_position == 2
+        assert 1 <= rejected.value.retry_after <= MAX_RETRY_AFTER
+        # the server's own requests always wait
+        background = asyncio.create_task(scheduler.acquire(Lane.BACKGROUND, "c"))
+        await asyncio.sleep(0)
+        assert scheduler.waiting == 2
+        scheduler.release(holder)
+        scheduler.release(await waiting)
+        scheduler.release(await background)
+
+    asyncio.run(run())
+
+
+def test_interactive_request_waiting_too_long_is_rejected_and_skipped():
+    async def run():
+        scheduler = FairScheduler(max_running=1, max_wait=0.01)
+        holder = await scheduler.acquire(Lane.INTERACTIVE, "a")
+        with pytest.raises(AdmissionRejected) as rejected:
+            await scheduler.acquire(Lane.INTERACTIVE, "b")
+        assert rejected.value.queue_position == 1
+        assert scheduler.waiting == 0
+        scheduler.release(holder)
+        assert scheduler.running == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_does_not_keep_a_turn():
+    async def run():
+        scheduler = FairScheduler(max_running=1)
+        holder = await scheduler.acquire(Lane.INTERACTIVE, "a")
+        waiting = asyncio.create_task(scheduler.acquire(Lane.INTERACTIVE, "b"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        scheduler.release(holder)
+        assert scheduler.running == 0
+        scheduler.release(await scheduler.acquire(Lane.INTERACTIVE, "c"))
+
+    asyncio.run(run())
+
+
+def test_release_after_holds_the_turn_until_the_stream_ends():
+    async def stream():
+        yield "a"
+        yield "b"
+
+    async def run():
+        scheduler = FairScheduler(max_running=1)
+        turn = await scheduler.acquire(Lane.INTERACTIVE, "a")
+        chunks = []
+        async for chunk in scheduler.release_after(turn, stream()):
+            chunks.append(chunk)
+            assert scheduler.running == 1
+        assert chunks == ["a", "b"]
+        assert scheduler.running == 0
+
+    asyncio.run(run())
+
+
+def test_retry_after_is_bounded():
+    scheduler = FairScheduler(max_running=1)
+    assert scheduler.retry_after(0) == 1
+    assert scheduler.retry_after(10 ** 6) == MAX_RETRY_AFTER
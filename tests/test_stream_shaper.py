@@ -0,0 +1,126 @@
+import asyncio
+import json
+
+import pytest
+from starlette.requests import Request
+
+from app.core.stream_shaper import StreamShaper, is_direct_local_client, merge_chunks
+
+
+def delta_chunk(content, completion_id="chatcmpl-1", **choice):
+    data = {"id": completion_id, "choices": [{"index": 0, "delta": {"content": content}, **choice}]}
+    return f"data: {json.dumps(data)}\n\n"
+
+
+def chunk_contents(chunks):
+    contents = []
+    for chunk in chunks:
+        for event in chunk.split("\n\n"):
+            if event.startswith("data: {"):
+                contents.append(json.loads(event[len("data: "):])["choices"][0]["delta"].get("content", ""))
+    return contents
+
+
+async def paced(chunks, pauses=None):
+    for i, chunk in enumerate(chunks):
+        await asyncio.sleep((pauses or {}).get(i, 0.001))
+        yield chunk
+
+
+async def collect(shaper, stream, consumer_delay=0.0):
+    batches = []
+    async for batch in shaper.shape(stream):
+        batches.append(batch)
+        await asyncio.sleep(consumer_delay)
+    return batches
+
+
+def test_merge_chunks_joins_the_text_deltas():
+    merged = merge_chunks([delta_chunk("Hel"), delta_chunk("lo"), delta_chunk("!", finish_reason="stop")])
+    assert len(merged) == 1
+    data = json.loads(merged[0][len("data: "):])
+    assert data["choices"][0]["delta"]["content"] == "Hello!"
+    assert data["choices"][0]["finish_reason"] == "stop"
+
+
+def test_merge_chunks_keeps_what_it_cannot_merge():
+    chunks = [delta_chunk("a"), delta_chunk("b", completion_id="chatcmpl-2"),
+              delta_chunk("c", completion_id="chatcmpl-2", logprobs={"content": []}), "data: [DONE]\n\n"]
+    assert merge_chunks(chunks) == chunks
+
+
+def test_merge_chunks_does_not_merge_after_the_finish_reason():
+    chunks = [delta_chunk("a", finish_reason="stop"), delta_chunk("b")]
+    assert merge_chunks(chunks) == chunks
+
+
+def test_first_chunk_is_sent_alone_then_batched_by_count():
+    chunks = [f"c{i} " for i in range(9)]
+    batches = asyncio.run(collect(StreamShaper(flush_tokens=4, flush_ms=1000, max_pending=64), paced(chunks)))
+    assert batches == ["c0 ", "c1 c2 c3 c4 ", "c5 c6 c7 c8 "]
+
+
+def test_pending_chunks_are_flushed_after_the_window():
+    chunks = ["a", "b", "c"]
+    shaper = StreamShaper(flush_tokens=100, flush_ms=20, max_pending=64)
+    batches = asyncio.run(collect(shaper, paced(chunks, pauses={2: 0.3})))
+    assert batches == ["a", "b", "c"]
+
+
+def test_slow_client_gets_merged_deltas_without_losing_text():
+    chunks = [delta_chunk(f"{i} ") for i in range(30)]
+    shaper = StreamShaper(flush_tokens=1, flush_ms=1, max_pending=4)
+    batches = asyncio.run(collect(shaper, paced(chunks), consumer_delay=0.02))
+    assert "".join(chunk_contents(batches)) == "".join(f"{i} " for i in range(30))
+    assert len(chunk_contents(batches)) < len(chunks)
+
+
+def test_upstream_error_is_raised_after_the_chunks_before_it():
+    async def failing():
+        yield "a"
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def run():
+        batches = []
+        with pytest.raises(ValueError, match="upstream failed"):
+            async for batch in StreamShaper(4, 10, 16).shape(failing()):
+                batches.append(batch)
+        return batches
+
+    assert asyncio.run(run()) == ["a"]
+
+
+def test_upstream_is_closed_when_the_client_leaves():
+    closed = asyncio.Event()
+
+    async def endless():
+        try:
+            while True:
+                await asyncio.sleep(0.001)
+                yield "a"
+        finally:
+            closed.set()
+
+    async def run():
+        shaped = StreamShaper(4, 10, 16).shape(endless())
+        await shaped.__anext__()
+        await shaped.aclose()
+        return closed.is_set()
+
+    assert asyncio.run(run())
+
+
+def make_request(client_host, host_header, headers=()):
+    return Request({"type": "http", "method": "POST", "path": "/v1/chat/completions", "query_string": b"",
+                    "scheme": "http", "server": ("127.0.0.1", 8000), "client": (client_host, 50000),
+                    "headers": [(b"host", host_header.encode()), *headers]})
+
+
+def test_direct_local_client():
+    assert is_direct_local_client(make_request("127.0.0.1", "localhost:8000"))
+    assert not is_direct_local_client(None)
+    assert not is_direct_local_client(make_request("10.0.0.2", "localhost:8000"))
+    # a tunnel connects from localhost but keeps the public host or adds forwarding headers
+    assert not is_direct_local_client(make_request("127.0.0.1", "pulsar.example.com"))
+    assert not is_direct_local_client(make_request("127.0.0.1", "localhost:8000", [(b"x-forwarded-for", b"1.2.3.4")]))